@@ -97,20 +97,136 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD', 'amolsawant@123'),
         'HOST': '34.93.114.125',
         'PORT': '5432',
-    }
+    },
+    # Only used by the loadtest command, which creates its test database and
+    # drops it again at the end of every run
+    'loadtest': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        'TEST': {'DEPENDENCIES': []},
+    },
 }
 
 
 
+# Group messages reach members in the same process directly and only go
+# through Redis for members connected to other processes
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "app.channel_layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)], 
+            "backend": "channels_redis.core.RedisChannelLayer",
+            "config": {
+                "hosts": [("127.0.0.1", 6379)],
+            },
         },
     },
 }
 
+# Real-time editing: live document content is kept in memory and written back
+# after this many seconds of unsaved edits, or after this many edits
+COLLAB_FLUSH_INTERVAL = 2.0
+COLLAB_FLUSH_OPS = 50
+
+# Recent edits kept per live document. Clients that reconnect within this many
+# revisions receive only the edits they missed instead of the whole document
+COLLAB_HISTORY_SIZE = 1000
+
+# Cursor moves are batched into one presence frame per document this often (seconds)
+COLLAB_PRESENCE_TICK = 0.03
+
+# Messages to each client are sent in one batch per tick (seconds). A client
+# with more queued messages than the maximum, or whose last frame has waited
+# on the socket for longer than the maximum send lag (seconds), gets a
+# document snapshot instead of the edits it missed
+COLLAB_OUTBOUND_TICK = 0.01
+COLLAB_OUTBOUND_MAX_QUEUE = 500
+COLLAB_OUTBOUND_MAX_SEND_LAG = 1.0
+
+# Clients on a +zlib binary subprotocol (app/compact.py) get frames of at
+# least this many bytes compressed
+COLLAB_BINARY_COMPRESS_MIN = 1024
+# Compressed frames from clients are rejected if they inflate past this many bytes
+COLLAB_BINARY_MAX_FRAME = 4 * 1024 * 1024
+
+# Writing suggestions are analyzed by a pool of worker threads, in batches
+# of up to BATCH_SIZE requests. A request waits DEBOUNCE seconds and is
+# dropped if the same connection sends a newer one meanwhile
+COLLAB_SUGGESTION_WORKERS = 2
+COLLAB_SUGGESTION_BATCH_SIZE = 32
+COLLAB_SUGGESTION_DEBOUNCE = 0.3
+
+# Files of misspelling->correction lines checked by the spelling suggestions.
+# The bundled list covers a few hundred common mistakes; add larger lists in
+# the same format through COLLAB_SUGGESTION_CORRECTIONS_FILES (separated by
+# the OS path separator), later files overriding earlier ones
+COLLAB_SUGGESTION_CORRECTIONS = [BASE_DIR / 'app' / 'suggestions' / 'data' / 'corrections.txt'] + [
+    path for path in os.environ.get('COLLAB_SUGGESTION_CORRECTIONS_FILES', '').split(os.pathsep) if path
+]
+
+# Suggestions for unchanged paragraphs are reused; this many documents keep
+# their per-paragraph results in each process
+COLLAB_SUGGESTION_CACHE_DOCUMENTS = 100
+
+# Decides when live edits become a version: after a pause following a
+# meaningful change, every max_ops edits or max_interval seconds, and when
+# the last editor leaves
+COLLAB_VERSION_POLICY = {
+    'BACKEND': 'app.collab.policy.CoalescingVersionPolicy',
+    'OPTIONS': {
+        'idle_seconds': 30,
+        'min_changes': 20,
+        'max_ops': 500,
+        'max_interval': 300,
+    },
+}
+
+# Who is connected to which document. Entries expire after ttl seconds
+# without a heartbeat. Use app.presence.RedisPresenceRegistry (OPTIONS: url,
+# ttl) when running several ASGI workers
+COLLAB_PRESENCE = {
+    'BACKEND': 'app.presence.InMemoryPresenceRegistry',
+    'OPTIONS': {'ttl': 60},
+}
+
+# Workers running the WebSocket consumers. Each document is owned by one of
+# them, picked by consistent hashing over the live workers; the others
+# forward their editors' ops to it. Use app.collab.cluster.RedisWorkerRegistry
+# (OPTIONS: url, ttl) when running several ASGI workers
+COLLAB_CLUSTER = {
+    'BACKEND': 'app.collab.cluster.InMemoryWorkerRegistry',
+    'OPTIONS': {'ttl': 15},
+}
+
+# Every Nth version of a document stores its full content, the rest store a
+# diff against the previous version
+DOCUMENT_VERSION_KEYFRAME_INTERVAL = 20
+
+# Number of version diffs kept in memory by each process
+VERSION_DIFF_CACHE_SIZE = 256
+
+# The default cache lives in each process's memory
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Cache holding document access decisions, and seconds a decision is kept.
+# Changes to collaborators or visibility take effect at once in the worker
+# that made them; other workers only see them once the TTL runs out unless
+# this alias names a cache they all share, such as
+# django.core.cache.backends.redis.RedisCache, when running several workers
+ACCESS_CACHE_ALIAS = 'default'
+DOCUMENT_ACCESS_CACHE_TTL = 10
+
+# Cache holding users' rendered dashboard document lists, and seconds they
+# are kept. Creating, sharing or deleting documents refreshes them at once
+# in the worker that made the change, and in every worker with a shared
+# cache; "last updated" times from live editing may lag by up to the TTL
+DASHBOARD_CACHE_ALIAS = 'default'
+DASHBOARD_CACHE_TTL = 30
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
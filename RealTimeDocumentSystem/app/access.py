@@ -0,0 +1,112 @@
+"""
+Document access checks shared by the WebSocket consumer and the views.
+
+A user may open a document they own, collaborate on, or that is public.
+The answer comes from a single EXISTS query and is cached per (user,
+document) for DOCUMENT_ACCESS_CACHE_TTL seconds, so a wave of reconnects
+after a deploy is served from the cache. Cached decisions for a document are
+dropped whenever its collaborators, visibility or owner change by bumping a
+per-document generation that is part of every cache key.
+
+Decisions live in the cache named by ACCESS_CACHE_ALIAS. The generation is
+bumped in the process that made the change, so only a cache shared by all
+workers, such as Redis, makes revocations take effect everywhere at once;
+with a per-process cache other workers notice when their TTL runs out.
+"""
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Document
+
+DEFAULT_ACCESS_CACHE_TTL = 10
+
+Collaborator = Document.collaborators.through
+
+
+def get_access_cache_ttl():
+    return getattr(settings, 'DOCUMENT_ACCESS_CACHE_TTL', DEFAULT_ACCESS_CACHE_TTL)
+
+
+def get_access_cache():
+    return caches[getattr(settings, 'ACCESS_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+
+def _generation_key(doc_id):
+    return f'doc_access_gen:{doc_id}'
+
+
+def _decision_key(doc_id, generation, user_id):
+    return f'doc_access:{doc_id}:{generation}:{user_id}'
+
+
+def collaborating(user_id):
+    """Expression that is true for documents the user collaborates on"""
+    return Exists(Collaborator.objects.filter(document_id=OuterRef('pk'), user_id=user_id))
+
+
+def accessible_filter(user_id):
+    """Q object matching every document the user may open"""
+    return Q(owner_id=user_id) | Q(is_public=True) | collaborating(user_id)
+
+
+def query_access(user_id, doc_id):
+    """Ask the database whether a user may open a document"""
+    return Document.objects.filter(accessible_filter(user_id), id=doc_id).exists()
+
+
+def can_access_document(user, doc_id):
+    """Whether user may open the document; False if it does not exist"""
+    if not user.is_authenticated:
+        return False
+    cache = get_access_cache()
+    generation = cache.get_or_set(_generation_key(doc_id), 0, None)
+    key = _decision_key(doc_id, generation, user.id)
+    allowed = cache.get(key)
+    if allowed is None:
+        allowed = query_access(user.id, doc_id)
+        cache.set(key, allowed, get_access_cache_ttl())
+    return allowed
+
+
+def invalidate_document_access(doc_id):
+    """Forget every cached decision for a document"""
+    cache = get_access_cache()
+    try:
+        cache.incr(_generation_key(doc_id))
+    except ValueError:
+        # No decisions were cached under the default generation
+        cache.add(_generation_key(doc_id), 1, None)
+
+
+@receiver(post_save, sender=Document)
+def document_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    # Only saves that may touch visibility or ownership matter
+    if update_fields is not None and not {'is_public', 'owner', 'owner_id'} & set(update_fields):
+        return
+    invalidate_document_access(instance.pk)
+
+
+@receiver(post_delete, sender=Document)
+def document_deleted(sender, instance, **kwargs):
+    invalidate_document_access(instance.pk)
+
+
+@receiver(m2m_changed, sender=Collaborator)
+def collaborators_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_document_access(instance.pk)
+    elif action == 'pre_clear':
+        # Changed from the user's side; clears do not say which documents
+        instance._cleared_document_ids = list(
+            Document.objects.filter(collaborators=instance).values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_document_ids', ())
+        for doc_id in pk_set:
+            invalidate_document_access(doc_id)
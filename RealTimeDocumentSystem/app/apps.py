@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # Connects the signal handlers that keep cached access checks and
+        # dashboards fresh
+        from . import access, dashboard  # noqa: F401
@@ -0,0 +1,210 @@
+"""
+Channel layer that fans group messages out in process where it can.
+
+HybridChannelLayer wraps another layer, usually channels_redis, and keeps
+track of which group members live in this process. A group_send puts the
+message straight into the receive queues of local members and publishes it
+once through the wrapped layer for the members of other processes::
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'app.channel_layers.HybridChannelLayer',
+            'CONFIG': {
+                'backend': 'channels_redis.core.RedisChannelLayer',
+                'config': {'hosts': [('127.0.0.1', 6379)]},
+            },
+        },
+    }
+
+In the wrapped layer a process is a single member of each group it has
+local members in, under a channel of its own. A message published there
+reaches every other process once, which then delivers it to its own
+local members; a process skips the copy of its own messages. The message
+is published even if no other process has members in the group: a
+process that has just joined cannot be known to the others before a
+round trip, and skipping the publish would lose messages meant for it.
+Messages from
+one sender reach each receiver in the order they were sent: local
+receivers get them through their local queue, remote ones through the
+wrapped layer, and each path keeps its order.
+
+Local members receive a shallow copy of the message dict, not a
+serialized one, so handlers must not modify nested values in place.
+"""
+import asyncio
+import collections
+import logging
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INNER_LAYER = 'channels.layers.InMemoryChannelLayer'
+
+# Type of the envelope other processes receive on their process channel
+GROUP_MESSAGE = 'hybrid.group'
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, backend=DEFAULT_INNER_LAYER, config=None, inner=None, capacity=100, **kwargs):
+        super().__init__(capacity=capacity, **kwargs)
+        self.inner = inner if inner is not None else import_string(backend)(**(config or {}))
+        self._reset()
+
+    def _reset(self):
+        self.loop = None
+        # channel -> messages delivered in process, waiting to be received
+        self.local_queues = {}
+        # channel -> pending receive() on the wrapped layer, kept across calls
+        self.inner_receives = {}
+        # group -> local member channels
+        self.local_groups = collections.defaultdict(set)
+        self.process_channel = None
+        self.process_receiver = None
+
+    def _check_loop(self):
+        # Queues and tasks belong to one event loop, as with the in-memory layer
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            if self.process_receiver is not None:
+                self.process_receiver.cancel()
+            self._reset()
+            self.loop = loop
+
+    def _queue(self, channel):
+        queue = self.local_queues.get(channel)
+        if queue is None:
+            queue = self.local_queues[channel] = asyncio.Queue()
+        return queue
+
+    async def _ensure_process_channel(self):
+        if self.process_channel is None:
+            self.process_channel = await self.inner.new_channel(prefix='hybrid')
+        self._ensure_receiving()
+        return self.process_channel
+
+    def _ensure_receiving(self):
+        # Restarted after an error, on the next join or send
+        if self.process_channel is not None and (self.process_receiver is None or self.process_receiver.done()):
+            self.process_receiver = asyncio.ensure_future(self._receive_remote())
+
+    async def _receive_remote(self):
+        """Deliver group messages published by other processes to local members"""
+        while True:
+            try:
+                envelope = await self.inner.receive(self.process_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Also raised by some layers when the receive is cancelled,
+                # so stop rather than retry
+                if asyncio.current_task() is self.process_receiver:
+                    logger.error(f"Error receiving from the wrapped channel layer: {str(e)}")
+                return
+            if envelope.get('type') != GROUP_MESSAGE or envelope.get('origin') == self.process_channel:
+                continue
+            self._deliver_local(envelope['group'], envelope['message'])
+
+    def _deliver_local(self, group, message):
+        for channel in list(self.local_groups.get(group, ())):
+            queue = self._queue(channel)
+            if queue.qsize() >= self.get_capacity(channel):
+                # Like the stock layers, a full channel misses group messages
+                continue
+            queue.put_nowait(dict(message))
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        return await self.inner.new_channel(prefix)
+
+    async def send(self, channel, message):
+        self._check_loop()
+        if channel in self.local_queues:
+            queue = self.local_queues[channel]
+            if queue.qsize() >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            queue.put_nowait(dict(message))
+        else:
+            await self.inner.send(channel, message)
+
+    async def receive(self, channel):
+        """The next message for channel, delivered locally or through the wrapped layer"""
+        self._check_loop()
+        queue = self._queue(channel)
+        if not queue.empty():
+            return queue.get_nowait()
+
+        inner_receive = self.inner_receives.get(channel)
+        if inner_receive is None:
+            inner_receive = self.inner_receives[channel] = asyncio.ensure_future(self.inner.receive(channel))
+        local_receive = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait([local_receive, inner_receive], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # Nobody is listening on the channel any more
+            local_receive.cancel()
+            inner_receive.cancel()
+            self.inner_receives.pop(channel, None)
+            if queue.empty():
+                self.local_queues.pop(channel, None)
+            raise
+
+        if local_receive.done():
+            # The wrapped receive stays pending for the next call
+            return local_receive.result()
+        local_receive.cancel()
+        del self.inner_receives[channel]
+        return inner_receive.result()
+
+    async def group_add(self, group, channel):
+        self._check_loop()
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._queue(channel)
+        self.local_groups[group].add(channel)
+        # Refreshed on every join so the membership does not expire
+        await self.inner.group_add(group, await self._ensure_process_channel())
+
+    async def group_discard(self, group, channel):
+        self._check_loop()
+        members = self.local_groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.local_groups[group]
+            if self.process_channel is not None:
+                await self.inner.group_discard(group, self.process_channel)
+
+    async def group_send(self, group, message):
+        self._check_loop()
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        self._ensure_receiving()
+        self._deliver_local(group, message)
+        await self.inner.group_send(group, {
+            'type': GROUP_MESSAGE,
+            'group': group,
+            'origin': self.process_channel,
+            'message': message,
+        })
+
+    async def flush(self):
+        pending = list(self.inner_receives.values())
+        if self.process_receiver is not None:
+            pending.append(self.process_receiver)
+        self._reset()
+        for task in pending:
+            task.cancel()
+        # Let the receives on the wrapped layer unwind before it is emptied
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.inner.flush()
+
+    async def close(self):
+        if hasattr(self.inner, 'close'):
+            await self.inner.close()
@@ -0,0 +1,32 @@
+"""
+JSON encoding for WebSocket traffic.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+produce compact UTF-8 JSON text, so encoded frames are interchangeable.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    def loads(data):
+        return json.loads(data)
+
+
+def join_batch(frames):
+    """Wrap already encoded messages in a batch message without re-encoding them"""
+    return '{"type":"batch","messages":[' + ','.join(frames) + ']}'
@@ -0,0 +1,12 @@
+from .engine import DocumentEngine, StaleRevisionError
+from .ops import InvalidOperation, apply_ops, diff_ops, parse_ops, transform
+
+__all__ = [
+    'DocumentEngine',
+    'InvalidOperation',
+    'StaleRevisionError',
+    'apply_ops',
+    'diff_ops',
+    'parse_ops',
+    'transform',
+]
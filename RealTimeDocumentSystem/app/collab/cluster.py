@@ -0,0 +1,648 @@
+"""
+Document ownership across ASGI worker processes.
+
+Each worker registers itself in a worker registry under a channel name of
+its own on the channel layer. Documents are assigned to the live workers
+with a consistent hash ring keyed on the document id, so every document
+has a single owner holding its authoritative DocumentEngine, and adding or
+removing a worker only moves about 1/N of the documents.
+
+Workers with editors on a document they do not own keep a replica of it:
+they subscribe to the owner for a snapshot, then follow the edits the
+owner broadcasts to the document group. Their editors' ops are forwarded
+to the owner, which applies and broadcasts them like its own.
+
+When the ring changes, the previous owner of a document asks the new one
+to take it over. The new owner claims the document from the other
+workers; whichever holds it writes it back, hands over its content,
+revision and history and becomes a replica. Revisions and the epoch carry
+over, so clients do not notice. A document nobody holds, for example
+because its owner died, is loaded from the database and its replicas tell
+their clients to resync. The registry is configured with COLLAB_CLUSTER::
+
+    COLLAB_CLUSTER = {
+        'BACKEND': 'app.collab.cluster.RedisWorkerRegistry',
+        'OPTIONS': {'url': 'redis://127.0.0.1:6379/3', 'ttl': 15},
+    }
+
+With the default in-memory registry a worker only knows itself and owns
+every document, which is all a single process needs.
+"""
+import asyncio
+import atexit
+import bisect
+import hashlib
+import itertools
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .. import codec
+from .engine import StaleRevisionError
+from .ops import InvalidOperation
+from .state import DocumentState, document_states
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKER_REGISTRY = 'app.collab.cluster.InMemoryWorkerRegistry'
+DEFAULT_WORKER_TTL = 15
+DEFAULT_RING_REPLICAS = 64
+DEFAULT_REQUEST_TIMEOUT = 5.0
+
+# A forwarded edit that has not reached the owner after this many workers
+# is answered with a resync instead
+MAX_HOPS = 4
+# A replica missing this many revisions has lost a broadcast and resyncs
+MAX_PENDING = 100
+
+
+def document_group(doc_id):
+    return f'document_{doc_id}'
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring with ``replicas`` points per node"""
+
+    def __init__(self, nodes=(), replicas=DEFAULT_RING_REPLICAS):
+        self.nodes = frozenset(nodes)
+        points = sorted((ring_hash(f'{node}#{index}'), node) for node in self.nodes for index in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        return self.owners[bisect.bisect(self.hashes, ring_hash(str(key))) % len(self.hashes)]
+
+
+class WorkerRegistry:
+    """Base class. Workers stay listed for ``ttl`` seconds after their last heartbeat."""
+
+    def __init__(self, ttl=DEFAULT_WORKER_TTL):
+        self.ttl = ttl
+
+    @property
+    def heartbeat_interval(self):
+        return self.ttl / 3
+
+    def heartbeat(self, worker):
+        raise NotImplementedError
+
+    def leave(self, worker):
+        raise NotImplementedError
+
+    def workers(self):
+        """Names of the live workers"""
+        raise NotImplementedError
+
+
+class InMemoryWorkerRegistry(WorkerRegistry):
+    def __init__(self, ttl=DEFAULT_WORKER_TTL, clock=time.monotonic):
+        super().__init__(ttl)
+        self.clock = clock
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def heartbeat(self, worker):
+        with self.lock:
+            self.expires[worker] = self.clock() + self.ttl
+
+    def leave(self, worker):
+        with self.lock:
+            self.expires.pop(worker, None)
+
+    def workers(self):
+        now = self.clock()
+        with self.lock:
+            for worker in [worker for worker, expires in self.expires.items() if expires <= now]:
+                del self.expires[worker]
+            return sorted(self.expires)
+
+
+class RedisWorkerRegistry(WorkerRegistry):
+    """A sorted set of worker names scored by when they expire"""
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', ttl=DEFAULT_WORKER_TTL, key='collab:workers', client=None):
+        super().__init__(ttl)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.key = key
+
+    def heartbeat(self, worker):
+        self.client.zadd(self.key, {worker: time.time() + self.ttl})
+
+    def leave(self, worker):
+        self.client.zrem(self.key, worker)
+
+    def workers(self):
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(self.key, '-inf', time.time())
+        pipe.zrange(self.key, 0, -1)
+        return sorted(worker.decode() if isinstance(worker, bytes) else worker for worker in pipe.execute()[1])
+
+
+class Cluster:
+    """
+    This worker's view of the cluster. Consumers acquire and release
+    documents and submit edits through it rather than through the state
+    manager, so that edits end up at the document's owner.
+    """
+
+    def __init__(self, registry, channel_layer=None, manager=None, worker=None,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.registry = registry
+        # None follows the default layer in CHANNEL_LAYERS, looked up per event loop
+        self.configured_layer = channel_layer
+        self.channel_layer = channel_layer
+        self.manager = manager if manager is not None else document_states
+        self.worker = worker
+        self.request_timeout = request_timeout
+        self.ring = HashRing()
+        self.loop = None
+        self._ready = None
+        self._receiver = None
+        self._heartbeat = None
+        self._replies = {}
+        self._request_ids = itertools.count()
+        # doc_id -> broadcasts received while a replica is being loaded
+        self._loading = {}
+        # doc_id -> set once a claim for the document has finished
+        self._claims = {}
+
+    async def start(self):
+        """Register this worker and start listening, once per event loop"""
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            await self._ready.wait()
+            return
+        self.loop = loop
+        self._ready = asyncio.Event()
+        self._replies = {}
+        self._loading = {}
+        self._claims = {}
+        try:
+            if self.configured_layer is None:
+                self.channel_layer = get_channel_layer()
+            if self.worker is None:
+                self.worker = await self.channel_layer.new_channel(prefix='collab')
+            await self.refresh()
+        except Exception:
+            self.loop = None
+            raise
+        finally:
+            self._ready.set()
+        self._receiver = loop.create_task(self._receive())
+        self._heartbeat = loop.create_task(self._run_heartbeat())
+
+    def stop(self):
+        """Leave the cluster, from synchronous code when the process exits"""
+        if self.worker is None:
+            return
+        # Written back first, so the next owners load the latest content
+        self.manager.flush_all_sync()
+        try:
+            self.registry.leave(self.worker)
+        except Exception as e:
+            logger.error(f"Error leaving the cluster: {str(e)}")
+
+    def owner(self, doc_id):
+        return self.ring.owner(doc_id) or self.worker
+
+    async def refresh(self):
+        """Heartbeat, pick up workers that joined or left and move documents accordingly"""
+        await sync_to_async(self.registry.heartbeat)(self.worker)
+        workers = set(await sync_to_async(self.registry.workers)())
+        workers.add(self.worker)
+        if workers == self.ring.nodes:
+            return
+        logger.info(f"Worker {self.worker} sees {len(workers)} workers")
+        self.ring = HashRing(workers)
+
+        for state in list(self.manager.states.values()):
+            if state.is_replica:
+                if state.owner not in workers:
+                    await self.resync(state)
+                continue
+            for worker in state.subscribers - workers:
+                await self._unsubscribe(state, worker)
+            owner = self.owner(state.doc_id)
+            if owner != self.worker:
+                # The new owner claims the document from us
+                await self.channel_layer.send(owner, {'type': 'collab.take', 'doc_id': state.doc_id})
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.registry.heartbeat_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error in cluster heartbeat: {str(e)}")
+
+    # Consumer API
+
+    async def acquire(self, doc_id):
+        await self.start()
+        if self.owner(doc_id) == self.worker:
+            return await self.manager.acquire(doc_id, load=self._load_owned)
+        return await self.manager.acquire(doc_id, load=self._load_replica)
+
+    async def release(self, doc_id):
+        state = self.manager.get(doc_id)
+        await self.manager.release(doc_id)
+        if state is not None and state.is_replica and self.manager.get(doc_id) is not state:
+            await self.channel_layer.group_discard(document_group(doc_id), self.worker)
+            await self.channel_layer.send(state.owner, {
+                'type': 'collab.unsubscribe', 'doc_id': doc_id, 'worker': self.worker})
+
+    async def submit_edit(self, state, edit):
+        """
+        Apply an edit here or forward it to the owner. ``edit`` holds
+        base_revision, ops, cursor_position, user_id, username, epoch and
+        the sender's channel name. Returns False if the edit was based on
+        a revision that cannot be rebased, in which case the sender should
+        resync; a forwarded edit is answered with a document_resync event.
+        """
+        if state.is_replica:
+            await self.channel_layer.send(state.owner, dict(edit, type='collab.edit', doc_id=state.doc_id, hops=0))
+            return True
+        return await self.apply_edit(state, edit)
+
+    async def apply_edit(self, state, edit):
+        # Broadcast under the lock so peers receive revisions in order
+        async with state.lock:
+            if state.is_replica:
+                # Handed over while we were waiting for the lock
+                await self.channel_layer.send(state.owner, dict(
+                    edit, type='collab.edit', doc_id=state.doc_id, hops=edit.get('hops', 0) + 1))
+                return True
+            try:
+                if edit['epoch'] != state.epoch:
+                    raise StaleRevisionError(f"epoch {edit['epoch']!r} is not the current one")
+                # Concurrent ops applied since base_revision are transformed away
+                revision, ops = state.engine.apply(edit['base_revision'], edit['ops'])
+            except (StaleRevisionError, InvalidOperation) as e:
+                logger.warning(f"Delta from {edit['username']} does not apply to document {state.doc_id}: {e}")
+                return False
+            self.manager.mark_dirty(state, edit['user_id'], ops)
+            await self.broadcast_ops(state, ops, revision, edit)
+        return True
+
+    async def broadcast_ops(self, state, ops, revision, edit):
+        # Encoded once here; receiving consumers forward the frame as is
+        frame = codec.dumps({
+            'type': 'edit_delta',
+            'ops': ops,
+            'revision': revision,
+            'cursor_position': edit['cursor_position'],
+            'user_id': edit['user_id'],
+            'username': edit['username']
+        })
+        await self.channel_layer.group_send(document_group(state.doc_id), {
+            'type': 'broadcast_edit_delta',
+            'frame': frame,
+            'doc_id': state.doc_id,
+            'revision': revision,
+            'epoch': state.epoch,
+            'cursor_position': edit['cursor_position'],
+            'user_id': edit['user_id'],
+            'username': edit['username'],
+            'sender_channel_name': edit['sender_channel_name']
+        })
+
+    async def save_version(self, state, user_id):
+        """Store a version of the document now; returns its number or None"""
+        if state.is_replica:
+            reply = await self.request(state.owner, {
+                'type': 'collab.save_version', 'doc_id': state.doc_id, 'user_id': user_id})
+            return reply['version_number']
+        version = await self.manager.flush(state, force_version_by=user_id)
+        return version.version_number if version is not None else None
+
+    async def write_content(self, doc_id, content, user_id, username, version=False):
+        """
+        Replace a document's content from outside a WebSocket session, as
+        for REST saves. The change is applied at the owner as an edit, so
+        open sessions receive it and later flushes do not undo it; it is
+        written back before this returns. With ``version`` a version is
+        stored as well and its number returned.
+        """
+        state = await self.acquire(doc_id)
+        try:
+            if state.is_replica:
+                reply = await self.request(state.owner, {
+                    'type': 'collab.write', 'doc_id': doc_id, 'content': content,
+                    'user_id': user_id, 'username': username, 'version': version})
+                if not reply['written']:
+                    raise StaleRevisionError(f'document {doc_id} moved while being written')
+                return reply['version_number']
+            return await self._write(state, content, user_id, username, version)
+        finally:
+            await self.release(doc_id)
+
+    async def _write(self, state, content, user_id, username, version):
+        async with state.lock:
+            revision, ops = state.engine.replace(content)
+            if ops:
+                self.manager.mark_dirty(state, user_id, ops)
+                await self.broadcast_ops(state, ops, revision, {
+                    'cursor_position': 0, 'user_id': user_id, 'username': username, 'sender_channel_name': None})
+        if version:
+            return await self.save_version(state, user_id)
+        await self.manager.flush(state)
+        return None
+
+    # Loading documents
+
+    async def _load_owned(self, doc_id):
+        state = await self.manager.load(doc_id)
+        snapshot = await self.claim(doc_id)
+        if snapshot is not None:
+            self._install(state, snapshot)
+        return state
+
+    async def _load_replica(self, doc_id, owner=None):
+        owner = owner or self.owner(doc_id)
+        # Broadcasts that overtake the snapshot are kept and applied after it
+        self._loading[doc_id] = []
+        await self.channel_layer.group_add(document_group(doc_id), self.worker)
+        try:
+            for _ in range(MAX_HOPS):
+                reply = await self.request(owner, {'type': 'collab.subscribe', 'doc_id': doc_id, 'worker': self.worker})
+                if reply.get('snapshot') is not None:
+                    break
+                owner = reply['owner']
+                if owner == self.worker:
+                    await self.channel_layer.group_discard(document_group(doc_id), self.worker)
+                    return await self._load_owned(doc_id)
+            else:
+                raise RuntimeError(f'No owner found for document {doc_id}')
+            state = DocumentState(doc_id, '')
+            state.restore(reply['snapshot'])
+            state.owner = owner
+            for event in self._loading.get(doc_id, ()):
+                state.follow(event['epoch'], event['revision'], event['frame'])
+            return state
+        finally:
+            self._loading.pop(doc_id, None)
+
+    async def own(self, doc_id):
+        """Make this worker the holder of a document, claiming it if needed"""
+        async with self.manager.load_lock(doc_id):
+            state = self.manager.get(doc_id)
+            if state is not None and not state.is_replica:
+                return state
+            if state is None:
+                state = await self._load_owned(doc_id)
+                self.manager.add(state)
+                return state
+
+            # Our replica becomes the authoritative copy
+            snapshot = await self.claim(doc_id, state.owner if state.owner in self.ring.nodes else None)
+            state.owner = None
+            await self.channel_layer.group_discard(document_group(doc_id), self.worker)
+            if snapshot is not None:
+                self._install(state, snapshot)
+            else:
+                # Nobody had it; start over from what was last written back
+                loaded = await self.manager.load(doc_id)
+                state.restore(loaded.snapshot())
+                state.last_version = loaded.last_version
+                await self.channel_layer.group_send(document_group(doc_id), {'type': 'document_resync'})
+            return state
+
+    def _install(self, state, snapshot):
+        """Take over a document handed over by its previous owner"""
+        state.restore(snapshot)
+        state.owner = None
+        subscribers = set(snapshot['subscribers']) - {self.worker}
+        state.connections += len(subscribers - state.subscribers)
+        state.subscribers |= subscribers
+        for worker in subscribers:
+            asyncio.ensure_future(self.channel_layer.send(worker, {
+                'type': 'collab.moved', 'doc_id': state.doc_id, 'owner': self.worker}))
+        logger.info(f"Worker {self.worker} took over document {state.doc_id} at revision {state.engine.revision}")
+
+    async def claim(self, doc_id, holder=None):
+        """
+        Ask ``holder``, or every other worker, to hand a document over.
+        Returns the snapshot of whoever held it, or None.
+        """
+        workers = [holder] if holder else [worker for worker in self.ring.nodes if worker != self.worker]
+        if not workers:
+            return None
+        done = self._claims[doc_id] = asyncio.Event()
+        try:
+            replies = await asyncio.gather(*(self.request(worker, {'type': 'collab.claim', 'doc_id': doc_id})
+                                             for worker in workers), return_exceptions=True)
+        finally:
+            # Edits forwarded to us in the meantime wait for the outcome
+            done.set()
+            self._claims.pop(doc_id, None)
+        for reply in replies:
+            if isinstance(reply, dict) and reply.get('snapshot') is not None:
+                return reply['snapshot']
+            if isinstance(reply, Exception):
+                logger.warning(f"No reply to claim for document {doc_id}: {reply!r}")
+        return None
+
+    async def resync(self, state):
+        """Reload a replica whose owner went away or whose broadcasts were lost"""
+        owner = self.owner(state.doc_id)
+        if owner == self.worker:
+            await self.own(state.doc_id)
+            return
+        async with self.manager.load_lock(state.doc_id):
+            try:
+                replica = await self._load_replica(state.doc_id, owner)
+            except Exception as e:
+                logger.error(f"Error resyncing document {state.doc_id}: {str(e)}")
+                return
+            state.restore(replica.snapshot())
+            state.owner = replica.owner
+        # Our clients may hold revisions the new copy does not know about
+        await self.channel_layer.group_send(document_group(state.doc_id), {'type': 'document_resync'})
+
+    async def _unsubscribe(self, state, worker):
+        if worker in state.subscribers:
+            state.subscribers.discard(worker)
+            await self.manager.release(state.doc_id)
+
+    # Messages between workers
+
+    async def request(self, worker, message):
+        request_id = next(self._request_ids)
+        future = self._replies[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self.channel_layer.send(worker, dict(message, request_id=request_id, reply_to=self.worker))
+            return await asyncio.wait_for(future, self.request_timeout)
+        finally:
+            self._replies.pop(request_id, None)
+
+    async def reply(self, message, **result):
+        await self.channel_layer.send(message['reply_to'], dict(
+            result, type='collab.reply', request_id=message['request_id']))
+
+    async def _receive(self):
+        while True:
+            message = await self.channel_layer.receive(self.worker)
+            try:
+                message_type = message.get('type')
+                # Edits and broadcasts are handled in the order they arrive;
+                # the rest may wait on other workers and get a task each
+                if message_type == 'collab.reply':
+                    future = self._replies.get(message['request_id'])
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif message_type == 'collab.edit':
+                    await self.handle_edit(message)
+                elif message_type == 'broadcast_edit_delta':
+                    await self.handle_broadcast(message)
+                elif message_type in self.handlers:
+                    asyncio.ensure_future(self._handle(self.handlers[message_type], message))
+            except Exception as e:
+                logger.error(f"Error in cluster receive: {str(e)}")
+
+    async def _handle(self, handler, message):
+        try:
+            await handler(self, message)
+        except Exception as e:
+            logger.error(f"Error handling {message.get('type')}: {str(e)}")
+
+    async def handle_edit(self, message):
+        doc_id = message['doc_id']
+        claim = self._claims.get(doc_id)
+        if claim is not None:
+            await claim.wait()
+        state = self.manager.get(doc_id)
+        if state is not None and not state.is_replica:
+            if not await self.apply_edit(state, message):
+                await self.channel_layer.send(message['sender_channel_name'], {'type': 'document_resync'})
+        elif state is not None and message['hops'] < MAX_HOPS:
+            await self.channel_layer.send(state.owner, dict(message, hops=message['hops'] + 1))
+        else:
+            await self.channel_layer.send(message['sender_channel_name'], {'type': 'document_resync'})
+
+    async def handle_broadcast(self, event):
+        doc_id = event['doc_id']
+        if doc_id in self._loading:
+            self._loading[doc_id].append(event)
+            return
+        state = self.manager.get(doc_id)
+        if state is None or not state.is_replica:
+            return
+        state.follow(event['epoch'], event['revision'], event['frame'])
+        if event['epoch'] != state.epoch or len(state.pending) > MAX_PENDING:
+            await self.resync(state)
+
+    async def handle_subscribe(self, message):
+        doc_id = message['doc_id']
+        state = self.manager.get(doc_id)
+        if state is None and self.owner(doc_id) == self.worker:
+            state = await self.own(doc_id)
+        if state is None or state.is_replica:
+            # Not ours; point the subscriber at whoever we think has it
+            await self.reply(message, owner=state.owner if state is not None else self.owner(doc_id))
+            return
+        async with state.lock:
+            if message['worker'] not in state.subscribers:
+                state.subscribers.add(message['worker'])
+                state.connections += 1
+            await self.reply(message, snapshot=state.snapshot())
+
+    async def handle_unsubscribe(self, message):
+        state = self.manager.get(message['doc_id'])
+        if state is None:
+            return
+        if state.is_replica:
+            await self.channel_layer.send(state.owner, message)
+        else:
+            await self._unsubscribe(state, message['worker'])
+
+    async def handle_claim(self, message):
+        state = self.manager.get(message['doc_id'])
+        if state is None or state.is_replica:
+            await self.reply(message, snapshot=None)
+            return
+        claimer = message['reply_to']
+        async with state.lock:
+            if state.is_replica:
+                await self.reply(message, snapshot=None)
+                return
+            await self.manager.flush(state)
+            snapshot = state.snapshot(history=True)
+            local = state.connections - len(state.subscribers)
+            subscribers = state.subscribers - {claimer}
+            if local > 0:
+                # Our own editors stay, now on a replica
+                subscribers.add(self.worker)
+                state.owner = claimer
+                state.subscribers = set()
+                state.connections = local
+                await self.channel_layer.group_add(document_group(state.doc_id), self.worker)
+            else:
+                self.manager.unload(state)
+            snapshot['subscribers'] = sorted(subscribers)
+            # Sent before we release the lock, so that it reaches the claimer
+            # ahead of any edit we forward to it
+            await self.reply(message, snapshot=snapshot)
+        logger.info(f"Worker {self.worker} handed document {state.doc_id} over to {claimer}")
+
+    async def handle_take(self, message):
+        if self.owner(message['doc_id']) == self.worker:
+            await self.own(message['doc_id'])
+
+    async def handle_moved(self, message):
+        state = self.manager.get(message['doc_id'])
+        if state is not None and state.is_replica:
+            state.owner = message['owner']
+
+    async def handle_save_version(self, message):
+        state = self.manager.get(message['doc_id'])
+        version_number = None
+        if state is not None and not state.is_replica:
+            version_number = await self.save_version(state, message['user_id'])
+        await self.reply(message, version_number=version_number)
+
+    async def handle_write(self, message):
+        state = self.manager.get(message['doc_id'])
+        if state is None or state.is_replica:
+            await self.reply(message, written=False, version_number=None)
+            return
+        version_number = await self._write(state, message['content'], message['user_id'], message['username'],
+                                           message['version'])
+        await self.reply(message, written=True, version_number=version_number)
+
+    handlers = {
+        'collab.subscribe': handle_subscribe,
+        'collab.unsubscribe': handle_unsubscribe,
+        'collab.claim': handle_claim,
+        'collab.take': handle_take,
+        'collab.moved': handle_moved,
+        'collab.save_version': handle_save_version,
+        'collab.write': handle_write,
+    }
+
+
+_cluster = None
+
+
+def get_cluster():
+    """This process's cluster membership, created from settings on first use"""
+    global _cluster
+    if _cluster is None:
+        config = getattr(settings, 'COLLAB_CLUSTER', {})
+        registry_class = import_string(config.get('BACKEND', DEFAULT_WORKER_REGISTRY))
+        _cluster = Cluster(registry_class(**config.get('OPTIONS', {})))
+        atexit.register(_cluster.stop)
+    return _cluster
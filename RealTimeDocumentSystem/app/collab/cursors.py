@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESENCE_TICK = 0.03
+
+
+class CursorCoalescer:
+    """
+    Collects cursor positions for one document and sends them as one frame.
+
+    Only the latest position of each connection is kept, so moves made
+    between two ticks replace each other instead of queueing. Connections
+    rather than users are the key because a user may have the document open
+    in several tabs. Nothing is sent while no cursor moves.
+    """
+
+    def __init__(self, send_frame, interval=None):
+        self.send_frame = send_frame
+        self.interval = interval if interval is not None else getattr(
+            settings, 'COLLAB_PRESENCE_TICK', DEFAULT_PRESENCE_TICK)
+        self.positions = {}
+        self._flush_task = None
+
+    def update(self, channel_name, user_id, username, cursor_position):
+        self.positions[channel_name] = (user_id, username, cursor_position)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_after_tick())
+
+    def discard(self, channel_name):
+        self.positions.pop(channel_name, None)
+
+    async def _flush_after_tick(self):
+        await asyncio.sleep(self.interval)
+        positions, self.positions = self.positions, {}
+        if not positions:
+            return
+        cursors = [
+            {'user_id': user_id, 'username': username, 'cursor_position': cursor_position}
+            for user_id, username, cursor_position in positions.values()
+        ]
+        try:
+            await self.send_frame(cursors)
+        except Exception as e:
+            logger.error(f"Error sending presence frame: {str(e)}")
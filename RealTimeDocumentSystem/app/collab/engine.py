@@ -0,0 +1,71 @@
+from collections import deque
+from itertools import islice
+
+from .ops import diff_ops, transform
+from .rope import Rope
+
+DEFAULT_HISTORY_SIZE = 1000
+
+
+class StaleRevisionError(Exception):
+    """Raised when ops are based on a revision the engine no longer remembers"""
+
+
+class DocumentEngine:
+    """
+    Authoritative text and revision counter for one document.
+
+    Each applied batch of ops bumps the revision and is kept in a bounded
+    history, so a client's ops based on an older revision can be transformed
+    past everything applied since. The text is kept in a Rope, so the cost
+    is proportional to the ops involved and only logarithmic in the
+    document size.
+    """
+
+    def __init__(self, content='', revision=0, history_size=DEFAULT_HISTORY_SIZE):
+        self.buffer = Rope(content)
+        self.revision = revision
+        self.history = deque(maxlen=history_size)
+
+    @property
+    def content(self):
+        """The text as a str, built on first access after an edit"""
+        return str(self.buffer)
+
+    @property
+    def length(self):
+        return len(self.buffer)
+
+    def snapshot(self):
+        """The current text as a Rope that later edits do not change"""
+        return self.buffer.copy()
+
+    def ops_since(self, revision):
+        """Return the op batches applied after ``revision``, oldest first"""
+        missed = self.revision - revision
+        if missed < 0 or missed > len(self.history):
+            raise StaleRevisionError(
+                f'revision {revision} is not within the last {len(self.history)} of {self.revision}')
+        return list(islice(self.history, len(self.history) - missed, None))
+
+    def apply(self, base_revision, ops):
+        """
+        Apply ops a client based on ``base_revision``.
+
+        Returns ``(revision, ops)`` with the ops as they were actually applied
+        to the current text, ready to broadcast.
+        """
+        for applied in self.ops_since(base_revision):
+            ops, _ = transform(ops, applied)
+
+        self.buffer.apply(ops)
+        self.revision += 1
+        self.history.append(ops)
+        return self.revision, ops
+
+    def replace(self, content):
+        """Apply a full-content edit as ops against the current revision"""
+        ops = diff_ops(self.content, content)
+        if not ops:
+            return self.revision, ops
+        return self.apply(self.revision, ops)
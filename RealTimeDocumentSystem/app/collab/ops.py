@@ -0,0 +1,157 @@
+"""
+Insert/delete operations on document text.
+
+An op is a dict, either ``{'op': 'insert', 'pos': int, 'text': str}`` or
+``{'op': 'delete', 'pos': int, 'length': int}``. Ops in a list are applied in
+order, each position relative to the result of the previous op. Positions
+count code points, so they index Python strings directly.
+"""
+
+MAX_OPS_PER_MESSAGE = 200
+
+
+class InvalidOperation(ValueError):
+    """Raised when ops are malformed or do not fit the document"""
+
+
+def insert(pos, text):
+    return {'op': 'insert', 'pos': pos, 'text': text}
+
+
+def delete(pos, length):
+    return {'op': 'delete', 'pos': pos, 'length': length}
+
+
+def _is_index(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def parse_ops(raw_ops):
+    """Validate ops received from a client and return them normalized"""
+    if not isinstance(raw_ops, list):
+        raise InvalidOperation('ops must be a list')
+    if len(raw_ops) > MAX_OPS_PER_MESSAGE:
+        raise InvalidOperation(f'at most {MAX_OPS_PER_MESSAGE} ops per message')
+
+    ops = []
+    for raw_op in raw_ops:
+        if not isinstance(raw_op, dict):
+            raise InvalidOperation('each op must be an object')
+        pos = raw_op.get('pos')
+        if not _is_index(pos):
+            raise InvalidOperation('op position must be a non-negative integer')
+
+        if raw_op.get('op') == 'insert':
+            text = raw_op.get('text')
+            if not isinstance(text, str):
+                raise InvalidOperation('insert op requires text')
+            if text:
+                ops.append(insert(pos, text))
+        elif raw_op.get('op') == 'delete':
+            length = raw_op.get('length')
+            if not _is_index(length):
+                raise InvalidOperation('delete op requires a non-negative length')
+            if length:
+                ops.append(delete(pos, length))
+        else:
+            raise InvalidOperation(f"unknown op {raw_op.get('op')!r}")
+    return ops
+
+
+def apply_ops(content, ops):
+    """Apply ops to a string and return the new string"""
+    for op in ops:
+        pos = op['pos']
+        if op['op'] == 'insert':
+            if pos > len(content):
+                raise InvalidOperation('insert position out of range')
+            content = content[:pos] + op['text'] + content[pos:]
+        else:
+            if pos + op['length'] > len(content):
+                raise InvalidOperation('delete range out of range')
+            content = content[:pos] + content[pos + op['length']:]
+    return content
+
+
+def diff_ops(old, new):
+    """Describe the change from old to new as at most one delete and one insert"""
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    ops = []
+    if old_end > start:
+        ops.append(delete(start, old_end - start))
+    if new_end > start:
+        ops.append(insert(start, new[start:new_end]))
+    return ops
+
+
+def _transform_op(op, other, other_first):
+    """
+    Rewrite a single op so it applies after ``other`` has been applied.
+
+    ``other_first`` breaks ties between inserts at the same position. Returns a
+    list because a delete spanning an insert is split in two.
+    """
+    pos = op['pos']
+
+    if other['op'] == 'insert':
+        other_len = len(other['text'])
+        if op['op'] == 'insert':
+            if other['pos'] < pos or (other['pos'] == pos and other_first):
+                return [insert(pos + other_len, op['text'])]
+            return [op]
+        if other['pos'] <= pos:
+            return [delete(pos + other_len, op['length'])]
+        if other['pos'] >= pos + op['length']:
+            return [op]
+        # The insert landed inside the deleted range and survives the delete
+        before = other['pos'] - pos
+        return [delete(pos, before), delete(pos + other_len, op['length'] - before)]
+
+    other_end = other['pos'] + other['length']
+    if op['op'] == 'insert':
+        if pos <= other['pos']:
+            return [op]
+        if pos >= other_end:
+            return [insert(pos - other['length'], op['text'])]
+        return [insert(other['pos'], op['text'])]
+
+    end = pos + op['length']
+    if end <= other['pos']:
+        return [op]
+    if pos >= other_end:
+        return [delete(pos - other['length'], op['length'])]
+    overlap = min(end, other_end) - max(pos, other['pos'])
+    if overlap == op['length']:
+        return []
+    return [delete(min(pos, other['pos']), op['length'] - overlap)]
+
+
+def transform(ops, others):
+    """
+    Transform two concurrent op lists based on the same document.
+
+    Returns ``(ops', others')`` such that applying ``others`` then ``ops'``
+    gives the same text as applying ``ops`` then ``others'``. ``others`` is
+    taken to have been applied first, so its inserts win position ties.
+    """
+    if not ops or not others:
+        return list(ops), list(others)
+    if len(ops) == 1 and len(others) == 1:
+        return (_transform_op(ops[0], others[0], True),
+                _transform_op(others[0], ops[0], False))
+    if len(ops) > 1:
+        head, others = transform(ops[:1], others)
+        tail, others = transform(ops[1:], others)
+        return head + tail, others
+    ops, head = transform(ops, others[:1])
+    ops, tail = transform(ops, others[1:])
+    return ops, head + tail
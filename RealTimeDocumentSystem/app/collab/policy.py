@@ -0,0 +1,88 @@
+"""
+Policies deciding when the live state of a document becomes a new version.
+
+A policy looks only at the in-memory VersionTracker of a document, so it is
+consulted on every flush without touching the database. The policy in use
+is configured with the COLLAB_VERSION_POLICY setting::
+
+    COLLAB_VERSION_POLICY = {
+        'BACKEND': 'app.collab.policy.CoalescingVersionPolicy',
+        'OPTIONS': {'idle_seconds': 30, 'min_changes': 20},
+    }
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_VERSION_POLICY = 'app.collab.policy.CoalescingVersionPolicy'
+
+
+def count_changes(ops):
+    """Characters inserted plus characters deleted by a list of ops"""
+    return sum(len(op['text']) if op['op'] == 'insert' else op['length'] for op in ops)
+
+
+class VersionTracker:
+    """What has happened to a document since its last version"""
+
+    def __init__(self, last_version_at=None):
+        self.last_version_at = last_version_at
+        self.last_edit_at = None
+        self.ops = 0
+        self.changes = 0
+
+    @property
+    def has_changes(self):
+        return self.ops > 0
+
+    def record(self, ops, now):
+        self.ops += 1
+        self.changes += count_changes(ops)
+        self.last_edit_at = now
+
+    def reset(self, now):
+        self.last_version_at = now
+        self.ops = 0
+        self.changes = 0
+
+
+class VersionPolicy:
+    """Base class; ``final`` is set when the last editor leaves the document"""
+
+    def should_create_version(self, tracker, now, final=False):
+        raise NotImplementedError
+
+
+class CoalescingVersionPolicy(VersionPolicy):
+    """
+    Cut one version per burst of editing instead of one per edit.
+
+    A version is created once a meaningful amount of text (``min_changes``
+    characters inserted or deleted) has been followed by ``idle_seconds`` of
+    quiet, after ``max_ops`` edits or ``max_interval`` seconds of continuous
+    editing, for the first edit of a document without versions, and when the
+    last editor leaves.
+    """
+
+    def __init__(self, idle_seconds=30, min_changes=20, max_ops=500, max_interval=300):
+        self.idle_seconds = idle_seconds
+        self.min_changes = min_changes
+        self.max_ops = max_ops
+        self.max_interval = max_interval
+
+    def should_create_version(self, tracker, now, final=False):
+        if not tracker.has_changes:
+            return False
+        if final or tracker.last_version_at is None:
+            return True
+        if tracker.ops >= self.max_ops:
+            return True
+        if now - tracker.last_version_at >= self.max_interval:
+            return True
+        return (tracker.changes >= self.min_changes
+                and now - tracker.last_edit_at >= self.idle_seconds)
+
+
+def get_version_policy():
+    config = getattr(settings, 'COLLAB_VERSION_POLICY', {})
+    policy_class = import_string(config.get('BACKEND', DEFAULT_VERSION_POLICY))
+    return policy_class(**config.get('OPTIONS', {}))
@@ -0,0 +1,196 @@
+"""
+Rope: document text as a balanced tree of string chunks.
+
+Inserting into or deleting from a Python string copies the whole string,
+which for multi-megabyte documents dominates the cost of applying an edit.
+A Rope keeps the text in leaves of at most MAX_LEAF code points under an
+AVL-balanced tree, so an edit rebuilds one leaf and the O(log n) nodes
+above it. Nodes are never modified once built: an edited rope shares every
+untouched subtree with the previous one, which makes copy() an O(1)
+snapshot. Text is turned into a str only when it is needed as a whole, at
+persistence and network boundaries, and that str is cached until the next
+edit.
+"""
+from .ops import InvalidOperation
+
+MAX_LEAF = 1024
+# Leaves are built half full so typing does not split them right away
+BUILD_LEAF = MAX_LEAF // 2
+
+
+class Leaf:
+    __slots__ = ('text', 'length')
+    height = 0
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+
+class Node:
+    __slots__ = ('left', 'right', 'length', 'height')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+        self.height = max(left.height, right.height) + 1
+
+
+def _build(text):
+    """A balanced tree for text, or None if it is empty"""
+    if not text:
+        return None
+    leaves = [Leaf(text[start:start + BUILD_LEAF]) for start in range(0, len(text), BUILD_LEAF)]
+
+    def build(lo, hi):
+        if hi - lo == 1:
+            return leaves[lo]
+        mid = (lo + hi) // 2
+        return Node(build(lo, mid), build(mid, hi))
+
+    return build(0, len(leaves))
+
+
+def _balance(left, right):
+    """A node for two AVL trees whose heights differ by at most two"""
+    if left.height > right.height + 1:
+        if left.left.height >= left.right.height:
+            return Node(left.left, Node(left.right, right))
+        inner = left.right
+        return Node(Node(left.left, inner.left), Node(inner.right, right))
+    if right.height > left.height + 1:
+        if right.right.height >= right.left.height:
+            return Node(Node(left, right.left), right.right)
+        inner = right.left
+        return Node(Node(left, inner.left), Node(inner.right, right.right))
+    return Node(left, right)
+
+
+def _join(left, right):
+    """Concatenate two trees of any heights in O(height difference)"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.height > right.height + 1:
+        return _balance(left.left, _join(left.right, right))
+    if right.height > left.height + 1:
+        return _balance(_join(left, right.left), right.right)
+    if left.height == 0 and right.height == 0 and left.length + right.length <= MAX_LEAF:
+        return Leaf(left.text + right.text)
+    return Node(left, right)
+
+
+def _split(node, pos):
+    """Two trees holding the text before and after pos"""
+    if pos <= 0:
+        return None, node
+    if pos >= node.length:
+        return node, None
+    if node.height == 0:
+        return Leaf(node.text[:pos]), Leaf(node.text[pos:])
+    if pos <= node.left.length:
+        left, right = _split(node.left, pos)
+        return left, _join(right, node.right)
+    left, right = _split(node.right, pos - node.left.length)
+    return _join(node.left, left), right
+
+
+def _insert(node, pos, text):
+    if node is None:
+        return _build(text)
+    if len(text) > MAX_LEAF:
+        left, right = _split(node, pos)
+        return _join(_join(left, _build(text)), right)
+    if node.height == 0:
+        text = node.text[:pos] + text + node.text[pos:]
+        return Leaf(text) if len(text) <= MAX_LEAF else _build(text)
+    if pos <= node.left.length:
+        return _join(_insert(node.left, pos, text), node.right)
+    return _join(node.left, _insert(node.right, pos - node.left.length, text))
+
+
+def _delete(node, start, end):
+    if start <= 0 and end >= node.length:
+        return None
+    if node.height == 0:
+        return Leaf(node.text[:start] + node.text[end:])
+    left, right = node.left, node.right
+    if start < left.length:
+        left = _delete(left, start, min(end, left.length))
+    if end > node.left.length:
+        right = _delete(right, max(start - node.left.length, 0), end - node.left.length)
+    return _join(left, right)
+
+
+class Rope:
+    """Mutable document text with O(log n) inserts and deletes by code point offset"""
+
+    __slots__ = ('root', '_text')
+
+    def __init__(self, text=''):
+        self.root = _build(text)
+        self._text = text
+
+    def __len__(self):
+        return self.root.length if self.root is not None else 0
+
+    def __str__(self):
+        if self._text is None:
+            chunks = []
+            stack = [self.root] if self.root is not None else []
+            while stack:
+                node = stack.pop()
+                if node.height == 0:
+                    chunks.append(node.text)
+                else:
+                    stack.append(node.right)
+                    stack.append(node.left)
+            self._text = ''.join(chunks)
+        return self._text
+
+    def __repr__(self):
+        return f'<Rope length={len(self)}>'
+
+    def copy(self):
+        """A snapshot that later edits to either rope do not affect"""
+        snapshot = Rope.__new__(Rope)
+        snapshot.root = self.root
+        snapshot._text = self._text
+        return snapshot
+
+    def _set_root(self, root):
+        self.root = root
+        self._text = None
+
+    def insert(self, pos, text):
+        if not 0 <= pos <= len(self):
+            raise IndexError('insert position out of range')
+        if text:
+            self._set_root(_insert(self.root, pos, text))
+
+    def delete(self, pos, length):
+        if pos < 0 or length < 0 or pos + length > len(self):
+            raise IndexError('delete range out of range')
+        if length:
+            self._set_root(_delete(self.root, pos, pos + length))
+
+    def apply(self, ops):
+        """Apply ops like ops.apply_ops; the rope is unchanged if one does not fit"""
+        root = self.root
+        for op in ops:
+            pos = op['pos']
+            length = root.length if root is not None else 0
+            if op['op'] == 'insert':
+                if pos > length:
+                    raise InvalidOperation('insert position out of range')
+                if op['text']:
+                    root = _insert(root, pos, op['text'])
+            else:
+                if pos + op['length'] > length:
+                    raise InvalidOperation('delete range out of range')
+                if op['length']:
+                    root = _delete(root, pos, pos + op['length'])
+        if root is not self.root:
+            self._set_root(root)
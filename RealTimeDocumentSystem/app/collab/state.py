@@ -0,0 +1,290 @@
+"""
+In-process authoritative state for documents with open connections.
+
+Edits are applied to a DocumentEngine in memory and written back to the
+database by a background task, so the number of queries no longer depends
+on how fast people type. A document is flushed when it has been dirty for
+COLLAB_FLUSH_INTERVAL seconds, after COLLAB_FLUSH_OPS unflushed edits, when
+its last connection closes and when the process exits. Whether a flush also
+creates a version is up to the configured version policy (see policy.py).
+"""
+import asyncio
+import atexit
+import logging
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .. import codec
+from ..models import Document, DocumentVersion
+from ..versions import create_version
+from .engine import DEFAULT_HISTORY_SIZE, DocumentEngine
+from .policy import VersionTracker, get_version_policy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_FLUSH_OPS = 50
+
+
+class DocumentState:
+    """A document's live engine plus the bookkeeping for writing it back"""
+
+    def __init__(self, doc_id, content, last_version=None):
+        self.doc_id = doc_id
+        self.engine = DocumentEngine(content, history_size=getattr(
+            settings, 'COLLAB_HISTORY_SIZE', DEFAULT_HISTORY_SIZE))
+        # Revisions restart from 0 whenever a document is loaded; clients
+        # resuming a connection name the load their revision belongs to
+        self.epoch = uuid.uuid4().hex[:12]
+        self.lock = asyncio.Lock()
+        self.flush_lock = asyncio.Lock()
+        self.connections = 0
+        self.flushed_revision = self.engine.revision
+        self.dirty_since = None
+        self.last_editor_id = None
+        # The latest stored version is the parent of the next one
+        self.last_version = last_version
+        self.last_version_content = None
+        self.versions = VersionTracker(last_version.created_at.timestamp() if last_version else None)
+        # Created by the first connection that moves a cursor
+        self.cursors = None
+        # (revision, encoded full-content edit) shared by old-protocol clients
+        self.legacy_edit_frame = None
+        # With several workers (see cluster.py): the worker that owns the
+        # document when this is a replica, and the workers holding replicas
+        # of it when this worker owns it
+        self.owner = None
+        self.subscribers = set()
+        # Replicas: broadcast edits received ahead of a missing revision
+        self.pending = {}
+
+    @property
+    def dirty(self):
+        return self.engine.revision != self.flushed_revision
+
+    @property
+    def unflushed_ops(self):
+        return self.engine.revision - self.flushed_revision
+
+    @property
+    def is_replica(self):
+        return self.owner is not None
+
+    def snapshot(self, history=False):
+        snapshot = {'content': self.engine.content, 'revision': self.engine.revision, 'epoch': self.epoch}
+        if history:
+            snapshot['history'] = list(self.engine.history)
+        return snapshot
+
+    def restore(self, snapshot):
+        """Replace the live content with a snapshot taken by another worker"""
+        self.engine = DocumentEngine(snapshot['content'], snapshot['revision'], self.engine.history.maxlen)
+        self.engine.history.extend(snapshot.get('history', ()))
+        self.epoch = snapshot['epoch']
+        self.flushed_revision = self.engine.revision
+        self.dirty_since = None
+        self.legacy_edit_frame = None
+        self.pending = {}
+
+    def follow(self, epoch, revision, frame):
+        """Apply an edit broadcast by the owner to a replica, in revision order"""
+        if self.owner is None or epoch != self.epoch or revision <= self.engine.revision:
+            return
+        self.pending[revision] = frame
+        while self.engine.revision + 1 in self.pending:
+            ops = codec.loads(self.pending.pop(self.engine.revision + 1))['ops']
+            self.engine.apply(self.engine.revision, ops)
+        # Only the owner writes the document back
+        self.flushed_revision = self.engine.revision
+
+
+def persist_document(state, content, save_content, version_editor_id=None):
+    """
+    Write document content back and optionally store it as a new version.
+    ``content`` may be a Rope snapshot, turned into a str here, off the
+    event loop.
+    """
+    content = str(content)
+    if save_content:
+        Document.objects.filter(id=state.doc_id).update(content=content, updated_at=timezone.now())
+    if version_editor_id is None:
+        return None
+
+    version = create_version(state.doc_id, content, version_editor_id,
+                             parent=state.last_version, parent_content=state.last_version_content)
+    state.last_version = version
+    state.last_version_content = content
+    logger.info(f"Created version {version.version_number} for document {state.doc_id}")
+    return version
+
+
+class DocumentStateManager:
+    """Registry of DocumentState objects with a write-behind flush loop"""
+
+    def __init__(self, flush_interval=None, flush_ops=None, version_policy=None):
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.version_policy = version_policy
+        self.states = {}
+        self._load_locks = {}
+        self._flusher = None
+        self._pending_flushes = set()
+
+    def get_flush_interval(self):
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'COLLAB_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+
+    def get_flush_ops(self):
+        if self.flush_ops is not None:
+            return self.flush_ops
+        return getattr(settings, 'COLLAB_FLUSH_OPS', DEFAULT_FLUSH_OPS)
+
+    def get_version_policy(self):
+        if self.version_policy is None:
+            self.version_policy = get_version_policy()
+        return self.version_policy
+
+    def get(self, doc_id):
+        return self.states.get(doc_id)
+
+    def load_lock(self, doc_id):
+        return self._load_locks.setdefault(doc_id, asyncio.Lock())
+
+    async def acquire(self, doc_id, load=None):
+        """
+        Return the live state for a document, loading it on first use.
+        ``load`` is awaited with the document id to create the state instead
+        of reading it from the database.
+        """
+        async with self.load_lock(doc_id):
+            state = self.states.get(doc_id)
+            if state is None:
+                state = self.states[doc_id] = await (load or self.load)(doc_id)
+            state.connections += 1
+        self._ensure_flusher()
+        return state
+
+    async def load(self, doc_id):
+        content, last_version = await database_sync_to_async(self._load)(doc_id)
+        return DocumentState(doc_id, content, last_version)
+
+    def add(self, state):
+        """Register a state created outside acquire(), without a connection"""
+        self.states[state.doc_id] = state
+        self._ensure_flusher()
+
+    def unload(self, state):
+        if self.states.get(state.doc_id) is state:
+            del self.states[state.doc_id]
+            self._load_locks.pop(state.doc_id, None)
+
+    async def release(self, doc_id):
+        """Drop a connection, flushing and unloading the document after the last one"""
+        state = self.states.get(doc_id)
+        if state is None:
+            return
+        state.connections -= 1
+        if state.connections > 0:
+            return
+
+        await self.flush(state, final=True)
+        # Someone may have reconnected while we were writing
+        if state.connections <= 0:
+            self.unload(state)
+
+    def mark_dirty(self, state, user_id, ops):
+        """Record an applied edit and flush early once enough have piled up"""
+        state.last_editor_id = user_id
+        state.versions.record(ops, time.time())
+        if state.dirty_since is None:
+            state.dirty_since = time.monotonic()
+        if state.unflushed_ops >= self.get_flush_ops():
+            task = asyncio.ensure_future(self.flush(state))
+            self._pending_flushes.add(task)
+            task.add_done_callback(self._pending_flushes.discard)
+
+    async def flush(self, state, final=False, force_version_by=None):
+        """
+        Write a document back if it is dirty, cutting a version if the policy
+        says so. ``force_version_by`` is a user id to store a version for
+        regardless of the policy, as for manual saves.
+        """
+        if state.is_replica:
+            return None
+        async with state.flush_lock:
+            now = time.time()
+            version_editor_id = force_version_by
+            if version_editor_id is None and state.last_editor_id is not None:
+                if self.get_version_policy().should_create_version(state.versions, now, final):
+                    version_editor_id = state.last_editor_id
+            if not state.dirty and version_editor_id is None:
+                return None
+
+            revision = state.engine.revision
+            content = state.engine.snapshot()
+            save_content = state.dirty
+            state.dirty_since = None
+            if version_editor_id is not None:
+                state.versions.reset(now)
+            try:
+                version = await database_sync_to_async(persist_document)(
+                    state, content, save_content, version_editor_id)
+            except Exception as e:
+                logger.error(f"Error flushing document {state.doc_id}: {str(e)}")
+                if state.dirty_since is None:
+                    state.dirty_since = time.monotonic()
+                return None
+            state.flushed_revision = revision
+            if state.dirty and state.dirty_since is None:
+                state.dirty_since = time.monotonic()
+            logger.debug(f"Flushed document {state.doc_id} at revision {revision}")
+            return version
+
+    async def flush_all(self):
+        for state in list(self.states.values()):
+            await self.flush(state)
+
+    def flush_all_sync(self):
+        """Flush from synchronous code, used when the process exits"""
+        policy = self.get_version_policy()
+        for state in list(self.states.values()):
+            if not state.dirty or state.is_replica:
+                continue
+            version_editor_id = None
+            if state.last_editor_id is not None and policy.should_create_version(state.versions, time.time(), True):
+                version_editor_id = state.last_editor_id
+            try:
+                persist_document(state, state.engine.content, True, version_editor_id)
+                state.flushed_revision = state.engine.revision
+            except Exception as e:
+                logger.error(f"Error flushing document {state.doc_id} at shutdown: {str(e)}")
+
+    def _load(self, doc_id):
+        content = Document.objects.filter(id=doc_id).values_list('content', flat=True).first() or ''
+        return content, DocumentVersion.objects.filter(document_id=doc_id).first()
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        while self.states:
+            interval = self.get_flush_interval()
+            await asyncio.sleep(interval)
+            policy = self.get_version_policy()
+            now = time.monotonic()
+            for state in list(self.states.values()):
+                if state.dirty_since is not None and now - state.dirty_since >= interval:
+                    await self.flush(state)
+                elif policy.should_create_version(state.versions, time.time()):
+                    await self.flush(state)
+
+
+document_states = DocumentStateManager()
+atexit.register(document_states.flush_all_sync)
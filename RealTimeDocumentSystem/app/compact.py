@@ -0,0 +1,265 @@
+"""
+Binary WebSocket subprotocol.
+
+Clients opt in by offering one of available_subprotocols() in the
+Sec-WebSocket-Protocol header; clients that offer none keep the JSON text
+protocol. Messages to the client are arrays of a type code followed by
+the message's fields in a fixed order, serialized with MessagePack
+(``collab.msgpack``, needs the msgpack package) or as JSON
+(``collab.compact``), and sent as binary frames. The ``+zlib`` variants
+deflate frames of at least COLLAB_BINARY_COMPRESS_MIN bytes. Compressed
+frames from clients may inflate to at most COLLAB_BINARY_MAX_FRAME bytes.
+
+Every frame starts with a flags byte, 1 if the rest is zlib-compressed.
+Several messages sent together form one array starting with BATCH::
+
+    [0, [3, 42, [[120, 'the']], 123, 2], [5, [[2, 150], [3, 12]]]]
+
+Users are referred to by id only. Before the first message that mentions
+a user, a connection receives a ``user`` message with their name.
+Clients may send edits, cursor moves, suggestion requests and version
+saves as binary frames in the same format; text JSON frames keep working
+on every protocol.
+"""
+import zlib
+
+from django.conf import settings
+
+from . import codec
+from .diff import LRUCache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_COMPRESS_MIN = 1024
+DEFAULT_MAX_FRAME = 4 * 1024 * 1024
+TRANSCODE_CACHE_SIZE = 256
+
+FLAG_ZLIB = 1
+BATCH = 0
+# Message types without a code are sent as [OTHER, message]
+OTHER = 99
+
+# Server to client: message type -> (code, fields)
+SERVER_MESSAGES = {
+    'sync': (1, ('revision', 'content', 'epoch')),
+    'edit_ack': (2, ('revision',)),
+    'edit_delta': (3, ('revision', 'ops', 'cursor_position', 'user_id')),
+    'resume': (4, ('revision', 'ops', 'epoch')),
+    'presence': (5, ('cursors',)),
+    'user_joined': (6, ('user_id',)),
+    'user_left': (7, ('user_id',)),
+    'version_saved': (8, ('version_number', 'timestamp', 'user_id')),
+    'ai_suggestion': (9, ('request_id', 'suggestion', 'issues', 'original_text')),
+    'error': (10, ('error',)),
+    'user': (11, ('user_id', 'username')),
+}
+
+# Client to server: code -> (message type, fields)
+CLIENT_MESSAGES = {
+    3: ('edit_delta', ('base_revision', 'ops', 'cursor_position')),
+    12: ('cursor_move', ('cursor_position',)),
+    13: ('ai_suggestion_request', ('request_id', 'text')),
+    14: ('save_version', ()),
+}
+
+
+class DecodeError(ValueError):
+    """Raised for binary frames that are not valid messages"""
+
+
+def pack_ops(ops):
+    # [pos, text] inserts, [pos, length] deletes
+    return [[op['pos'], op['text']] if op['op'] == 'insert' else [op['pos'], op['length']] for op in ops]
+
+
+def unpack_ops(ops):
+    if not isinstance(ops, list):
+        return ops
+    unpacked = []
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 2:
+            # Left for parse_ops to reject
+            unpacked.append(op)
+        elif isinstance(op[1], str):
+            unpacked.append({'op': 'insert', 'pos': op[0], 'text': op[1]})
+        else:
+            unpacked.append({'op': 'delete', 'pos': op[0], 'length': op[1]})
+    return unpacked
+
+
+FIELD_PACKERS = {
+    'ops': pack_ops,
+    'cursors': lambda cursors: [[cursor['user_id'], cursor['cursor_position']] for cursor in cursors],
+    'issues': lambda issues: [
+        [issue['start'], issue['end'], issue['message'], issue['replacement']] for issue in issues],
+}
+
+
+def to_array(message):
+    """A message dict as [code, field, ...]"""
+    spec = SERVER_MESSAGES.get(message.get('type', 'error'))
+    if spec is None:
+        return [OTHER, message]
+    code, fields = spec
+    return [code] + [
+        FIELD_PACKERS[field](message.get(field) or []) if field in FIELD_PACKERS else message.get(field)
+        for field in fields
+    ]
+
+
+def from_array(array):
+    """A message from the client as the dict the JSON protocol would have produced"""
+    if not isinstance(array, list) or not array or array[0] not in CLIENT_MESSAGES:
+        raise DecodeError('unknown message')
+    message_type, fields = CLIENT_MESSAGES[array[0]]
+    message = dict(zip(fields, array[1:]), type=message_type)
+    if 'ops' in message:
+        message['ops'] = unpack_ops(message['ops'])
+    return message
+
+
+def mentioned_users(message):
+    """(user id, username) pairs a message refers to"""
+    if message.get('cursors'):
+        return [(cursor['user_id'], cursor['username']) for cursor in message['cursors']]
+    if message.get('user_id') is not None and message.get('username') is not None:
+        return [(message['user_id'], message['username'])]
+    return []
+
+
+class Serializer:
+    """Turns message arrays into bytes, with a cache for broadcast frames"""
+
+    def __init__(self):
+        # JSON frame of a broadcast -> (encoded message, users it mentions);
+        # every connection of this process receives the same broadcasts
+        self.transcoded = LRUCache(TRANSCODE_CACHE_SIZE)
+
+    def dumps(self, array):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def join_batch(self, encoded):
+        """Wrap encoded messages in a batch without re-encoding them"""
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    def dumps(self, array):
+        return codec.dumps(array).encode()
+
+    def loads(self, data):
+        return codec.loads(data)
+
+    def join_batch(self, encoded):
+        return b'[0,' + b','.join(encoded) + b']'
+
+
+class MessagePackSerializer(Serializer):
+    def dumps(self, array):
+        return msgpack.packb(array, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def join_batch(self, encoded):
+        count = len(encoded) + 1
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b'\xdc' + count.to_bytes(2, 'big')
+        else:
+            header = b'\xdd' + count.to_bytes(4, 'big')
+        return header + b'\x00' + b''.join(encoded)
+
+
+class BinaryProtocol:
+    """One negotiated subprotocol: a serializer, optionally with compression"""
+
+    def __init__(self, serializer, compress=False, compress_min=None, max_frame=None):
+        self.serializer = serializer
+        self.compress = compress
+        self.compress_min = compress_min if compress_min is not None else getattr(
+            settings, 'COLLAB_BINARY_COMPRESS_MIN', DEFAULT_COMPRESS_MIN)
+        self.max_frame = max_frame if max_frame is not None else getattr(
+            settings, 'COLLAB_BINARY_MAX_FRAME', DEFAULT_MAX_FRAME)
+
+    def dumps(self, message):
+        return self.serializer.dumps(to_array(message))
+
+    def transcode(self, frame):
+        """
+        Re-encode a broadcast JSON frame. Returns the encoded message and the
+        users it mentions, which the connection may not know yet.
+        """
+        cached = self.serializer.transcoded.get(frame)
+        if cached is None:
+            message = codec.loads(frame)
+            cached = (self.dumps(message), mentioned_users(message))
+            self.serializer.transcoded.set(frame, cached)
+        return cached
+
+    def frame(self, encoded):
+        """The binary frame for one or more encoded messages"""
+        payload = encoded[0] if len(encoded) == 1 else self.serializer.join_batch(encoded)
+        if self.compress and len(payload) >= self.compress_min:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                return bytes([FLAG_ZLIB]) + compressed
+        return b'\x00' + payload
+
+    def loads(self, data):
+        """Decode a binary frame from the client"""
+        if not data:
+            raise DecodeError('empty frame')
+        try:
+            payload = self.inflate(data[1:]) if data[0] & FLAG_ZLIB else data[1:]
+            array = self.serializer.loads(payload)
+        except DecodeError:
+            raise
+        except Exception as e:
+            raise DecodeError(str(e))
+        return from_array(array)
+
+    def inflate(self, data):
+        # Client frames are untrusted; stop before a small frame inflates into a huge one
+        decompressor = zlib.decompressobj()
+        payload = decompressor.decompress(data, self.max_frame)
+        if decompressor.unconsumed_tail or decompressor.unused_data:
+            raise DecodeError(f'frame inflates to more than {self.max_frame} bytes')
+        return payload
+
+
+_serializers = {}
+
+
+def get_serializer(name):
+    if name not in _serializers:
+        _serializers[name] = MessagePackSerializer() if name == 'msgpack' else JSONSerializer()
+    return _serializers[name]
+
+
+def available_subprotocols():
+    names = ['collab.compact+zlib', 'collab.compact']
+    if msgpack is not None:
+        names = ['collab.msgpack+zlib', 'collab.msgpack'] + names
+    return names
+
+
+def negotiate(offered):
+    """
+    The first subprotocol offered by the client that the server supports,
+    and the protocol to speak on it; (None, None) keeps the JSON protocol.
+    """
+    supported = available_subprotocols()
+    for name in offered:
+        if name in supported:
+            base, _, option = name.partition('+')
+            serializer = get_serializer('msgpack' if base == 'collab.msgpack' else 'json')
+            return name, BinaryProtocol(serializer, compress=option == 'zlib')
+    return None, None
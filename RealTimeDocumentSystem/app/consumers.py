@@ -1,21 +1,42 @@
-import json
 import asyncio
+import functools
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import Document, DocumentSession, DocumentVersion
+from .access import can_access_document
+from .models import DocumentVersion
+from .collab import InvalidOperation, StaleRevisionError, diff_ops, parse_ops
+from .collab.cluster import get_cluster
+from .collab.cursors import CursorCoalescer
+from .outbound import EDIT, OTHER, REPLY, OutboundQueue
+from .presence import get_presence_registry
+from .suggestions import get_suggestion_pool
+from . import codec, compact
 
 import re
+from urllib.parse import parse_qs
 
 logger = logging.getLogger(__name__)
 
+# Clients that connect with ?protocol=delta send and receive insert/delete ops
+# instead of the full document content on every edit
+DELTA_PROTOCOL = 'delta'
+
 class DocumentConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.doc_id = self.scope['url_route']['kwargs']['doc_id']
             self.user = self.scope['user']
             self.room_group_name = f'document_{self.doc_id}'
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            self.protocol = query.get('protocol', [''])[0]
+            # Clients offering a binary subprotocol always speak the delta protocol
+            self.subprotocol, self.binary = compact.negotiate(self.scope.get('subprotocols', []))
+            if self.binary is not None:
+                self.protocol = DELTA_PROTOCOL
+                # Users whose names this client has been sent
+                self.known_users = set()
             
             logger.info(f"User {self.user.username} attempting to connect to document {self.doc_id}")
             
@@ -24,22 +45,36 @@ class DocumentConsumer(AsyncWebsocketConsumer):
                 logger.warning(f"User {self.user.username} denied access to document {self.doc_id}")
                 await self.close()
                 return
+            
+            # Live document state shared by every connection in this process;
+            # a replica if another worker owns the document
+            self.state = await get_cluster().acquire(self.doc_id)
+            self.outbound = OutboundQueue(self.send_frame, self.snapshot_message)
                 
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
+            await self.accept(subprotocol=self.subprotocol)
             
             logger.info(f"User {self.user.username} successfully connected to document {self.doc_id}")
             
             # Add user to active sessions
             await self.add_user_session()
+            self.heartbeat_task = asyncio.ensure_future(self.send_heartbeats())
+
+            # Delta clients need the revision their ops will be based on;
+            # reconnecting ones only need what they missed
+            if self.protocol == DELTA_PROTOCOL:
+                self.send_catch_up(query.get('epoch', [''])[0], query.get('revision', [''])[0])
             
             # Notify others that user joined
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'user_joined',
-                    'username': self.user.username,
-                    'user_id': self.user.id
+                    'frame': codec.dumps({
+                        'type': 'user_joined',
+                        'username': self.user.username,
+                        'user_id': self.user.id
+                    })
                 }
             )
             
@@ -51,8 +86,17 @@ class DocumentConsumer(AsyncWebsocketConsumer):
         try:
             if hasattr(self, 'room_group_name'):
                 await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+                if hasattr(self, 'heartbeat_task'):
+                    self.heartbeat_task.cancel()
+                get_suggestion_pool().discard(self.channel_name)
                 await self.remove_user_session()
                 
+                if hasattr(self, 'state'):
+                    self.outbound.close()
+                    if self.state.cursors is not None:
+                        self.state.cursors.discard(self.channel_name)
+                    await get_cluster().release(self.doc_id)
+                
                 logger.info(f"User {self.user.username} disconnected from document {self.doc_id}")
                 
                 # Notify others that user left
@@ -60,22 +104,32 @@ class DocumentConsumer(AsyncWebsocketConsumer):
                     self.room_group_name,
                     {
                         'type': 'user_left',
-                        'username': self.user.username,
-                        'user_id': self.user.id
+                        'frame': codec.dumps({
+                            'type': 'user_left',
+                            'username': self.user.username,
+                            'user_id': self.user.id
+                        })
                     }
                 )
         except Exception as e:
             logger.error(f"Error in disconnect: {str(e)}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            if bytes_data is not None:
+                if self.binary is None:
+                    raise compact.DecodeError('binary subprotocol not negotiated')
+                data = self.binary.loads(bytes_data)
+            else:
+                data = codec.loads(text_data)
             message_type = data.get('type', 'edit')
             
             logger.debug(f"Received message type '{message_type}' from user {self.user.username}")
             
             if message_type == 'edit':
                 await self.handle_edit(data)
+            elif message_type == 'edit_delta':
+                await self.handle_edit_delta(data)
             elif message_type == 'cursor_move':
                 await self.handle_cursor_move(data)
             elif message_type == 'ai_suggestion_request':
@@ -83,11 +137,16 @@ class DocumentConsumer(AsyncWebsocketConsumer):
             elif message_type == 'save_version':
                 await self.handle_save_version(data)
                 
-        except json.JSONDecodeError as e:
+        except codec.DecodeError as e:
             logger.error(f"JSON decode error: {str(e)}")
-            await self.send(text_data=json.dumps({
+            self.queue_message({
                 'error': 'Invalid JSON format'
-            }))
+            })
+        except compact.DecodeError as e:
+            logger.error(f"Binary decode error: {str(e)}")
+            self.queue_message({
+                'error': 'Invalid binary message'
+            })
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}")
 
@@ -98,58 +157,191 @@ class DocumentConsumer(AsyncWebsocketConsumer):
             
             logger.debug(f"Handling edit from user {self.user.username}, content length: {len(content)}")
             
-            # Save to database
-            await self.save_document_content(content)
-            
-            # Broadcast to all users in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_edit',
-                    'content': content,
-                    'cursor_position': cursor_position,
-                    'user_id': self.user.id,
-                    'username': self.user.username
-                }
-            )
+            # Full-content edits from old clients become ops against the latest revision
+            engine = self.state.engine
+            ops = diff_ops(engine.content, content)
+            if not ops:
+                return
+            await self.submit_edit(engine.revision, ops, cursor_position)
         except Exception as e:
             logger.error(f"Error in handle_edit: {str(e)}")
 
+    async def handle_edit_delta(self, data):
+        try:
+            base_revision = data.get('base_revision')
+            cursor_position = data.get('cursor_position', 0)
+            try:
+                if not isinstance(base_revision, int):
+                    raise InvalidOperation('base_revision must be an integer')
+                ops = parse_ops(data.get('ops'))
+            except InvalidOperation as e:
+                self.queue_message({
+                    'type': 'error',
+                    'error': f'Invalid edit_delta: {e}'
+                })
+                return
+
+            await self.submit_edit(base_revision, ops, cursor_position)
+            logger.debug(f"Submitted {len(ops)} ops from user {self.user.username} based on revision {base_revision}")
+        except Exception as e:
+            logger.error(f"Error in handle_edit_delta: {str(e)}")
+
+    async def submit_edit(self, base_revision, ops, cursor_position):
+        """Apply ops here, or at the worker owning the document, and broadcast them"""
+        applied = await get_cluster().submit_edit(self.state, {
+            'base_revision': base_revision,
+            'ops': ops,
+            'cursor_position': cursor_position,
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'epoch': self.state.epoch,
+            'sender_channel_name': self.channel_name
+        })
+        if not applied:
+            self.send_sync()
+
+    def queue_message(self, message, kind=OTHER, key=None):
+        """Queue a message for the client; it is sent with the next batch"""
+        if self.binary is not None:
+            self.announce_users(compact.mentioned_users(message))
+            self.outbound.put(self.binary.dumps(message), kind, key)
+        else:
+            self.outbound.put(codec.dumps(message), kind, key)
+
+    def queue_frame(self, frame, kind=OTHER, key=None):
+        """Queue a message that is already JSON encoded"""
+        if self.binary is not None:
+            frame, users = self.binary.transcode(frame)
+            self.announce_users(users)
+        self.outbound.put(frame, kind, key)
+
+    def announce_users(self, users):
+        # Binary messages carry user ids only; send each name once
+        for user_id, username in users:
+            if user_id not in self.known_users:
+                self.known_users.add(user_id)
+                self.outbound.put(self.binary.dumps({'type': 'user', 'user_id': user_id, 'username': username}))
+
+    async def send_frame(self, frames):
+        if self.binary is not None:
+            await self.send(bytes_data=self.binary.frame(frames))
+        elif self.protocol == DELTA_PROTOCOL and len(frames) > 1:
+            await self.send(text_data=codec.join_batch(frames))
+        else:
+            # Old clients do not understand batches
+            for frame in frames:
+                await self.send(text_data=frame)
+
+    def snapshot_message(self):
+        """Current document state, sent instead of edits a slow client missed"""
+        engine = self.state.engine
+        if self.protocol == DELTA_PROTOCOL:
+            message = {'type': 'sync', 'content': engine.content, 'revision': engine.revision,
+                       'epoch': self.state.epoch}
+            return self.binary.dumps(message) if self.binary is not None else codec.dumps(message)
+        return codec.dumps({
+            'type': 'edit',
+            'content': engine.content,
+            'cursor_position': 0,
+            'revision': engine.revision,
+            'user_id': None,
+            'username': None
+        })
+
+    def send_sync(self):
+        """Send the full document state so a delta client can (re)base its edits"""
+        engine = self.state.engine
+        self.queue_message({
+            'type': 'sync',
+            'content': engine.content,
+            'revision': engine.revision,
+            'epoch': self.state.epoch
+        }, kind=EDIT)
+
+    def send_catch_up(self, epoch, revision):
+        """
+        Send a reconnecting client the ops applied since the revision it last
+        saw, or the full document if those are no longer in the engine's
+        history or would be larger than the document itself.
+        """
+        engine = self.state.engine
+        try:
+            if epoch != self.state.epoch:
+                raise StaleRevisionError(f'epoch {epoch!r} is not the current one')
+            missed = engine.ops_since(int(revision))
+        except (StaleRevisionError, ValueError):
+            self.send_sync()
+            return
+
+        ops = [op for batch in missed for op in batch]
+        if sum(len(op.get('text', '')) for op in ops) > engine.length:
+            self.send_sync()
+            return
+        self.queue_message({
+            'type': 'resume',
+            'ops': ops,
+            'revision': engine.revision,
+            'epoch': self.state.epoch
+        }, kind=REPLY)
+        logger.debug(f"Resumed {self.user.username} on document {self.doc_id} with {len(missed)} missed revisions")
+
     async def handle_cursor_move(self, data):
         try:
             cursor_position = data.get('cursor_position', 0)
             
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_cursor',
-                    'cursor_position': cursor_position,
-                    'user_id': self.user.id,
-                    'username': self.user.username
-                }
-            )
+            # Cursor moves are coalesced into one presence frame per tick
+            self.get_cursor_coalescer().update(self.channel_name, self.user.id, self.user.username, cursor_position)
         except Exception as e:
             logger.error(f"Error in handle_cursor_move: {str(e)}")
 
+    def get_cursor_coalescer(self):
+        if self.state.cursors is None:
+            group_send = self.channel_layer.group_send
+            room_group_name = self.room_group_name
+            
+            async def send_frame(cursors):
+                await group_send(room_group_name, {
+                    'type': 'broadcast_presence',
+                    'frame': codec.dumps({'type': 'presence', 'cursors': cursors}),
+                    'cursor_frames': [
+                        [cursor['user_id'], codec.dumps(dict(cursor, type='cursor_move'))]
+                        for cursor in cursors
+                    ]
+                })
+            
+            self.state.cursors = CursorCoalescer(send_frame)
+        return self.state.cursors
+
     async def handle_ai_suggestion_request(self, data):
         try:
             text = data.get('text', '')
-            suggestion = await self.get_ai_suggestion(text)
-            
-            await self.send(text_data=json.dumps({
-                'type': 'ai_suggestion',
-                'suggestion': suggestion,
-                'original_text': text
-            }))
+            # Analyzed by the suggestion pool; edits keep flowing meanwhile
+            future = get_suggestion_pool().submit(self.channel_name, text, self.doc_id)
+            future.add_done_callback(functools.partial(self.send_ai_suggestion, data.get('request_id'), text))
         except Exception as e:
             logger.error(f"Error in handle_ai_suggestion_request: {str(e)}")
 
+    def send_ai_suggestion(self, request_id, text, future):
+        # Cancelled when a newer request from this connection superseded it
+        if future.cancelled():
+            return
+        result = future.result()
+        self.queue_message({
+            'type': 'ai_suggestion',
+            'request_id': request_id,
+            'suggestion': result['suggestions'],
+            'issues': result['issues'],
+            'original_text': text
+        })
+
     async def handle_save_version(self, data):
         try:
-            content = data.get('content', '')
+            # Apply any content the client has not sent as an edit yet
+            if 'content' in data:
+                await self.handle_edit(data)
             
             # Save version
-            version_info = await self.save_document_version(content)
+            version_info = await self.save_document_version()
             
             if version_info:
                 # Notify all users in the room about the saved version
@@ -157,162 +349,109 @@ class DocumentConsumer(AsyncWebsocketConsumer):
                     self.room_group_name,
                     {
                         'type': 'version_saved',
-                        'version_number': version_info['version_number'],
-                        'user_id': self.user.id,
-                        'username': self.user.username,
-                        'timestamp': version_info['timestamp']
+                        'frame': codec.dumps({
+                            'type': 'version_saved',
+                            'version_number': version_info['version_number'],
+                            'user_id': self.user.id,
+                            'username': self.user.username,
+                            'timestamp': version_info['timestamp']
+                        })
                     }
                 )
                 
                 # Send confirmation to the user who saved
-                await self.send(text_data=json.dumps({
+                self.queue_message({
                     'type': 'version_saved',
                     'version_number': version_info['version_number'],
                     'timestamp': version_info['timestamp']
-                }))
+                })
         except Exception as e:
             logger.error(f"Error in handle_save_version: {str(e)}")
 
-    async def broadcast_edit(self, event):
+    async def broadcast_edit_delta(self, event):
+        try:
+            # Replicas catch up with the owner before anything reads them
+            self.state.follow(event['epoch'], event['revision'], event['frame'])
+            if event['sender_channel_name'] == self.channel_name:
+                self.queue_message({
+                    'type': 'edit_ack',
+                    'revision': event['revision']
+                }, kind=REPLY)
+            elif self.protocol == DELTA_PROTOCOL:
+                self.queue_frame(event['frame'], kind=EDIT)
+            else:
+                # Old clients only understand full-content edits, encoded
+                # once per revision for all of them in this process
+                engine = self.state.engine
+                cached = self.state.legacy_edit_frame
+                if cached is None or cached[0] != engine.revision:
+                    cached = self.state.legacy_edit_frame = (engine.revision, codec.dumps({
+                        'type': 'edit',
+                        'content': engine.content,
+                        'cursor_position': event['cursor_position'],
+                        'revision': engine.revision,
+                        'user_id': event['user_id'],
+                        'username': event['username']
+                    }))
+                self.queue_frame(cached[1], kind=EDIT, key='edit')
+        except Exception as e:
+            logger.error(f"Error in broadcast_edit_delta: {str(e)}")
+
+    async def document_resync(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'edit',
-                'content': event['content'],
-                'cursor_position': event['cursor_position'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+            # The owner could not apply our edit, or the document was reloaded.
+            # The snapshot is already encoded for this connection's protocol
+            self.outbound.put(self.snapshot_message(), kind=EDIT)
         except Exception as e:
-            logger.error(f"Error in broadcast_edit: {str(e)}")
+            logger.error(f"Error in document_resync: {str(e)}")
 
-    async def broadcast_cursor(self, event):
+    async def broadcast_presence(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_move',
-                'cursor_position': event['cursor_position'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+            if self.protocol == DELTA_PROTOCOL:
+                self.queue_frame(event['frame'], key='presence')
+            else:
+                # Old clients expect one message per cursor
+                for user_id, frame in event['cursor_frames']:
+                    self.queue_frame(frame, key=('cursor', user_id))
         except Exception as e:
-            logger.error(f"Error in broadcast_cursor: {str(e)}")
+            logger.error(f"Error in broadcast_presence: {str(e)}")
 
     async def user_joined(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'user_joined',
-                'username': event['username'],
-                'user_id': event['user_id']
-            }))
+            self.queue_frame(event['frame'])
         except Exception as e:
             logger.error(f"Error in user_joined: {str(e)}")
 
     async def user_left(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'user_left',
-                'username': event['username'],
-                'user_id': event['user_id']
-            }))
+            self.queue_frame(event['frame'])
         except Exception as e:
             logger.error(f"Error in user_left: {str(e)}")
 
     async def version_saved(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'version_saved',
-                'version_number': event['version_number'],
-                'username': event['username'],
-                'timestamp': event['timestamp']
-            }))
+            self.queue_frame(event['frame'])
         except Exception as e:
             logger.error(f"Error in version_saved: {str(e)}")
 
     @database_sync_to_async
     def can_access_document(self):
         try:
-            document = Document.objects.get(id=self.doc_id)
-            can_access = (self.user == document.owner or 
-                         self.user in document.collaborators.all() or 
-                         document.is_public)
+            can_access = can_access_document(self.user, self.doc_id)
             logger.info(f"Access check for user {self.user.username} to document {self.doc_id}: {can_access}")
             return can_access
-        except Document.DoesNotExist:
-            logger.warning(f"Document {self.doc_id} does not exist")
-            return False
         except Exception as e:
             logger.error(f"Error in can_access_document: {str(e)}")
             return False
 
-    @database_sync_to_async
-    def save_document_content(self, content):
-        try:
-            document = Document.objects.get(id=self.doc_id)
-            
-            # Check if content actually changed
-            if document.content != content:
-                document.content = content
-                document.save()
-                
-                # Create version for any significant change
-                # Create version if:
-                # 1. Content is substantial (more than 50 characters)
-                # 2. Or if it's been more than 5 minutes since last version
-                # 3. Or if this is the first version
-                
-                latest_version = document.versions.first()
-                should_create_version = False
-                
-                if len(content) > 50:  # Substantial content
-                    should_create_version = True
-                elif not latest_version:  # First version
-                    should_create_version = True
-                else:
-                    # Check if it's been more than 5 minutes since last version
-                    from django.utils import timezone
-                    from datetime import timedelta
-                    time_diff = timezone.now() - latest_version.created_at
-                    if time_diff > timedelta(minutes=5):
-                        should_create_version = True
-                
-                if should_create_version:
-                    version_number = (latest_version.version_number + 1) if latest_version else 1
-                    
-                    DocumentVersion.objects.create(
-                        document=document,
-                        content=content,
-                        created_by=self.user,
-                        version_number=version_number
-                    )
-                    
-                    logger.info(f"Created version {version_number} for document {self.doc_id} by {self.user.username}")
-                
-        except Document.DoesNotExist:
-            logger.error(f"Document {self.doc_id} not found when saving content")
-        except Exception as e:
-            logger.error(f"Error in save_document_content: {str(e)}")
-
-    @database_sync_to_async
-    def save_document_version(self, content):
-        """Save a manual version of the document"""
+    async def save_document_version(self):
+        """Save a manual version of the live document"""
         try:
             from django.utils import timezone
             
-            document = Document.objects.get(id=self.doc_id)
-            
-            # Update document content
-            document.content = content
-            document.save()
-            
-            # Create version
-            latest_version = document.versions.first()
-            version_number = (latest_version.version_number + 1) if latest_version else 1
-            
-            DocumentVersion.objects.create(
-                document=document,
-                content=content,
-                created_by=self.user,
-                version_number=version_number
-            )
+            version_number = await get_cluster().save_version(self.state, self.user.id)
+            if version_number is None:
+                return None
             
             logger.info(f"Manually created version {version_number} for document {self.doc_id} by {self.user.username}")
             
@@ -320,10 +459,6 @@ class DocumentConsumer(AsyncWebsocketConsumer):
                 'version_number': version_number,
                 'timestamp': timezone.now().strftime('%Y-%m-%d %H:%M:%S')
             }
-            
-        except Document.DoesNotExist:
-            logger.error(f"Document {self.doc_id} not found when saving version")
-            return None
         except Exception as e:
             logger.error(f"Error in save_document_version: {str(e)}")
             return None
@@ -331,11 +466,7 @@ class DocumentConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def add_user_session(self):
         try:
-            DocumentSession.objects.create(
-                document_id=self.doc_id,
-                user=self.user,
-                session_id=self.channel_name
-            )
+            get_presence_registry().join(self.doc_id, self.channel_name, self.user.id, self.user.username)
             logger.info(f"Added user session for {self.user.username} in document {self.doc_id}")
         except Exception as e:
             logger.error(f"Error in add_user_session: {str(e)}")
@@ -343,46 +474,18 @@ class DocumentConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def remove_user_session(self):
         try:
-            DocumentSession.objects.filter(
-                document_id=self.doc_id,
-                user=self.user,
-                session_id=self.channel_name
-            ).delete()
+            get_presence_registry().leave(self.doc_id, self.channel_name)
             logger.info(f"Removed user session for {self.user.username} in document {self.doc_id}")
         except Exception as e:
             logger.error(f"Error in remove_user_session: {str(e)}")
 
-    async def get_ai_suggestion(self, text):
-        """Simple AI suggestions using basic text analysis"""
-        try:
-            suggestions = []
-            
-            # Basic grammar suggestions
-            if len(text.split()) < 3:
-                suggestions.append("Consider adding more detail to your sentence.")
-            
-            # Check for common mistakes
-            common_mistakes = {
-                'teh': 'the',
-                'recieve': 'receive',
-                'seperate': 'separate',
-                'occured': 'occurred',
-                'definately': 'definitely'
-            }
-            
-            for mistake, correction in common_mistakes.items():
-                if mistake in text.lower():
-                    suggestions.append(f"Did you mean '{correction}' instead of '{mistake}'?")
-            
-            # Check sentence structure
-            sentences = text.split('.')
-            for sentence in sentences:
-                sentence = sentence.strip()
-                if sentence and not sentence[0].isupper():
-                    suggestions.append("Consider capitalizing the first letter of your sentence.")
-            
-            logger.debug(f"Generated {len(suggestions)} AI suggestions for text length {len(text)}")
-            return suggestions[:3]  # Return max 3 suggestions
-        except Exception as e:
-            logger.error(f"Error in get_ai_suggestion: {str(e)}")
-            return []
+    async def send_heartbeats(self):
+        """Keep this connection's presence entry from expiring"""
+        registry = get_presence_registry()
+        heartbeat = database_sync_to_async(registry.heartbeat)
+        while True:
+            await asyncio.sleep(registry.heartbeat_interval)
+            try:
+                await heartbeat(self.doc_id, self.channel_name)
+            except Exception as e:
+                logger.error(f"Error in send_heartbeats: {str(e)}")
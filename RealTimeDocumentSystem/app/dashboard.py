@@ -0,0 +1,119 @@
+"""
+Dashboard document lists.
+
+All documents a user can see are fetched in one query, without their
+content, and rendered once into an HTML fragment that is cached per user.
+Active users change far more often than the lists do, so the fragment only
+contains a marker per document card; the markers are replaced with the
+current users from the presence registry on every request.
+
+Cached fragments are invalidated by bumping a generation shared by all
+users whenever a document is created, saved, deleted or shared, because
+public documents appear on everyone's dashboard. Content written back by
+live editing sessions does not go through save(), so a card's "last updated"
+time may lag by up to DASHBOARD_CACHE_TTL seconds. Fragments live in the
+cache named by DASHBOARD_CACHE_ALIAS; unless every worker shares it, other
+workers also show changes only once their fragments expire.
+"""
+import re
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+
+from .access import Collaborator, accessible_filter, collaborating
+from .models import Document
+from .presence import get_presence_registry
+
+DEFAULT_DASHBOARD_CACHE_TTL = 30
+
+GENERATION_KEY = 'dashboard_gen'
+
+ACTIVE_USERS_MARKER = re.compile(r'<!--active-users:(\d+):(\d+)-->')
+
+
+def get_dashboard_cache_ttl():
+    return getattr(settings, 'DASHBOARD_CACHE_TTL', DEFAULT_DASHBOARD_CACHE_TTL)
+
+
+def get_dashboard_cache():
+    return caches[getattr(settings, 'DASHBOARD_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+
+def dashboard_documents(user):
+    """Every document on the user's dashboard, in one query and without content"""
+    collaborator_count = Collaborator.objects.filter(
+        document_id=OuterRef('pk'),
+    ).order_by().values('document_id').annotate(count=Count('id')).values('count')
+    return Document.objects.filter(accessible_filter(user.id)).defer('content').select_related('owner').annotate(
+        collaborator_count=Coalesce(Subquery(collaborator_count, output_field=IntegerField()), 0),
+        is_collaborator=collaborating(user.id),
+    )
+
+
+def render_document_lists(user):
+    owned_docs, collaborated_docs, public_docs = [], [], []
+    for doc in dashboard_documents(user):
+        if doc.owner_id == user.id:
+            owned_docs.append(doc)
+        if doc.is_collaborator:
+            collaborated_docs.append(doc)
+        if doc.is_public and doc.owner_id != user.id:
+            public_docs.append(doc)
+    return render_to_string('dashboard_documents.html', {
+        'owned_docs': owned_docs,
+        'collaborated_docs': collaborated_docs,
+        'public_docs': public_docs,
+    })
+
+
+def fill_active_users(html):
+    """Replace the active user markers with the users currently connected"""
+    doc_ids = {int(doc_id) for doc_id, _ in ACTIVE_USERS_MARKER.findall(html)}
+    active_users_by_doc = get_presence_registry().users_by_document(doc_ids)
+    template = get_template('dashboard_active_users.html')
+
+    def replace(match):
+        users = active_users_by_doc.get(int(match.group(1)))
+        if not users:
+            return ''
+        return template.render({'users': users, 'owner_id': int(match.group(2))})
+
+    return ACTIVE_USERS_MARKER.sub(replace, html)
+
+
+def document_lists_html(user):
+    """The dashboard's document sections for a user, from cache when possible"""
+    cache = get_dashboard_cache()
+    generation = cache.get_or_set(GENERATION_KEY, 0, None)
+    key = f'dashboard:{user.id}:{generation}'
+    html = cache.get(key)
+    if html is None:
+        html = render_document_lists(user)
+        cache.set(key, html, get_dashboard_cache_ttl())
+    return mark_safe(fill_active_users(html))
+
+
+def invalidate_dashboards():
+    cache = get_dashboard_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 1, None)
+
+
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def document_changed(sender, **kwargs):
+    invalidate_dashboards()
+
+
+@receiver(m2m_changed, sender=Collaborator)
+def collaborators_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_dashboards()
@@ -0,0 +1,238 @@
+"""
+Line and word diffs between document versions.
+
+The diff is Myers' O(ND) algorithm in its linear-space form: each step
+finds where the forward and reverse searches for the shortest edit script
+meet and recurses on the two halves, so memory stays proportional to the
+length of the inputs rather than to their product.
+
+Versions never change once stored, so diffs are kept in a small LRU cache
+keyed by document, version numbers and options.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import DocumentVersion
+from .versions import VersionContentCache
+
+DEFAULT_DIFF_CACHE_SIZE = 256
+DEFAULT_CONTEXT = 3
+
+WORD_RE = re.compile(r'\w+|\s+|[^\w\s]+')
+
+
+def tokenize(text, by='line'):
+    if by == 'word':
+        return WORD_RE.findall(text)
+    return text.splitlines(keepends=True)
+
+
+def _bisect(a, alo, ahi, b, blo, bhi):
+    """
+    Return the point (x, y) where a shortest edit script from a[alo:ahi] to
+    b[blo:bhi] can be split in two, or None if the ranges share nothing.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    v_offset = max_d
+    # Diagonals -max_d - 1 .. max_d + 1 are read
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = [-1] * v_length
+    v2[v_offset + 1] = 0
+    delta = n - m
+    # With an odd delta the forward search detects the overlap, otherwise the reverse one
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+
+    for d in range(max_d):
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1 and x1 >= n - v2[k2_offset]:
+                    return alo + x1, blo + y1
+
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= n - x2:
+                        return alo + x1, blo + x1 - (k1_offset - v_offset)
+    return None
+
+
+def _diff(a, alo, ahi, b, blo, bhi, opcodes):
+    prefix = 0
+    while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+        prefix += 1
+    if prefix:
+        opcodes.append(('equal', alo, alo + prefix, blo, blo + prefix))
+        alo += prefix
+        blo += prefix
+
+    suffix = 0
+    while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+        suffix += 1
+    ahi -= suffix
+    bhi -= suffix
+
+    if alo == ahi:
+        if blo < bhi:
+            opcodes.append(('insert', alo, alo, blo, bhi))
+    elif blo == bhi:
+        opcodes.append(('delete', alo, ahi, blo, blo))
+    else:
+        split = _bisect(a, alo, ahi, b, blo, bhi)
+        if split is None:
+            opcodes.append(('delete', alo, ahi, blo, blo))
+            opcodes.append(('insert', ahi, ahi, blo, bhi))
+        else:
+            x, y = split
+            _diff(a, alo, x, b, blo, y, opcodes)
+            _diff(a, x, ahi, b, y, bhi, opcodes)
+
+    if suffix:
+        opcodes.append(('equal', ahi, ahi + suffix, bhi, bhi + suffix))
+
+
+def diff_opcodes(a, b):
+    """
+    Opcodes turning sequence a into b, like SequenceMatcher.get_opcodes()
+    but with 'delete' and 'insert' only, never 'replace'.
+    """
+    # Compare small ints instead of long strings
+    ids = {}
+    a = [ids.setdefault(token, len(ids)) for token in a]
+    b = [ids.setdefault(token, len(ids)) for token in b]
+
+    opcodes = []
+    _diff(a, 0, len(a), b, 0, len(b), opcodes)
+
+    merged = []
+    for opcode in opcodes:
+        if merged and merged[-1][0] == opcode[0]:
+            tag, i1, _, j1, _ = merged[-1]
+            merged[-1] = (tag, i1, opcode[2], j1, opcode[4])
+        else:
+            merged.append(opcode)
+    return merged
+
+
+def diff_texts(old, new, by='line', context=DEFAULT_CONTEXT):
+    """
+    Compact diff of two texts. Changes are ``['=', text]``, ``['-', text]``
+    and ``['+', text]``; unchanged runs longer than twice ``context`` units
+    keep only their edges, with ``['skip', count]`` standing for the units
+    left out.
+    """
+    a = tokenize(old, by)
+    b = tokenize(new, by)
+    changes = []
+    insertions = deletions = 0
+    opcodes = diff_opcodes(a, b)
+    for index, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == 'delete':
+            changes.append(['-', ''.join(a[i1:i2])])
+            deletions += i2 - i1
+        elif tag == 'insert':
+            changes.append(['+', ''.join(b[j1:j2])])
+            insertions += j2 - j1
+        else:
+            head = context if index > 0 else 0
+            tail = context if index < len(opcodes) - 1 else 0
+            if i2 - i1 <= head + tail:
+                changes.append(['=', ''.join(a[i1:i2])])
+                continue
+            if head:
+                changes.append(['=', ''.join(a[i1:i1 + head])])
+            changes.append(['skip', i2 - i1 - head - tail])
+            if tail:
+                changes.append(['=', ''.join(a[i2 - tail:i2])])
+    return {
+        'by': by,
+        'changes': changes,
+        'insertions': insertions,
+        'deletions': deletions,
+    }
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+_version_diffs = None
+
+
+def get_version_diff_cache():
+    global _version_diffs
+    if _version_diffs is None:
+        _version_diffs = LRUCache(getattr(settings, 'VERSION_DIFF_CACHE_SIZE', DEFAULT_DIFF_CACHE_SIZE))
+    return _version_diffs
+
+
+def diff_versions(document_id, from_number, to_number, by='line', context=DEFAULT_CONTEXT):
+    """Diff two versions of a document, raising DocumentVersion.DoesNotExist if one is missing"""
+    key = (int(document_id), from_number, to_number, by, context)
+    cache = get_version_diff_cache()
+    result = cache.get(key)
+    if result is None:
+        versions = VersionContentCache().resolve(DocumentVersion.objects.filter(
+            document_id=document_id, version_number__in=[from_number, to_number]))
+        contents = {version.version_number: version.full_content for version in versions}
+        if from_number not in contents or to_number not in contents:
+            raise DocumentVersion.DoesNotExist(f"Document {document_id} has no version {from_number} or {to_number}")
+        result = dict(diff_texts(contents[from_number], contents[to_number], by, context),
+                      **{'from': from_number, 'to': to_number})
+        cache.set(key, result)
+    return result
@@ -0,0 +1,361 @@
+"""
+Load generator for the document WebSocket consumer.
+
+Simulated editors connect to the real DocumentConsumer through
+channels.testing.WebsocketCommunicator, speak the delta protocol and type
+at a steady rate. Every insert carries a unique tag, so when another
+editor receives the broadcast the time since it was sent is known. The
+result is a plain dict that the loadtest command writes out as JSON.
+
+Database queries are counted on every connection Django opens while the
+test runs, split into the connect, editing and disconnect phases.
+
+A run never touches the configured database, cache or channel layer: it
+gets the throwaway SQLite database of the loadtest alias, created and
+dropped like a test database, its own local memory cache and an
+in-memory channel layer, so the numbers of the loadtest command and of
+the test suite come from the same setup.
+"""
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import platform
+import random
+import re
+import subprocess
+import time
+
+import channels
+import django
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections, router
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from . import codec
+from .collab.ops import insert
+from .models import Document
+from .routing import websocket_urlpatterns
+
+TAG_RE = re.compile(r'\[(\d+)\.(\d+)\]')
+
+# Database alias a run works in; see DATABASES in settings.py
+LOADTEST_DATABASE = 'loadtest'
+
+ISOLATED_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+ISOLATED_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'loadtest'}}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None  # noqa: E731
+    return {
+        'count': len(latencies),
+        'p50': ms(percentile(latencies, 0.50)),
+        'p90': ms(percentile(latencies, 0.90)),
+        'p99': ms(percentile(latencies, 0.99)),
+        'max': ms(latencies[-1] if latencies else None),
+    }
+
+
+class LoadTestRouter:
+    """Sends every query to the load test database while a run is in progress"""
+
+    def db_for_read(self, model, **hints):
+        return LOADTEST_DATABASE
+
+    def db_for_write(self, model, **hints):
+        return LOADTEST_DATABASE
+
+
+@contextlib.contextmanager
+def isolated_environment():
+    """Swap in a throwaway database, cache and channel layer for the duration"""
+    with override_settings(
+        CACHES=ISOLATED_CACHES,
+        CHANNEL_LAYERS=ISOLATED_CHANNEL_LAYERS,
+        DATABASE_ROUTERS=['app.loadtest.LoadTestRouter'],
+    ):
+        old_config = setup_databases(verbosity=0, interactive=False,
+                                     aliases={LOADTEST_DATABASE}, serialized_aliases=set())
+        try:
+            # An in-memory database lives as long as the process, so empty
+            # whatever an earlier run left behind
+            call_command('flush', database=LOADTEST_DATABASE, interactive=False, verbosity=0)
+            yield
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+
+class QueryCounter:
+    """Counts queries on every database connection, per phase"""
+
+    def __init__(self):
+        self.phase = 'setup'
+        self.counts = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        self.counts[self.phase] = self.counts.get(self.phase, 0) + 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        for conn in connections.all(initialized_only=True):
+            self.install(conn)
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+class Editor:
+    def __init__(self, index, user, doc_id, run):
+        self.index = index
+        self.user = user
+        self.doc_id = doc_id
+        self.run = run
+        self.revision = 0
+        self.synced = False
+        self.sequence = itertools.count()
+        # Send times of edits not acknowledged yet; a connection's edits are acked in order
+        self.unacked = collections.deque()
+        self.communicator = None
+        self.reader = None
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(
+            self.run.application, f'/ws/document/{self.doc_id}/?protocol=delta')
+        self.communicator.scope['user'] = self.user
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f'Editor {self.index} could not connect to document {self.doc_id}')
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            event = await self.communicator.receive_output(timeout=3600)
+            if event['type'] != 'websocket.send':
+                continue
+            received_at = time.perf_counter()
+            message = codec.loads(event['text'])
+            messages = message['messages'] if message.get('type') == 'batch' else [message]
+            self.run.messages_received += len(messages)
+            for message in messages:
+                self.handle(message, received_at)
+
+    def handle(self, message, received_at):
+        message_type = message.get('type')
+        if message_type in ('sync', 'edit_ack', 'edit_delta'):
+            self.revision = max(self.revision, message['revision'])
+        if message_type == 'sync':
+            if self.synced:
+                # A rejected edit is answered with a sync instead of an ack
+                self.run.resyncs += 1
+                if self.unacked:
+                    self.unacked.popleft()
+            self.synced = True
+        elif message_type == 'edit_ack':
+            self.run.acks += 1
+            if self.unacked:
+                self.run.ack_latencies.append(received_at - self.unacked.popleft())
+        elif message_type == 'edit_delta':
+            for op in message['ops']:
+                if op['op'] != 'insert':
+                    continue
+                for match in TAG_RE.finditer(op['text']):
+                    sent_at = self.run.sent.get((int(match.group(1)), int(match.group(2))))
+                    if sent_at is not None:
+                        self.run.broadcast_latencies.append(received_at - sent_at)
+        elif message_type == 'error':
+            self.run.errors += 1
+
+    async def type_edits(self, rng, interval, stop_at):
+        # Editors start out of phase so their edits do not arrive in waves
+        await asyncio.sleep(rng.uniform(0, interval))
+        while time.perf_counter() < stop_at:
+            sequence = next(self.sequence)
+            tag = f'[{self.index}.{sequence}]'
+            sent_at = time.perf_counter()
+            self.run.sent[(self.index, sequence)] = sent_at
+            self.unacked.append(sent_at)
+            # The document only grows, so positions within the seed text are always valid
+            await self.communicator.send_to(text_data=codec.dumps({
+                'type': 'edit_delta',
+                'base_revision': self.revision,
+                'ops': [insert(rng.randint(0, self.run.document_size), tag)],
+                'cursor_position': 0,
+            }))
+            self.run.edits_sent += 1
+            await asyncio.sleep(interval)
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class LoadTest:
+    """
+    ``documents`` documents of ``document_size`` characters are each edited
+    by ``editors`` connections typing ``rate`` edits per second for
+    ``duration`` seconds.
+    """
+
+    def __init__(self, documents=5, editors=20, rate=5.0, duration=10.0, document_size=10000,
+                 settle=5.0, seed=0):
+        self.documents = documents
+        self.editors = editors
+        self.rate = rate
+        self.duration = duration
+        self.document_size = document_size
+        self.settle = settle
+        self.seed = seed
+        self.application = URLRouter(websocket_urlpatterns)
+        self.sent = {}
+        self.broadcast_latencies = []
+        self.ack_latencies = []
+        self.messages_received = 0
+        self.edits_sent = 0
+        self.acks = 0
+        self.errors = 0
+        self.resyncs = 0
+
+    def create_fixtures(self):
+        rng = random.Random(self.seed)
+        words = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor'.split()
+        users = User.objects.bulk_create([
+            User(username=f'loadtest-{index}') for index in range(self.documents * self.editors)])
+        editors = []
+        for doc_index in range(self.documents):
+            content = ' '.join(rng.choice(words) for _ in range(self.document_size // 4 + 1))
+            document = Document.objects.create(
+                title=f'Load test {doc_index}', content=content[:self.document_size],
+                owner=users[doc_index * self.editors], is_public=True)
+            for editor_index in range(self.editors):
+                index = doc_index * self.editors + editor_index
+                editors.append(Editor(index, users[index], document.id, self))
+        return editors
+
+    async def run(self, editors, counter):
+        rng = random.Random(self.seed)
+        counter.phase = 'connect'
+        for editor in editors:
+            await editor.connect()
+
+        counter.phase = 'editing'
+        interval = 1 / self.rate
+        started = time.perf_counter()
+        await asyncio.gather(*(editor.type_edits(random.Random(rng.random()), interval, started + self.duration)
+                               for editor in editors))
+        # Give the server up to `settle` seconds to catch up with the last edits
+        settle_until = time.perf_counter() + self.settle
+        while self.acks + self.resyncs < self.edits_sent and time.perf_counter() < settle_until:
+            await asyncio.sleep(0.01)
+        # Broadcasts go out with the acks, allow them one more outbound tick
+        await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        counter.phase = 'disconnect'
+        for editor in editors:
+            await editor.disconnect()
+        return elapsed
+
+    def execute(self):
+        with isolated_environment():
+            editors = self.create_fixtures()
+            with QueryCounter() as counter:
+                elapsed = asyncio.run(self.run(editors, counter))
+            return self.report(elapsed, counter.counts)
+
+    def report(self, elapsed, query_counts):
+        edit_queries = query_counts.get('editing', 0) + query_counts.get('disconnect', 0)
+        return {
+            'config': {
+                'documents': self.documents,
+                'editors_per_document': self.editors,
+                'rate': self.rate,
+                'duration': self.duration,
+                'document_size': self.document_size,
+                'seed': self.seed,
+            },
+            'environment': environment(),
+            'elapsed': round(elapsed, 3),
+            'edits_sent': self.edits_sent,
+            'edits_acked': self.acks,
+            'errors': self.errors,
+            'resyncs': self.resyncs,
+            # Every edit should reach the other editors of its document
+            'broadcasts_expected': self.edits_sent * (self.editors - 1),
+            'edit_to_broadcast_ms': summarize(self.broadcast_latencies),
+            'edit_to_ack_ms': summarize(self.ack_latencies),
+            'messages_received': self.messages_received,
+            'messages_per_sec': round(self.messages_received / elapsed, 1) if elapsed else None,
+            'db_queries': {
+                'connect': query_counts.get('connect', 0),
+                'editing': query_counts.get('editing', 0),
+                'disconnect': query_counts.get('disconnect', 0),
+                'per_edit': round(edit_queries / self.edits_sent, 4) if self.edits_sent else None,
+            },
+        }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'channels': channels.__version__,
+        'database': connections[router.db_for_write(Document)].vendor,
+    }
+
+
+def compare(report, baseline):
+    """Lines comparing the headline numbers of two reports"""
+    metrics = [
+        ('edit_to_broadcast_ms', 'p50'),
+        ('edit_to_broadcast_ms', 'p99'),
+        ('edit_to_ack_ms', 'p99'),
+        ('messages_per_sec', None),
+        ('db_queries', 'per_edit'),
+    ]
+    lines = []
+    for section, key in metrics:
+        name = f'{section}.{key}' if key else section
+        new = report[section][key] if key else report[section]
+        old = baseline.get(section, {}).get(key) if key else baseline.get(section)
+        if new is None or old is None:
+            lines.append(f'{name}: {old} -> {new}')
+            continue
+        change = f' ({(new - old) / old * 100:+.1f}%)' if old else ''
+        lines.append(f'{name}: {old} -> {new}{change}')
+    return lines
+
+
+def load_report(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
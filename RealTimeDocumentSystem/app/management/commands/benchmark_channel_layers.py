@@ -0,0 +1,94 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from app.channel_layers import DEFAULT_INNER_LAYER, HybridChannelLayer
+
+
+class Command(BaseCommand):
+    help = ('Compare group_send throughput of a channel layer with the same layer behind '
+            'HybridChannelLayer, checking that every member receives messages in order')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default=DEFAULT_INNER_LAYER,
+                            help='Channel layer class to compare against, e.g. channels_redis.core.RedisChannelLayer')
+        parser.add_argument('--config', default='{}',
+                            help='JSON keyword arguments for the backend, e.g. {"hosts": [["127.0.0.1", 6379]]}')
+        parser.add_argument('--groups', type=int, default=20,
+                            help='Number of groups, like one per open document')
+        parser.add_argument('--members', type=int, default=10,
+                            help='Members of each group')
+        parser.add_argument('--messages', type=int, default=500,
+                            help='Messages sent to each group')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Simulated processes the hybrid layer spreads group members over')
+
+    def handle(self, *args, **options):
+        backend = import_string(options['backend'])
+        config = json.loads(options['config'])
+        # Nothing may be dropped for the order check to mean anything
+        config.setdefault('capacity', options['groups'] * options['messages'] + 100)
+        shared = backend is import_string(DEFAULT_INNER_LAYER)
+
+        def stock():
+            return [backend(**config)]
+
+        def hybrid():
+            # In-memory layers only reach each other through the same instance
+            inner = backend(**config)
+            return [HybridChannelLayer(inner=inner if shared else backend(**config), capacity=config['capacity'])
+                    for _ in range(options['processes'])]
+
+        results = {}
+        for name, make_layers in (('stock', stock), ('hybrid', hybrid)):
+            delivered, missing, out_of_order, seconds = asyncio.run(self.measure(make_layers(), options))
+            results[name] = delivered / seconds
+            line = (f'{name}: {delivered} messages in {seconds * 1000:.1f} ms '
+                    f'({results[name]:.0f} messages/s), {missing} missing, {out_of_order} out of order')
+            self.stdout.write(self.style.SUCCESS(line) if not missing and not out_of_order else self.style.ERROR(line))
+        self.stdout.write(f"hybrid/stock: {results['hybrid'] / results['stock']:.2f}x")
+
+    async def measure(self, layers, options):
+        groups = [f"benchmark_{index}" for index in range(options['groups'])]
+        members = []
+        for group in groups:
+            for index in range(options['members']):
+                layer = layers[index % len(layers)]
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                members.append((layer, channel))
+        # Roughly the size of an encoded edit broadcast
+        frame = json.dumps({'type': 'edit_delta', 'ops': [{'op': 'insert', 'pos': 1024, 'text': 'x' * 40}],
+                            'revision': 0, 'user_id': 1, 'username': 'benchmark'})
+
+        async def receive(layer, channel):
+            last, missing, out_of_order = -1, 0, 0
+            for _ in range(options['messages']):
+                try:
+                    message = await asyncio.wait_for(layer.receive(channel), timeout=5)
+                except asyncio.TimeoutError:
+                    missing += 1
+                    continue
+                if message['sequence'] <= last:
+                    out_of_order += 1
+                last = message['sequence']
+            return missing, out_of_order
+
+        started = time.perf_counter()
+        receivers = [asyncio.ensure_future(receive(layer, channel)) for layer, channel in members]
+        for sequence in range(options['messages']):
+            for group in groups:
+                await layers[0].group_send(group, {'type': 'broadcast_edit_delta', 'sequence': sequence, 'frame': frame})
+            # Let receivers run, as a busy server would between incoming edits
+            await asyncio.sleep(0)
+        results = await asyncio.gather(*receivers)
+        seconds = time.perf_counter() - started
+
+        missing = sum(result[0] for result in results)
+        out_of_order = sum(result[1] for result in results)
+        for layer in layers:
+            await layer.flush()
+        return len(members) * options['messages'] - missing, missing, out_of_order, seconds
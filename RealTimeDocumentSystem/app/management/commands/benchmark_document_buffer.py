@@ -0,0 +1,80 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.collab.ops import apply_ops, delete, insert
+from app.collab.rope import Rope
+
+
+class Command(BaseCommand):
+    help = ('Compare applying edits to a str with applying them to a Rope for large documents, '
+            'checking that both end with the same text')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,5,10',
+                            help='Comma-separated document sizes in MB')
+        parser.add_argument('--edits', type=int, default=1000,
+                            help='Edits applied to each document')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        for size in options['sizes'].split(','):
+            length = int(float(size) * 1024 * 1024)
+            text = self.make_text(rng, length)
+            edits = self.make_edits(rng, length, options['edits'])
+
+            started = time.perf_counter()
+            content = text
+            for ops in edits:
+                content = apply_ops(content, ops)
+            str_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            rope = Rope(text)
+            build_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            for ops in edits:
+                rope.apply(ops)
+            rope_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            snapshots = [rope.copy() for _ in range(1000)]
+            snapshot_seconds = (time.perf_counter() - started) / len(snapshots)
+            snapshot = snapshots[-1]
+            started = time.perf_counter()
+            final = str(snapshot)
+            to_str_seconds = time.perf_counter() - started
+            matches = final == content
+
+            per_edit = 1e6 / len(edits)
+            line = (f'{size} MB: str {str_seconds * per_edit:.1f} us/edit, '
+                    f'rope {rope_seconds * per_edit:.1f} us/edit '
+                    f'({str_seconds / rope_seconds:.0f}x), '
+                    f'build {build_seconds * 1000:.1f} ms, snapshot {snapshot_seconds * 1e6:.1f} us, '
+                    f'to str {to_str_seconds * 1000:.1f} ms')
+            self.stdout.write(self.style.SUCCESS(line) if matches else self.style.ERROR(line + ', text differs'))
+
+    def make_text(self, rng, length):
+        words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'café']
+        paragraph = ' '.join(rng.choice(words) for _ in range(200)) + '\n'
+        return (paragraph * (length // len(paragraph) + 1))[:length]
+
+    def make_edits(self, rng, length, count):
+        """Mostly typing and backspacing at random places, with the odd paste"""
+        edits = []
+        for _ in range(count):
+            roll = rng.random()
+            if roll < 0.7:
+                text = rng.choice('abcdefghij ')
+                edits.append([insert(rng.randint(0, length), text)])
+                length += 1
+            elif roll < 0.95:
+                pos = rng.randint(1, length)
+                edits.append([delete(pos - 1, 1)])
+                length -= 1
+            else:
+                text = 'pasted text ' * 50
+                edits.append([insert(rng.randint(0, length), text)])
+                length += len(text)
+        return edits
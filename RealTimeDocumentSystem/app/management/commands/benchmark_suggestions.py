@@ -0,0 +1,85 @@
+import itertools
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.suggestions.paragraphs import ParagraphCache
+from app.suggestions.rules import CorrectionsRule, RuleEngine, get_rule_engine
+
+WORDS = (
+    'the quick brown fox jumps over a lazy dog while document editors share their '
+    'changes with every collaborator in real time and nobody loses a single word'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Measure suggestion rule throughput on generated text'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=float, default=1.0,
+                            help='Size of the generated text in megabytes')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of timed runs; the best one is reported')
+        parser.add_argument('--extra-rules', type=int, default=0,
+                            help='Add this many generated corrections to the dictionary')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        engine = get_rule_engine()
+        spelling = next(rule for rule in engine.rules if isinstance(rule, CorrectionsRule))
+        if options['extra_rules']:
+            corrections = dict(spelling.corrections)
+            while len(corrections) < len(spelling.corrections) + options['extra_rules']:
+                word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(5, 12)))
+                corrections.setdefault(word + 'q', word)
+            spelling = CorrectionsRule(corrections)
+            engine = RuleEngine([spelling if isinstance(rule, CorrectionsRule) else rule for rule in engine.rules])
+
+        text = self.generate_text(rng, list(spelling.corrections), int(options['size'] * 1024 * 1024))
+        megabytes = len(text.encode()) / (1024 * 1024)
+        self.stdout.write(f'{megabytes:.2f} MB of text, {len(spelling.corrections)} corrections')
+
+        issues, seconds = self.best_of(options['repeat'], lambda: list(spelling.check(text)))
+        self.stdout.write(f'spelling: {len(issues)} issues in {seconds * 1000:.1f} ms '
+                          f'({megabytes / seconds:.1f} MB/s)')
+        issues, seconds = self.best_of(options['repeat'], lambda: engine.check(text))
+        self.stdout.write(self.style.SUCCESS(
+            f'all rules: {len(issues)} issues in {seconds * 1000:.1f} ms '
+            f'({megabytes / seconds:.1f} MB/s)'))
+
+        # Re-analysis after an edit to one paragraph, alternating between two
+        # versions so that every run has exactly one changed paragraph
+        paragraphs = text.split('\n')
+        middle = len(paragraphs) // 2
+        versions = [text, '\n'.join(paragraphs[:middle] + ['Teh edited paragraph.'] + paragraphs[middle + 1:])]
+        cache = ParagraphCache()
+        cache.check(engine, text)
+        runs = itertools.cycle(versions[::-1])
+        (issues, analyzed), seconds = self.best_of(options['repeat'], lambda: cache.check(engine, next(runs)))
+        self.stdout.write(self.style.SUCCESS(
+            f'after editing one paragraph: {len(issues)} issues in {seconds * 1000:.1f} ms '
+            f'({analyzed} of {len(paragraphs)} paragraphs analyzed)'))
+
+    def generate_text(self, rng, misspellings, size):
+        parts = []
+        length = 0
+        while length < size:
+            words = [rng.choice(misspellings) if rng.random() < 0.02 else rng.choice(WORDS)
+                     for _ in range(rng.randint(5, 20))]
+            # Roughly five sentences to a paragraph
+            sentence = ' '.join(words).capitalize() + ('.\n' if rng.random() < 0.2 else '. ')
+            parts.append(sentence)
+            length += len(sentence)
+        return ''.join(parts)[:size]
+
+    def best_of(self, repeat, run):
+        best = None
+        for _ in range(max(repeat, 1)):
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return result, best
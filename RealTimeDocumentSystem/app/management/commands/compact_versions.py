@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Document, DocumentVersion
+from app.versions import VersionContentCache, build_version
+
+
+class Command(BaseCommand):
+    help = 'Rewrite stored document versions as keyframes plus deltas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--document', type=int, action='append', dest='documents',
+                            help='Only compact this document id (can be repeated)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of versions to update per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the space saved without writing anything')
+
+    def handle(self, *args, **options):
+        documents = Document.objects.order_by('id')
+        if options['documents']:
+            documents = documents.filter(id__in=options['documents'])
+
+        total_before = total_after = 0
+        for document_id in documents.values_list('id', flat=True).iterator():
+            before, after = self.compact_document(document_id, options['batch_size'], options['dry_run'])
+            total_before += before
+            total_after += after
+            if before:
+                self.stdout.write(f'Document {document_id}: {before} -> {after} characters')
+
+        verb = 'Would save' if options['dry_run'] else 'Saved'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total_before - total_after} of {total_before} stored characters'))
+
+    @transaction.atomic
+    def compact_document(self, document_id, batch_size, dry_run):
+        versions = (DocumentVersion.objects.filter(document_id=document_id)
+                    .order_by('version_number'))
+        fields = ['content', 'delta', 'depth', 'parent']
+        before = after = 0
+        batch = []
+        parent = parent_content = None
+
+        for version in versions.iterator(chunk_size=batch_size):
+            # Resolve against the stored chain before it is rewritten
+            content = self.resolve(version, parent, parent_content)
+            before += len(version.content) + len(version.delta)
+
+            compacted = build_version(document_id, content, version.created_by_id, version.version_number,
+                                      parent=parent, parent_content=parent_content)
+            version.content = compacted.content
+            version.delta = compacted.delta
+            version.depth = compacted.depth
+            version.parent_id = compacted.parent_id
+            after += len(version.content) + len(version.delta)
+
+            batch.append(version)
+            if len(batch) >= batch_size:
+                if not dry_run:
+                    DocumentVersion.objects.bulk_update(batch, fields)
+                batch = []
+            parent, parent_content = version, content
+
+        if batch and not dry_run:
+            DocumentVersion.objects.bulk_update(batch, fields)
+        return before, after
+
+    def resolve(self, version, previous, previous_content):
+        cache = VersionContentCache()
+        if previous is not None:
+            cache.contents[previous.pk] = previous_content
+        return cache.get(version)
@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from app.loadtest import LoadTest, compare, load_report
+
+
+class Command(BaseCommand):
+    help = ('Simulate concurrent editors against the document consumer and report latency, '
+            'throughput and database queries as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=5,
+                            help='Number of documents being edited')
+        parser.add_argument('--editors', type=int, default=20,
+                            help='Editors connected to each document')
+        parser.add_argument('--rate', type=float, default=5.0,
+                            help='Edits per second typed by each editor')
+        parser.add_argument('--duration', type=float, default=10.0,
+                            help='Seconds of typing')
+        parser.add_argument('--document-size', type=int, default=10000,
+                            help='Characters in each document before editing starts')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--compare', metavar='REPORT',
+                            help='Print the change in headline numbers against an earlier report')
+
+    def handle(self, *args, **options):
+        load_test = LoadTest(
+            documents=options['documents'],
+            editors=options['editors'],
+            rate=options['rate'],
+            duration=options['duration'],
+            document_size=options['document_size'],
+            seed=options['seed'],
+        )
+        # Runs against a throwaway database, so real data is never touched
+        report = load_test.execute()
+
+        encoded = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(encoded + '\n')
+            broadcast = report['edit_to_broadcast_ms']
+            self.stdout.write(self.style.SUCCESS(
+                f"{report['edits_sent']} edits, p50 {broadcast['p50']} ms, p99 {broadcast['p99']} ms, "
+                f"{report['messages_per_sec']} messages/s, {report['db_queries']['per_edit']} queries/edit"))
+        else:
+            self.stdout.write(encoded)
+
+        if options['compare']:
+            for line in compare(report, load_report(options['compare'])):
+                self.stdout.write(line)
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-18 10:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_alter_document_options_document_collaborators_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='delta',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='app.documentversion'),
+        ),
+    ]
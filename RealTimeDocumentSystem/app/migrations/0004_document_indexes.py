@@ -0,0 +1,48 @@
+# Generated by Django 4.2.20 on 2026-10-18 10:32
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def renumber_duplicate_versions(apps, schema_editor):
+    """
+    Give versions that raced to the same number distinct numbers. The
+    earliest of them keeps the number and the others move after the
+    document's latest version, so numbers that were unique never change.
+    """
+    DocumentVersion = apps.get_model('app', 'DocumentVersion')
+    duplicates = list(DocumentVersion.objects.order_by().values('document_id', 'version_number')
+                      .annotate(count=Count('id')).filter(count__gt=1)
+                      .order_by('document_id', 'version_number'))
+    latest = dict(DocumentVersion.objects.order_by()
+                  .filter(document_id__in={duplicate['document_id'] for duplicate in duplicates})
+                  .values('document_id').annotate(latest=Max('version_number'))
+                  .values_list('document_id', 'latest'))
+    for duplicate in duplicates:
+        document_id = duplicate['document_id']
+        versions = list(DocumentVersion.objects.filter(document_id=document_id,
+                                                       version_number=duplicate['version_number'])
+                        .order_by('created_at', 'id'))[1:]
+        for version in versions:
+            latest[document_id] += 1
+            version.version_number = latest[document_id]
+        DocumentVersion.objects.bulk_update(versions, ['version_number'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_documentversion_delta_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['is_public', '-updated_at'], name='document_public_updated_idx'),
+        ),
+        migrations.RunPython(renumber_duplicate_versions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='documentversion',
+            constraint=models.UniqueConstraint(fields=('document', 'version_number'), name='unique_document_version_number'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-18 10:33
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing_versions(apps, schema_editor):
+    Document = apps.get_model('app', 'Document')
+    DocumentVersion = apps.get_model('app', 'DocumentVersion')
+    latest = (DocumentVersion.objects.filter(document_id=OuterRef('pk')).order_by()
+              .values('document_id').annotate(latest=Max('version_number')).values('latest'))
+    Document.objects.update(version_count=Coalesce(Subquery(latest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_document_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='version_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing_versions, migrations.RunPython.noop),
+    ]
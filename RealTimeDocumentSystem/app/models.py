@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 class Document(models.Model):
     title = models.CharField(max_length=200)
@@ -10,26 +11,49 @@ class Document(models.Model):
     created_at = models.DateTimeField(auto_now=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_public = models.BooleanField(default=False)
+    # Number of the latest version; incremented atomically to number new ones
+    version_count = models.PositiveIntegerField(default=0)
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Public documents, newest first, for listings
+            models.Index(fields=['is_public', '-updated_at'], name='document_public_updated_idx'),
+        ]
     
     def __str__(self):
         return self.title
 
 class DocumentVersion(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='versions')
+    # Full content for keyframes; empty for versions stored as a delta (see app/versions.py)
     content = models.TextField()
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now=True)
     version_number = models.IntegerField()
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    delta = models.TextField(blank=True, default='')
+    depth = models.PositiveIntegerField(default=0)
     
     class Meta:
         ordering = ['-version_number']
+        constraints = [
+            # Its index also serves the latest-version-first lookups per document
+            models.UniqueConstraint(fields=['document', 'version_number'], name='unique_document_version_number'),
+        ]
     
     def __str__(self):
         return f"{self.document.title} - v{self.version_number}"
 
+    @property
+    def is_keyframe(self):
+        return self.depth == 0
+
+    @cached_property
+    def full_content(self):
+        from .versions import VersionContentCache
+        return VersionContentCache().get(self)
+
 class DocumentSession(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -0,0 +1,126 @@
+"""
+Per-connection outbound message queue.
+
+Messages for a client are queued and written out once per tick, several at
+a time, instead of one WebSocket send per event. Messages with a collapse
+key replace the queued message with the same key, so a client only ever
+receives the latest cursor position of a user.
+
+A client is behind when the queue exceeds its maximum depth, or when the
+previous frame has been waiting on the transport for longer than the
+maximum send lag: servers that apply backpressure make ``send`` wait
+while the socket buffer is full. Queued edits are then dropped and
+replaced by a single snapshot of the document built at send time. Replies
+to the client's own requests, like acks, are never dropped.
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOUND_TICK = 0.01
+DEFAULT_OUTBOUND_MAX_QUEUE = 500
+DEFAULT_OUTBOUND_MAX_SEND_LAG = 1.0
+
+# Message kinds
+EDIT = 'edit'
+REPLY = 'reply'
+OTHER = 'other'
+SNAPSHOT = 'snapshot'
+
+
+class OutboundQueue:
+    """
+    ``send_frame`` is awaited with a list of messages on every tick;
+    ``snapshot`` returns the message that replaces dropped edits.
+    """
+
+    def __init__(self, send_frame, snapshot, interval=None, max_depth=None, max_lag=None):
+        self.send_frame = send_frame
+        self.snapshot = snapshot
+        self.interval = interval if interval is not None else getattr(
+            settings, 'COLLAB_OUTBOUND_TICK', DEFAULT_OUTBOUND_TICK)
+        self.max_depth = max_depth if max_depth is not None else getattr(
+            settings, 'COLLAB_OUTBOUND_MAX_QUEUE', DEFAULT_OUTBOUND_MAX_QUEUE)
+        self.max_lag = max_lag if max_lag is not None else getattr(
+            settings, 'COLLAB_OUTBOUND_MAX_SEND_LAG', DEFAULT_OUTBOUND_MAX_SEND_LAG)
+        self.entries = {}
+        self.snapshot_pending = False
+        self._sending_since = None
+        self._counter = itertools.count()
+        self._task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, message, kind=OTHER, key=None):
+        if kind == EDIT and self.snapshot_pending:
+            # The snapshot sent on the next tick already includes this edit
+            return
+        if key is None:
+            key = next(self._counter)
+        else:
+            # Superseded messages are dropped, the new one goes to the back
+            self.entries.pop(key, None)
+        self.entries[key] = (kind, message)
+
+        if len(self.entries) > self.max_depth:
+            logger.warning(f"Outbound queue exceeded {self.max_depth} messages, replacing edits with a snapshot")
+            self._overflow()
+        elif kind == EDIT and self.send_lag() > self.max_lag:
+            logger.warning(f"Outbound frame waited {self.send_lag():.1f}s on the transport, "
+                           f"replacing edits with a snapshot")
+            self._overflow()
+        self._schedule()
+
+    def send_lag(self):
+        """Seconds the frame being sent has been waiting, 0 if none is"""
+        if self._sending_since is None:
+            return 0
+        return time.monotonic() - self._sending_since
+
+    def _overflow(self):
+        self.entries = {
+            key: entry for key, entry in self.entries.items() if entry[0] != EDIT
+        }
+        self.entries[SNAPSHOT] = (SNAPSHOT, None)
+        self.snapshot_pending = True
+        droppable = [key for key, (kind, _) in self.entries.items() if kind == OTHER]
+        for key in droppable[:max(len(self.entries) - self.max_depth, 0)]:
+            del self.entries[key]
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def drain(self):
+        """Take every queued message, building the snapshot if one is due"""
+        entries, self.entries = self.entries, {}
+        self.snapshot_pending = False
+        return [
+            self.snapshot() if kind == SNAPSHOT else message
+            for kind, message in entries.values()
+        ]
+
+    async def _run(self):
+        while self.entries:
+            await asyncio.sleep(self.interval)
+            messages = self.drain()
+            if not messages:
+                continue
+            self._sending_since = time.monotonic()
+            try:
+                await self.send_frame(messages)
+            except Exception as e:
+                logger.error(f"Error sending outbound frame: {str(e)}")
+            finally:
+                self._sending_since = None
+
+    def close(self):
+        self.entries = {}
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,22 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DocumentCursorPagination(CursorPagination):
+    """
+    Pages through documents by position instead of offset, so deep pages
+    cost the same as the first and concurrent edits do not shift entries
+    between pages.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    # The id breaks ties between documents updated at the same moment
+    ordering = ('-updated_at', '-id')
+
+
+class VersionCursorPagination(CursorPagination):
+    """Pages through a document's versions, newest first"""
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = '-version_number'
@@ -0,0 +1,204 @@
+"""
+Registry of who is connected to which document.
+
+Each WebSocket connection registers itself when it joins a document and
+refreshes its entry with a heartbeat; an entry that is not refreshed within
+``ttl`` seconds expires, so connections of a crashed process disappear on
+their own. The registry in use is configured with the COLLAB_PRESENCE
+setting::
+
+    COLLAB_PRESENCE = {
+        'BACKEND': 'app.presence.RedisPresenceRegistry',
+        'OPTIONS': {'url': 'redis://127.0.0.1:6379/2', 'ttl': 60},
+    }
+
+The in-process registry only sees connections of its own process; use the
+Redis one when running more than one ASGI worker.
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_PRESENCE_REGISTRY = 'app.presence.InMemoryPresenceRegistry'
+DEFAULT_PRESENCE_TTL = 60
+
+
+def unique_users(entries):
+    """Distinct users among connection entries, in order of first appearance"""
+    users = {}
+    for entry in entries:
+        users.setdefault(entry['id'], entry)
+    return list(users.values())
+
+
+class PresenceRegistry:
+    """
+    Base class. ``connection_id`` identifies one WebSocket connection (its
+    channel name); a user with two tabs open has two connections but is
+    listed once.
+    """
+
+    def __init__(self, ttl=DEFAULT_PRESENCE_TTL):
+        self.ttl = ttl
+
+    @property
+    def heartbeat_interval(self):
+        # Several heartbeats fit in one TTL, so one late beat does not expire an entry
+        return self.ttl / 3
+
+    def join(self, doc_id, connection_id, user_id, username):
+        raise NotImplementedError
+
+    def heartbeat(self, doc_id, connection_id):
+        raise NotImplementedError
+
+    def leave(self, doc_id, connection_id):
+        raise NotImplementedError
+
+    def users_by_document(self, doc_ids):
+        """Map each document id to the users connected to it"""
+        raise NotImplementedError
+
+    def users(self, doc_id):
+        return self.users_by_document([doc_id])[doc_id]
+
+
+class InMemoryPresenceRegistry(PresenceRegistry):
+    def __init__(self, ttl=DEFAULT_PRESENCE_TTL, clock=time.monotonic):
+        super().__init__(ttl)
+        self.clock = clock
+        # doc_id -> {connection_id: [expires_at, user entry]}
+        self.documents = {}
+        # Consumers and views may use the registry from different threads
+        self.lock = threading.Lock()
+
+    def join(self, doc_id, connection_id, user_id, username):
+        with self.lock:
+            connections = self.documents.setdefault(str(doc_id), {})
+            connections[connection_id] = [self.clock() + self.ttl, {'id': user_id, 'username': username}]
+
+    def heartbeat(self, doc_id, connection_id):
+        with self.lock:
+            entry = self.documents.get(str(doc_id), {}).get(connection_id)
+            if entry is not None:
+                entry[0] = self.clock() + self.ttl
+
+    def leave(self, doc_id, connection_id):
+        with self.lock:
+            connections = self.documents.get(str(doc_id))
+            if connections is None:
+                return
+            connections.pop(connection_id, None)
+            if not connections:
+                del self.documents[str(doc_id)]
+
+    def users_by_document(self, doc_ids):
+        now = self.clock()
+        result = {}
+        with self.lock:
+            for doc_id in doc_ids:
+                connections = self.documents.get(str(doc_id))
+                if not connections:
+                    result[doc_id] = []
+                    continue
+                expired = [key for key, (expires_at, _) in connections.items() if expires_at <= now]
+                for key in expired:
+                    del connections[key]
+                if not connections:
+                    del self.documents[str(doc_id)]
+                result[doc_id] = unique_users(user for _, user in connections.values())
+        return result
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """
+    One key per connection, expiring after ``ttl`` seconds, plus a set per
+    document naming its connections. Listing a document reads the set
+    and fetches the connection keys in one round trip; members whose key has
+    expired are removed from the set on the way.
+    """
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', ttl=DEFAULT_PRESENCE_TTL, prefix='presence', client=None):
+        super().__init__(ttl)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _document_key(self, doc_id):
+        return f'{self.prefix}:{doc_id}'
+
+    def _connection_key(self, doc_id, connection_id):
+        return f'{self.prefix}:{doc_id}:{connection_id}'
+
+    def join(self, doc_id, connection_id, user_id, username):
+        document_key = self._document_key(doc_id)
+        pipe = self.client.pipeline()
+        pipe.set(self._connection_key(doc_id, connection_id),
+                 json.dumps({'id': user_id, 'username': username}), ex=self.ttl)
+        pipe.sadd(document_key, connection_id)
+        # The set outlives its members by one TTL at most
+        pipe.expire(document_key, self.ttl)
+        pipe.execute()
+
+    def heartbeat(self, doc_id, connection_id):
+        pipe = self.client.pipeline()
+        pipe.expire(self._connection_key(doc_id, connection_id), self.ttl)
+        pipe.expire(self._document_key(doc_id), self.ttl)
+        pipe.execute()
+
+    def leave(self, doc_id, connection_id):
+        pipe = self.client.pipeline()
+        pipe.delete(self._connection_key(doc_id, connection_id))
+        pipe.srem(self._document_key(doc_id), connection_id)
+        pipe.execute()
+
+    def users_by_document(self, doc_ids):
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return {}
+        pipe = self.client.pipeline()
+        for doc_id in doc_ids:
+            pipe.smembers(self._document_key(doc_id))
+        members = [(doc_id, self._decode(connection_id))
+                   for doc_id, connection_ids in zip(doc_ids, pipe.execute())
+                   for connection_id in connection_ids]
+
+        result = {doc_id: [] for doc_id in doc_ids}
+        if not members:
+            return result
+        values = self.client.mget([self._connection_key(doc_id, connection_id)
+                                   for doc_id, connection_id in members])
+
+        stale = self.client.pipeline()
+        has_stale = False
+        for (doc_id, connection_id), value in zip(members, values):
+            if value is None:
+                stale.srem(self._document_key(doc_id), connection_id)
+                has_stale = True
+            else:
+                result[doc_id].append(json.loads(value))
+        if has_stale:
+            stale.execute()
+        return {doc_id: unique_users(entries) for doc_id, entries in result.items()}
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+
+_registry = None
+
+
+def get_presence_registry():
+    """The process-wide registry, created from settings on first use"""
+    global _registry
+    if _registry is None:
+        config = getattr(settings, 'COLLAB_PRESENCE', {})
+        registry_class = import_string(config.get('BACKEND', DEFAULT_PRESENCE_REGISTRY))
+        _registry = registry_class(**config.get('OPTIONS', {}))
+    return _registry
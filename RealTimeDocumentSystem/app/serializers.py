@@ -1,13 +1,30 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import Document, DocumentVersion, DocumentSession
+from .versions import VersionContentCache
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
 
-class DocumentSerializer(serializers.ModelSerializer):
+def requested_fields(request):
+    """Field names asked for with ?fields=a,b,c, or None for all fields"""
+    if request is None or 'fields' not in request.query_params:
+        return None
+    return {name.strip() for name in request.query_params['fields'].split(',') if name.strip()}
+
+class SparseFieldsMixin:
+    """Limit the serialized fields to those named in the request's ?fields= parameter"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+class DocumentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     owner = UserSerializer(read_only=True)
     collaborators = UserSerializer(many=True, read_only=True)
     
@@ -15,15 +32,43 @@ class DocumentSerializer(serializers.ModelSerializer):
         model = Document
         fields = ['id', 'title', 'content', 'owner', 'collaborators', 'created_at', 'updated_at', 'is_public']
         read_only_fields = ['owner', 'created_at', 'updated_at']
+    
+    def update(self, instance, validated_data):
+        # Only the fields sent are written; a full save would put back a stale
+        # version_count, which allocate_version_number advances concurrently
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
+class DocumentListSerializer(DocumentSerializer):
+    """Document listings leave out the content"""
+    
+    class Meta(DocumentSerializer.Meta):
+        fields = ['id', 'title', 'owner', 'collaborators', 'created_at', 'updated_at', 'is_public']
 
 class DocumentVersionSerializer(serializers.ModelSerializer):
     created_by = UserSerializer(read_only=True)
+    content = serializers.SerializerMethodField()
+    
+    def get_content(self, obj):
+        # Share one cache across a list so delta chains are replayed once
+        cache = self.context.setdefault('version_contents', VersionContentCache())
+        return cache.get(obj)
     
     class Meta:
         model = DocumentVersion
         fields = ['id', 'content', 'created_by', 'created_at', 'version_number']
         read_only_fields = ['created_by', 'created_at', 'version_number']
 
+class DocumentVersionListSerializer(serializers.ModelSerializer):
+    """Version history entries without content"""
+    created_by = UserSerializer(read_only=True)
+    
+    class Meta:
+        model = DocumentVersion
+        fields = ['id', 'created_by', 'created_at', 'version_number']
+
 class DocumentSessionSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     
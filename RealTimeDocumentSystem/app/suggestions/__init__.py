@@ -0,0 +1,15 @@
+from .analysis import analyze_batch, analyze_text
+from .pool import SuggestionPool, get_suggestion_pool
+from .rules import CorrectionsRule, Issue, Rule, RuleEngine, get_rule_engine
+
+__all__ = [
+    'CorrectionsRule',
+    'Issue',
+    'Rule',
+    'RuleEngine',
+    'SuggestionPool',
+    'analyze_batch',
+    'analyze_text',
+    'get_rule_engine',
+    'get_suggestion_pool',
+]
@@ -0,0 +1,38 @@
+"""
+Writing suggestions for a piece of text.
+
+Analysis is plain CPU work with no I/O, so the pool runs it in worker
+threads on batches of texts from many connections at once. Texts that
+belong to a document are analyzed incrementally, see paragraphs.py.
+"""
+from .paragraphs import get_paragraph_cache
+from .rules import get_rule_engine
+
+MAX_SUGGESTIONS = 3
+MAX_ISSUES = 200
+
+
+def analyze_text(text, document_id=None):
+    """
+    ``suggestions`` holds up to MAX_SUGGESTIONS distinct messages;
+    ``issues`` the first MAX_ISSUES problems with their offsets in text.
+    """
+    engine = get_rule_engine()
+    if document_id is None:
+        issues = engine.check(text)
+    else:
+        issues, _ = get_paragraph_cache(document_id).check(engine, text)
+    suggestions = list(dict.fromkeys(issue.message for issue in issues))
+    return {
+        'suggestions': suggestions[:MAX_SUGGESTIONS],
+        'issues': [issue._asdict() for issue in issues[:MAX_ISSUES]],
+    }
+
+
+def analyze_batch(requests):
+    """Results for each (document_id, text) pair, analyzing identical pairs once"""
+    results = {}
+    for request in requests:
+        if request not in results:
+            results[request] = analyze_text(request[1], request[0])
+    return [results[request] for request in requests]
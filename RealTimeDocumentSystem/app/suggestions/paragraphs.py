@@ -0,0 +1,81 @@
+"""
+Per-paragraph analysis cache.
+
+Clients send the whole text of a document with every suggestion request,
+but between two requests usually only a paragraph or two has changed. The
+issues found in each paragraph are cached per document under a hash of the
+paragraph, so a request only runs the per-paragraph rules on paragraphs
+that are new or edited and shifts the cached issues of the others to their
+current offsets. Splitting and hashing still touch the whole text, but
+that is a small fraction of the cost of running the rules.
+
+Each document keeps only the paragraphs of the text it was last analyzed
+with, and COLLAB_SUGGESTION_CACHE_DOCUMENTS documents are kept per process.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+
+from ..diff import LRUCache
+from .rules import Issue
+
+DEFAULT_SUGGESTION_CACHE_DOCUMENTS = 100
+
+
+def paragraph_key(paragraph):
+    return hashlib.blake2b(paragraph.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class ParagraphCache:
+    """Issues of one document's paragraphs, keyed by paragraph hash"""
+
+    def __init__(self):
+        self.paragraphs = {}
+        self.lock = threading.Lock()
+
+    def check(self, engine, text):
+        """
+        Every issue in text, with offsets into text, plus the number of
+        paragraphs that had to be analyzed.
+        """
+        with self.lock:
+            cached = self.paragraphs
+        current = {}
+        issues = engine.check_text(text)
+        analyzed = 0
+        offset = 0
+        for paragraph in text.split('\n'):
+            key = paragraph_key(paragraph)
+            paragraph_issues = current.get(key)
+            if paragraph_issues is None:
+                paragraph_issues = cached.get(key)
+            if paragraph_issues is None:
+                paragraph_issues = engine.check_paragraph(paragraph)
+                analyzed += 1
+            current[key] = paragraph_issues
+            for start, end, message, replacement in paragraph_issues:
+                issues.append(Issue(start + offset, end + offset, message, replacement))
+            offset += len(paragraph) + 1
+        # Paragraphs that are gone are dropped along with the old mapping
+        with self.lock:
+            self.paragraphs = current
+        return issues, analyzed
+
+
+_caches = None
+_caches_lock = threading.Lock()
+
+
+def get_paragraph_cache(document_id):
+    """The paragraph cache of a document, created on first use"""
+    global _caches
+    with _caches_lock:
+        if _caches is None:
+            _caches = LRUCache(getattr(settings, 'COLLAB_SUGGESTION_CACHE_DOCUMENTS',
+                                       DEFAULT_SUGGESTION_CACHE_DOCUMENTS))
+        cache = _caches.get(str(document_id))
+        if cache is None:
+            cache = ParagraphCache()
+            _caches.set(str(document_id), cache)
+        return cache
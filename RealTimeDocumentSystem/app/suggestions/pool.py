@@ -0,0 +1,155 @@
+"""
+Suggestion requests are queued here instead of being analyzed in the
+consumer's receive loop.
+
+Each connection has at most one queued request: a newer request replaces
+the queued one, and a result that arrives after its connection asked again
+is dropped, so someone typing quickly only gets suggestions for what they
+typed last. A request waits COLLAB_SUGGESTION_DEBOUNCE seconds before it is
+analyzed. Due requests are taken in batches of up to
+COLLAB_SUGGESTION_BATCH_SIZE and analyzed in a pool of
+COLLAB_SUGGESTION_WORKERS threads; while every worker is busy, requests
+keep piling up and form the next, larger batch.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .analysis import analyze_batch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SUGGESTION_WORKERS = 2
+DEFAULT_SUGGESTION_BATCH_SIZE = 32
+DEFAULT_SUGGESTION_DEBOUNCE = 0.3
+
+
+class SuggestionRequest:
+    __slots__ = ('key', 'text', 'document_id', 'future', 'due')
+
+    def __init__(self, key, text, document_id, future, due):
+        self.key = key
+        self.text = text
+        self.document_id = document_id
+        self.future = future
+        self.due = due
+
+
+class SuggestionPool:
+    """
+    ``submit`` returns a future that resolves to the suggestions for a text,
+    or is cancelled if a newer request from the same key supersedes it.
+    ``analyze`` is called in a worker thread with a list of
+    (document_id, text) pairs.
+    """
+
+    def __init__(self, analyze=analyze_batch, workers=None, batch_size=None, debounce=None):
+        self.analyze = analyze
+        self.workers = workers if workers is not None else getattr(
+            settings, 'COLLAB_SUGGESTION_WORKERS', DEFAULT_SUGGESTION_WORKERS)
+        self.batch_size = batch_size if batch_size is not None else getattr(
+            settings, 'COLLAB_SUGGESTION_BATCH_SIZE', DEFAULT_SUGGESTION_BATCH_SIZE)
+        self.debounce = debounce if debounce is not None else getattr(
+            settings, 'COLLAB_SUGGESTION_DEBOUNCE', DEFAULT_SUGGESTION_DEBOUNCE)
+        self.executor = None
+        # key -> request waiting to be analyzed, oldest first
+        self.pending = OrderedDict()
+        # key -> most recent request, queued or being analyzed
+        self.latest = {}
+        self._dispatcher = None
+        self._slots = None
+        self._batches = set()
+
+    def submit(self, key, text, document_id=None):
+        loop = asyncio.get_running_loop()
+        self._ensure_dispatcher(loop)
+        stale = self.pending.pop(key, None)
+        if stale is not None:
+            stale.future.cancel()
+        request = SuggestionRequest(key, text, document_id, loop.create_future(), loop.time() + self.debounce)
+        self.pending[key] = request
+        self.latest[key] = request
+        return request.future
+
+    def discard(self, key):
+        """Forget a key's requests, as when its connection closes"""
+        self.pending.pop(key, None)
+        request = self.latest.pop(key, None)
+        if request is not None:
+            request.future.cancel()
+
+    def _ensure_dispatcher(self, loop):
+        if self._dispatcher is not None and not self._dispatcher.done() and self._dispatcher.get_loop() is loop:
+            return
+        if self._dispatcher is None or self._dispatcher.get_loop() is not loop:
+            # Futures and the semaphore belong to one event loop
+            self.pending.clear()
+            self.latest.clear()
+            self._slots = asyncio.Semaphore(self.workers)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='suggestions')
+        self._dispatcher = loop.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        # Restarted by submit() once it has run dry
+        while self.pending:
+            # Requests are queued in the order they become due
+            first = next(iter(self.pending.values()))
+            delay = first.due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            await self._slots.acquire()
+            now = loop.time()
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                request = next(iter(self.pending.values()))
+                if request.due > now:
+                    break
+                del self.pending[request.key]
+                batch.append(request)
+            if not batch:
+                self._slots.release()
+                continue
+            task = loop.create_task(self._run(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.analyze, [(request.document_id, request.text) for request in batch])
+        except Exception as e:
+            logger.error(f"Error in suggestion batch: {str(e)}")
+            results = None
+        finally:
+            self._slots.release()
+
+        for index, request in enumerate(batch):
+            if self.latest.get(request.key) is not request:
+                # Superseded while it was being analyzed
+                request.future.cancel()
+                continue
+            del self.latest[request.key]
+            if results is None:
+                # Nothing to answer with; the client keeps its last suggestions
+                request.future.cancel()
+            elif not request.future.done():
+                request.future.set_result(results[index])
+        logger.debug(f"Analyzed a batch of {len(batch)} suggestion requests")
+
+
+_pool = None
+
+
+def get_suggestion_pool():
+    """The process-wide pool, created from settings on first use"""
+    global _pool
+    if _pool is None:
+        _pool = SuggestionPool()
+    return _pool
@@ -0,0 +1,171 @@
+"""
+Rules that find problems in text.
+
+Each rule reports Issues with the character offsets they cover, so clients
+can underline them; rules about the text as a whole have no offsets. The
+spelling rule loads its corrections from data files (by default the
+bundled data/corrections.txt, see COLLAB_SUGGESTION_CORRECTIONS) and
+compiles all of them into one regex. The regex is built from a trie of the
+misspellings, so matching at a position follows one path through the trie
+rather than trying every word in turn, and its cost grows far more slowly
+than the dictionary.
+"""
+import itertools
+import os
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+DEFAULT_CORRECTIONS_FILE = os.path.join(os.path.dirname(__file__), 'data', 'corrections.txt')
+
+Issue = namedtuple('Issue', ['start', 'end', 'message', 'replacement'])
+
+
+def load_corrections(path):
+    """
+    Read misspelling->correction lines; blank lines and # comments are
+    skipped. A line may list several corrections separated by commas, as the
+    large published misspelling lists do; the first one is suggested.
+    """
+    corrections = {}
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            misspelling, sep, correction = line.partition('->')
+            correction = correction.split(',')[0].strip()
+            misspelling = misspelling.strip().lower()
+            if not sep or not misspelling or not correction:
+                raise ValueError(f"{path}:{number}: expected 'misspelling->correction'")
+            if misspelling != correction.lower():
+                corrections[misspelling] = correction
+    return corrections
+
+
+def _trie_pattern(node):
+    ends_here = '' in node
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not ends_here:
+        return branches[0]
+    group = '(?:' + '|'.join(branches) + ')'
+    return group + '?' if ends_here else group
+
+
+def compile_word_matcher(words):
+    """One case-insensitive regex matching any of words as a whole word"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word.lower():
+            node = node.setdefault(char, {})
+        node[''] = {}
+    # The lookahead rejects most word starts before entering the trie
+    first_chars = ''.join(re.escape(char) for char in sorted(trie))
+    return re.compile(r'\b(?=[' + first_chars + '])' + _trie_pattern(trie) + r'\b', re.IGNORECASE)
+
+
+def match_case(word, replacement):
+    """Capitalize replacement the way word is capitalized"""
+    if word.isupper() and len(word) > 1:
+        return replacement.upper()
+    if word[:1].isupper():
+        return replacement[:1].upper() + replacement[1:]
+    return replacement
+
+
+class Rule:
+    # Whether the issues found in a paragraph depend only on that paragraph,
+    # so they can be cached and reused while the paragraph is unchanged
+    per_paragraph = True
+
+    def check(self, text):
+        """Yield the Issues found in text"""
+        raise NotImplementedError
+
+
+class ShortTextRule(Rule):
+    per_paragraph = False
+    WORD = re.compile(r'\S+')
+
+    def __init__(self, min_words=3):
+        self.min_words = min_words
+
+    def check(self, text):
+        # Stops looking after min_words words, however long the text
+        words = sum(1 for _ in itertools.islice(self.WORD.finditer(text), self.min_words))
+        if words < self.min_words:
+            yield Issue(None, None, "Consider adding more detail to your sentence.", None)
+
+
+class CorrectionsRule(Rule):
+    def __init__(self, corrections):
+        self.corrections = {misspelling.lower(): correction for misspelling, correction in corrections.items()}
+        self.pattern = compile_word_matcher(self.corrections) if self.corrections else None
+
+    @classmethod
+    def from_files(cls, paths):
+        corrections = {}
+        for path in paths:
+            corrections.update(load_corrections(path))
+        return cls(corrections)
+
+    def check(self, text):
+        if self.pattern is None:
+            return
+        for match in self.pattern.finditer(text):
+            word = match.group()
+            correction = match_case(word, self.corrections[word.lower()])
+            yield Issue(match.start(), match.end(), f"Did you mean '{correction}' instead of '{word}'?", correction)
+
+
+class CapitalizationRule(Rule):
+    FIRST_WORD = re.compile(r'\s*(\w)')
+    # A new line starts a new paragraph, and so a new sentence
+    SENTENCE_START = re.compile(r'[.!?\n]\s*(\w)')
+
+    def check(self, text):
+        first = self.FIRST_WORD.match(text)
+        for match in itertools.chain([first] if first else [], self.SENTENCE_START.finditer(text)):
+            char = match.group(1)
+            if char.islower():
+                yield Issue(match.start(1), match.end(1),
+                            "Consider capitalizing the first letter of your sentence.", char.upper())
+
+
+class RuleEngine:
+    def __init__(self, rules):
+        self.rules = rules
+        self.text_rules = [rule for rule in rules if not rule.per_paragraph]
+        self.paragraph_rules = [rule for rule in rules if rule.per_paragraph]
+
+    def check_text(self, text):
+        """Issues from the rules that look at the text as a whole"""
+        return [issue for rule in self.text_rules for issue in rule.check(text)]
+
+    def check_paragraph(self, paragraph):
+        """Issues from the per-paragraph rules, with offsets into paragraph"""
+        return [issue for rule in self.paragraph_rules for issue in rule.check(paragraph)]
+
+    def check(self, text):
+        """Every issue in text"""
+        return self.check_text(text) + self.check_paragraph(text)
+
+
+_engine = None
+
+
+def get_rule_engine():
+    """The process-wide engine, created from settings on first use"""
+    global _engine
+    if _engine is None:
+        paths = getattr(settings, 'COLLAB_SUGGESTION_CORRECTIONS', [DEFAULT_CORRECTIONS_FILE])
+        _engine = RuleEngine([
+            ShortTextRule(),
+            CorrectionsRule.from_files(paths),
+            CapitalizationRule(),
+        ])
+    return _engine
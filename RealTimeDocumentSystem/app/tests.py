@@ -1,3 +1,1336 @@
-from django.test import TestCase
+import asyncio
+import os
+import random
+import string
+import tempfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import close_old_connections
+from django.db.models.signals import pre_save
+from unittest import skipUnless
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+
+from . import codec, compact
+from .access import can_access_document
+from .channel_layers import HybridChannelLayer
+from .collab import DocumentEngine, InvalidOperation, apply_ops, diff_ops, parse_ops, transform
+from .collab.cursors import CursorCoalescer
+from .collab.cluster import Cluster, HashRing, InMemoryWorkerRegistry, document_group, get_cluster
+from .collab.ops import delete, insert
+from .collab.policy import CoalescingVersionPolicy, VersionTracker, get_version_policy
+from .collab.rope import Rope
+from .collab.state import DocumentStateManager
+from .models import Document, DocumentVersion
+from .outbound import EDIT, REPLY, OutboundQueue
+from .routing import websocket_urlpatterns
+from .presence import InMemoryPresenceRegistry, RedisPresenceRegistry, get_presence_registry
+from .serializers import DocumentVersionSerializer
+from .suggestions import CorrectionsRule, SuggestionPool, analyze_text
+from .suggestions.paragraphs import ParagraphCache
+from .suggestions.rules import DEFAULT_CORRECTIONS_FILE, get_rule_engine, load_corrections
+from .diff import diff_opcodes, diff_texts
+from .loadtest import LOADTEST_DATABASE, LoadTest
+from .versions import allocate_version_number, compute_delta, create_version
+
+# Consumer tests must not depend on the Redis layer configured in settings
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def random_ops(rng, content, count):
+    """Generate ops that apply cleanly to content, one after another"""
+    ops = []
+    for _ in range(count):
+        if content and rng.random() < 0.4:
+            pos = rng.randrange(len(content))
+            length = rng.randint(1, min(5, len(content) - pos))
+            op = delete(pos, length)
+        else:
+            pos = rng.randint(0, len(content))
+            op = insert(pos, ''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(1, 4))))
+        content = apply_ops(content, [op])
+        ops.append(op)
+    return ops
+
+
+class SimulatedClient:
+    """Client side of the delta protocol, mirroring the logic in editor.html"""
+
+    def __init__(self, content, revision):
+        self.synced = content
+        self.revision = revision
+        self.content = content
+        self.pending = None
+        self.unsent = []
+        self.outbox = deque()
+        self.inbox = deque()
+
+    def edit(self, rng):
+        ops = random_ops(rng, self.content, rng.randint(1, 3))
+        self.content = apply_ops(self.content, ops)
+        self.unsent += ops
+
+    def flush(self):
+        if self.pending is None and self.unsent:
+            self.pending, self.unsent = self.unsent, []
+            self.outbox.append((self.revision, self.pending))
+
+    def deliver(self):
+        kind, revision, ops = self.inbox.popleft()
+        if kind == 'ack':
+            self.synced = apply_ops(self.synced, self.pending)
+            self.pending = None
+        else:
+            self.synced = apply_ops(self.synced, ops)
+            if self.pending is not None:
+                self.pending, ops = transform(self.pending, ops)
+            self.unsent, ops = transform(self.unsent, ops)
+            self.content = apply_ops(self.content, ops)
+        self.revision = revision
+
+
+class OpsTests(SimpleTestCase):
+    def test_transform_converges_for_random_pairs(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            base = ''.join(rng.choice('abcdef') for _ in range(rng.randint(0, 12)))
+            ops_a = random_ops(rng, base, rng.randint(1, 3))
+            ops_b = random_ops(rng, base, rng.randint(1, 3))
+            a_prime, b_prime = transform(ops_a, ops_b)
+            self.assertEqual(
+                apply_ops(apply_ops(base, ops_b), a_prime),
+                apply_ops(apply_ops(base, ops_a), b_prime),
+            )
+
+    def test_delete_spanning_concurrent_insert_keeps_insert(self):
+        ops, _ = transform([delete(1, 4)], [insert(3, 'XY')])
+        self.assertEqual(apply_ops(apply_ops('abcdef', [insert(3, 'XY')]), ops), 'aXYf')
+
+    def test_malformed_ops_are_rejected(self):
+        for raw_ops in ({'op': 'insert'}, [{'op': 'insert', 'pos': -1, 'text': 'x'}], [{'op': 'insert', 'pos': 0}],
+                        [{'op': 'delete', 'pos': 0, 'length': True}], [{'op': 'move', 'pos': 0}], ['insert'],
+                        [insert(0, 'x')] * 201):
+            with self.subTest(raw_ops=raw_ops), self.assertRaises(InvalidOperation):
+                parse_ops(raw_ops)
+        with self.assertRaises(InvalidOperation):
+            apply_ops('abc', [delete(2, 5)])
+
+    def test_diff_ops_round_trips(self):
+        for old, new in [('', 'abc'), ('abc', ''), ('hello world', 'hello brave world'), ('aaa', 'aa')]:
+            self.assertEqual(apply_ops(old, diff_ops(old, new)), new)
+
+
+class RopeTests(SimpleTestCase):
+    def assertBalanced(self, node):
+        if node is None or node.height == 0:
+            return
+        self.assertLessEqual(abs(node.left.height - node.right.height), 1)
+        self.assertEqual(node.length, node.left.length + node.right.length)
+        self.assertBalanced(node.left)
+        self.assertBalanced(node.right)
+
+    def test_edits_match_string_edits(self):
+        rng = random.Random(3)
+        content = ''.join(rng.choice('ab\u00e9\n') for _ in range(5000))
+        text = Rope(content)
+        for _ in range(500):
+            if content and rng.random() < 0.4:
+                pos = rng.randrange(len(content))
+                ops = [delete(pos, rng.randint(1, min(len(content) - pos, rng.choice([1, 3000]))))]
+            else:
+                ops = [insert(rng.randint(0, len(content)), 'x' * rng.choice([1, 40, 2500]))]
+            content = apply_ops(content, ops)
+            text.apply(ops)
+            self.assertBalanced(text.root)
+        self.assertEqual(str(text), content)
+        self.assertEqual(len(text), len(content))
+
+    def test_snapshots_and_failed_edits_leave_text_unchanged(self):
+        text = Rope('hello world')
+        snapshot = text.copy()
+        text.insert(5, ' there')
+        text.delete(0, 6)
+        with self.assertRaises(InvalidOperation):
+            text.apply([insert(0, 'oh '), delete(100, 1)])
+        self.assertEqual(str(text), 'there world')
+        self.assertEqual(str(snapshot), 'hello world')
+
+
+class EngineConvergenceTests(SimpleTestCase):
+    def run_session(self, seed, clients=4, steps=600):
+        rng = random.Random(seed)
+        engine = DocumentEngine('The quick brown fox')
+        peers = [SimulatedClient(engine.content, engine.revision) for _ in range(clients)]
+
+        def serve(sender):
+            base_revision, ops = sender.outbox.popleft()
+            revision, applied = engine.apply(base_revision, ops)
+            for peer in peers:
+                if peer is sender:
+                    peer.inbox.append(('ack', revision, None))
+                else:
+                    peer.inbox.append(('ops', revision, applied))
+
+        for _ in range(steps):
+            peer = rng.choice(peers)
+            action = rng.random()
+            if action < 0.4:
+                peer.edit(rng)
+            elif action < 0.6:
+                peer.flush()
+            elif action < 0.8 and peer.outbox:
+                serve(peer)
+            elif peer.inbox:
+                peer.deliver()
+
+        # Drain the network until every client is idle
+        while any(p.unsent or p.pending is not None or p.outbox or p.inbox for p in peers):
+            for peer in peers:
+                while peer.inbox:
+                    peer.deliver()
+                peer.flush()
+                while peer.outbox:
+                    serve(peer)
+
+        for peer in peers:
+            self.assertEqual(peer.content, engine.content)
+            self.assertEqual(peer.revision, engine.revision)
+
+    def test_random_concurrent_sessions_converge(self):
+        for seed in range(25):
+            with self.subTest(seed=seed):
+                self.run_session(seed)
+
+
+@override_settings(DOCUMENT_VERSION_KEYFRAME_INTERVAL=4)
+class VersionStorageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='writer')
+        self.document = Document.objects.create(title='Notes', owner=self.user)
+        rng = random.Random(3)
+        lines = [f'line {i}\n' for i in range(50)]
+        self.contents = []
+        for _ in range(10):
+            lines[rng.randrange(len(lines))] = f'edited {rng.random()}\n'
+            self.contents.append(''.join(lines))
+
+    def test_compute_delta_round_trips(self):
+        for old, new in zip(self.contents, self.contents[1:]):
+            self.assertEqual(apply_ops(old, compute_delta(old, new)), new)
+
+    def test_versions_are_keyframes_every_interval(self):
+        parent = None
+        for content in self.contents:
+            parent = create_version(self.document.id, content, self.user.id, parent=parent)
+
+        versions = DocumentVersion.objects.filter(document=self.document).order_by('version_number')
+        self.assertEqual([v.depth for v in versions], [0, 1, 2, 3, 0, 1, 2, 3, 0, 1])
+        self.assertEqual(versions[3].content, '')
+        data = DocumentVersionSerializer(DocumentVersion.objects.filter(document=self.document), many=True).data
+        self.assertEqual([item['content'] for item in data], self.contents[::-1])
+
+    def test_compact_versions_command(self):
+        for number, content in enumerate(self.contents, start=1):
+            DocumentVersion.objects.create(document=self.document, content=content,
+                                           created_by=self.user, version_number=number)
+
+        call_command('compact_versions', stdout=StringIO())
+
+        versions = DocumentVersion.objects.filter(document=self.document).order_by('version_number')
+        self.assertEqual(sum(1 for v in versions if v.is_keyframe), 3)
+        self.assertEqual([v.full_content for v in versions], self.contents)
+
+
+class VersionPolicyTests(SimpleTestCase):
+    def setUp(self):
+        self.policy = CoalescingVersionPolicy(idle_seconds=30, min_changes=20, max_ops=100, max_interval=300)
+        self.tracker = VersionTracker(last_version_at=1000.0)
+
+    def type_characters(self, count, start):
+        for i in range(count):
+            self.tracker.record([insert(i, 'x')], start + i)
+
+    def test_no_version_without_changes(self):
+        self.assertFalse(self.policy.should_create_version(self.tracker, 5000.0, final=True))
+
+    def test_first_edit_of_unversioned_document(self):
+        tracker = VersionTracker()
+        tracker.record([insert(0, 'a')], 10.0)
+        self.assertTrue(self.policy.should_create_version(tracker, 10.0))
+
+    def test_burst_is_versioned_after_idle_period(self):
+        self.type_characters(25, start=1010.0)
+        self.assertFalse(self.policy.should_create_version(self.tracker, 1040.0))
+        self.assertTrue(self.policy.should_create_version(self.tracker, 1064.0))
+
+    def test_small_change_waits_for_interval(self):
+        self.type_characters(5, start=1010.0)
+        self.assertFalse(self.policy.should_create_version(self.tracker, 1100.0))
+        self.assertTrue(self.policy.should_create_version(self.tracker, 1300.0))
+
+    def test_continuous_typing_is_capped_by_op_count(self):
+        self.type_characters(100, start=1010.0)
+        self.assertTrue(self.policy.should_create_version(self.tracker, 1110.0))
+
+    def test_last_editor_leaving_creates_version(self):
+        self.type_characters(1, start=1010.0)
+        self.assertTrue(self.policy.should_create_version(self.tracker, 1011.0, final=True))
+        self.tracker.reset(1011.0)
+        self.assertFalse(self.tracker.has_changes)
+
+    @override_settings(COLLAB_VERSION_POLICY={
+        'BACKEND': 'app.collab.policy.CoalescingVersionPolicy',
+        'OPTIONS': {'idle_seconds': 5},
+    })
+    def test_policy_is_configured_from_settings(self):
+        policy = get_version_policy()
+        self.assertIsInstance(policy, CoalescingVersionPolicy)
+        self.assertEqual(policy.idle_seconds, 5)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def make_queue(self, max_depth=10):
+        self.frames = []
+
+        async def send_frame(messages):
+            self.frames.append(messages)
+
+        return OutboundQueue(send_frame, lambda: {'type': 'sync'}, interval=0.001, max_depth=max_depth)
+
+    async def test_messages_are_batched_per_tick(self):
+        queue = self.make_queue()
+        for revision in range(3):
+            queue.put({'type': 'edit_delta', 'revision': revision}, kind=EDIT)
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.frames), 1)
+        self.assertEqual([m['revision'] for m in self.frames[0]], [0, 1, 2])
+
+    async def test_superseded_messages_collapse(self):
+        queue = self.make_queue()
+        for position in range(5):
+            queue.put({'type': 'cursor_move', 'cursor_position': position}, key=('cursor', 1))
+        queue.put({'type': 'user_joined'})
+        self.assertEqual(queue.drain(), [{'type': 'cursor_move', 'cursor_position': 4}, {'type': 'user_joined'}])
+        queue.close()
+
+    async def test_overflow_replaces_edits_with_snapshot(self):
+        queue = self.make_queue(max_depth=3)
+        queue.put({'type': 'user_joined'})
+        queue.put({'type': 'edit_ack', 'revision': 0}, kind=REPLY)
+        for revision in range(1, 6):
+            queue.put({'type': 'edit_delta', 'revision': revision}, kind=EDIT)
+        queue.put({'type': 'edit_ack', 'revision': 6}, kind=REPLY)
+        self.assertEqual(queue.drain(), [
+            {'type': 'edit_ack', 'revision': 0}, {'type': 'sync'}, {'type': 'edit_ack', 'revision': 6}])
+        queue.close()
+
+    async def test_slow_transport_replaces_edits_with_snapshot(self):
+        sent = []
+        transport = asyncio.Event()
+
+        async def send_frame(messages):
+            sent.append(messages)
+            await transport.wait()
+
+        queue = OutboundQueue(send_frame, lambda: {'type': 'sync'}, interval=0.001, max_lag=0.02)
+        queue.put({'type': 'edit_delta', 'revision': 0}, kind=EDIT)
+        await asyncio.sleep(0.01)
+        # The first frame is stuck in the socket buffer
+        queue.put({'type': 'edit_delta', 'revision': 1}, kind=EDIT)
+        await asyncio.sleep(0.05)
+        queue.put({'type': 'edit_delta', 'revision': 2}, kind=EDIT)
+        queue.put({'type': 'edit_ack', 'revision': 3}, kind=REPLY)
+        transport.set()
+        await asyncio.sleep(0.05)
+        self.assertEqual(sent, [
+            [{'type': 'edit_delta', 'revision': 0}],
+            [{'type': 'sync'}, {'type': 'edit_ack', 'revision': 3}],
+        ])
+        queue.close()
+
+
+class CursorCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.frames = []
+
+        async def send_frame(cursors):
+            self.frames.append(cursors)
+
+        self.cursors = CursorCoalescer(send_frame, interval=0.01)
+
+    async def test_moves_within_a_tick_are_coalesced(self):
+        for position in range(5):
+            self.cursors.update('tab-1', 1, 'ann', position)
+        self.cursors.update('tab-2', 2, 'bob', 7)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.frames, [[{'user_id': 1, 'username': 'ann', 'cursor_position': 4},
+                                        {'user_id': 2, 'username': 'bob', 'cursor_position': 7}]])
+        # Nothing moved since
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.frames), 1)
+
+    async def test_closing_one_tab_keeps_the_users_other_tabs(self):
+        self.cursors.update('tab-1', 1, 'ann', 3)
+        self.cursors.update('tab-2', 1, 'ann', 9)
+        self.cursors.discard('tab-1')
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.frames, [[{'user_id': 1, 'username': 'ann', 'cursor_position': 9}]])
+
+
+class SuggestionPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+        def analyze(requests):
+            texts = [text for _, text in requests]
+            self.batches.append(texts)
+            self.gate.wait(1)
+            return [[text.upper()] for text in texts]
+
+        return SuggestionPool(analyze, workers=1, batch_size=kwargs.pop('batch_size', 10), debounce=0.01, **kwargs)
+
+    async def test_newer_request_replaces_queued_one(self):
+        pool = self.make_pool()
+        first = pool.submit('conn-a', 'old')
+        second = pool.submit('conn-a', 'new')
+        other = pool.submit('conn-b', 'other')
+        self.assertEqual(await second, ['NEW'])
+        self.assertEqual(await other, ['OTHER'])
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.batches, [['new', 'other']])
+
+    async def test_result_superseded_during_analysis_is_dropped(self):
+        pool = self.make_pool(batch_size=1)
+        self.gate.clear()
+        first = pool.submit('conn-a', 'old')
+        while not self.batches:
+            await asyncio.sleep(0.005)
+        second = pool.submit('conn-a', 'new')
+        self.gate.set()
+        self.assertEqual(await second, ['NEW'])
+        self.assertTrue(first.cancelled())
+
+    async def test_discard_cancels_requests(self):
+        pool = self.make_pool()
+        future = pool.submit('conn-a', 'text')
+        pool.discard('conn-a')
+        await asyncio.sleep(0.05)
+        self.assertTrue(future.cancelled())
+        self.assertEqual(self.batches, [])
+
+    def test_analysis(self):
+        text = 'I will recieve teh letter. it came from Tehran'
+        result = analyze_text(text)
+        self.assertEqual(result['suggestions'], [
+            "Did you mean 'receive' instead of 'recieve'?",
+            "Did you mean 'the' instead of 'teh'?",
+            "Consider capitalizing the first letter of your sentence.",
+        ])
+        self.assertEqual([(text[issue['start']:issue['end']], issue['replacement']) for issue in result['issues']],
+                         [('recieve', 'receive'), ('teh', 'the'), ('i', 'I')])
+
+
+class RuleEngineTests(SimpleTestCase):
+    def test_only_whole_words_match(self):
+        rule = CorrectionsRule({'teh': 'the', 'tehr': 'there'})
+        text = 'Teh tehran TEH tehr teh_ teh.'
+        self.assertEqual([(issue.start, issue.replacement) for issue in rule.check(text)],
+                         [(0, 'The'), (11, 'THE'), (15, 'there'), (25, 'the')])
+
+    def test_bundled_corrections_load(self):
+        corrections = load_corrections(DEFAULT_CORRECTIONS_FILE)
+        self.assertGreater(len(corrections), 200)
+        self.assertEqual(corrections['accomodate'], 'accommodate')
+        self.assertFalse(set(corrections) & set(corrections.values()))
+
+    def test_large_external_list(self):
+        rng = random.Random(0)
+        lines = ['# external list', 'acn->can, acne', 'teh->the']
+        for _ in range(20000):
+            word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12)))
+            lines.append(f'{word}q->{word}')
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', encoding='utf-8', delete=False) as f:
+            f.write('\n'.join(lines))
+        self.addCleanup(os.remove, f.name)
+
+        rule = CorrectionsRule.from_files([DEFAULT_CORRECTIONS_FILE, f.name])
+        self.assertGreater(len(rule.corrections), 20000)
+        misspelling, _, correction = lines[-1].partition('->')
+        self.assertEqual([issue.replacement for issue in rule.check(f'Acn {misspelling} accomodate')],
+                         ['Can', correction, 'accommodate'])
+
+
+class ParagraphCacheTests(SimpleTestCase):
+    def test_only_changed_paragraphs_are_analyzed(self):
+        engine = get_rule_engine()
+        cache = ParagraphCache()
+        paragraphs = [f'Paragraph {i} has teh usual words. it goes on' for i in range(20)]
+        text = '\n'.join(paragraphs)
+        issues, analyzed = cache.check(engine, text)
+        self.assertEqual(analyzed, 20)
+        self.assertEqual(sorted(issues), sorted(engine.check(text)))
+
+        paragraphs[5] = 'An recieved edit'
+        edited = '\n'.join(paragraphs)
+        issues, analyzed = cache.check(engine, edited)
+        self.assertEqual(analyzed, 1)
+        self.assertEqual(sorted(issues), sorted(engine.check(edited)))
+        self.assertEqual([edited[issue.start:issue.end] for issue in issues if issue.replacement == 'received'],
+                         ['recieved'])
+
+
+class CodecTests(SimpleTestCase):
+    def test_batch_of_encoded_frames_decodes(self):
+        messages = [{'type': 'edit_delta', 'ops': [insert(0, 'h\u00e9')]}, {'type': 'presence', 'cursors': []}]
+        frame = codec.join_batch([codec.dumps(message) for message in messages])
+        self.assertEqual(codec.loads(frame), {'type': 'batch', 'messages': messages})
+
+
+class CompactProtocolTests(SimpleTestCase):
+    def decode(self, frame):
+        payload = zlib.decompress(frame[1:]) if frame[0] & compact.FLAG_ZLIB else frame[1:]
+        return codec.loads(payload)
+
+    def test_messages_become_arrays_and_batches(self):
+        _, protocol = compact.negotiate(['chat', 'collab.compact'])
+        delta = {'type': 'edit_delta', 'ops': [insert(3, 'h\u00e9'), delete(0, 2)], 'revision': 7,
+                 'cursor_position': 5, 'user_id': 2, 'username': 'bob'}
+        encoded, users = protocol.transcode(codec.dumps(delta))
+        self.assertEqual(users, [(2, 'bob')])
+        frame = protocol.frame([encoded, protocol.dumps({'error': 'Invalid JSON format'})])
+        self.assertEqual(self.decode(frame), [0, [3, 7, [[3, 'h\u00e9'], [0, 2]], 5, 2], [10, 'Invalid JSON format']])
+
+        edit = protocol.loads(b'\x00' + codec.dumps([3, 7, [[3, 'x'], [0, 2]], 4]).encode())
+        self.assertEqual(edit, {'type': 'edit_delta', 'base_revision': 7, 'ops': [insert(3, 'x'), delete(0, 2)],
+                                'cursor_position': 4})
+        with self.assertRaises(compact.DecodeError):
+            protocol.loads(b'\x00[42]')
+
+    def test_large_frames_are_compressed(self):
+        name, protocol = compact.negotiate(['collab.compact+zlib'])
+        self.assertEqual(name, 'collab.compact+zlib')
+        small = protocol.frame([protocol.dumps({'type': 'edit_ack', 'revision': 1})])
+        self.assertEqual(small[0], 0)
+        large = protocol.frame([protocol.dumps({'type': 'sync', 'content': 'hello ' * 1000, 'revision': 1,
+                                                'epoch': 'e'})])
+        self.assertEqual(large[0], compact.FLAG_ZLIB)
+        self.assertEqual(self.decode(large), [1, 1, 'hello ' * 1000, 'e'])
+        self.assertEqual(compact.negotiate(['chat']), (None, None))
+
+    def test_oversized_client_frames_are_rejected(self):
+        protocol = compact.BinaryProtocol(compact.get_serializer('json'), compress=True, max_frame=1024)
+        fits = codec.dumps([3, 0, [[0, 'x' * 900]], 0]).encode()
+        self.assertEqual(protocol.loads(bytes([compact.FLAG_ZLIB]) + zlib.compress(fits))['ops'],
+                         [insert(0, 'x' * 900)])
+        bomb = codec.dumps([3, 0, [[0, 'x' * 1000000]], 0]).encode()
+        with self.assertRaises(compact.DecodeError):
+            protocol.loads(bytes([compact.FLAG_ZLIB]) + zlib.compress(bomb))
+        # Trailing data after the compressed stream
+        with self.assertRaises(compact.DecodeError):
+            protocol.loads(bytes([compact.FLAG_ZLIB]) + zlib.compress(fits) + b'junk')
+
+    @skipUnless(compact.msgpack is not None, 'msgpack is not installed')
+    def test_msgpack_batches(self):
+        _, protocol = compact.negotiate(['collab.msgpack'])
+        messages = [{'type': 'edit_ack', 'revision': index} for index in range(20)]
+        frame = protocol.frame([protocol.dumps(message) for message in messages])
+        self.assertEqual(compact.msgpack.unpackb(frame[1:]), [0] + [[2, index] for index in range(20)])
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        # Two processes sharing one wrapped layer
+        self.shared = InMemoryChannelLayer()
+        self.sent_through_shared = []
+        group_send = self.shared.group_send
+
+        async def record(group, message):
+            self.sent_through_shared.append(message)
+            await group_send(group, message)
+
+        self.shared.group_send = record
+        self.first = HybridChannelLayer(inner=self.shared)
+        self.second = HybridChannelLayer(inner=self.shared)
+
+    async def join(self, layer, group='document_1'):
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        return channel
+
+    async def test_local_members_are_served_in_process(self):
+        channels = [await self.join(self.first) for _ in range(3)]
+        for sequence in range(5):
+            await self.first.group_send('document_1', {'type': 'edit', 'sequence': sequence})
+        for channel in channels:
+            received = [(await self.first.receive(channel))['sequence'] for _ in range(5)]
+            self.assertEqual(received, [0, 1, 2, 3, 4])
+        # One publish per message, not one per member
+        self.assertEqual(len(self.sent_through_shared), 5)
+        # The sender's process does not deliver its own messages twice
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.first.receive(channels[0]), 0.05)
+
+    async def test_remote_members_receive_in_order(self):
+        local = await self.join(self.first)
+        remote = await self.join(self.second)
+        for sequence in range(5):
+            await self.first.group_send('document_1', {'type': 'edit', 'sequence': sequence})
+        self.assertEqual([(await self.first.receive(local))['sequence'] for _ in range(5)], [0, 1, 2, 3, 4])
+        received = [(await asyncio.wait_for(self.second.receive(remote), 1))['sequence'] for _ in range(5)]
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+
+    async def test_members_receive_messages_sent_right_after_joining(self):
+        await self.join(self.first)
+        for _ in range(20):
+            newcomer = await self.join(self.second)
+            await self.first.group_send('document_1', {'type': 'edit'})
+            self.assertEqual((await asyncio.wait_for(self.second.receive(newcomer), 1))['type'], 'edit')
+            await self.second.group_discard('document_1', newcomer)
+
+    async def test_direct_send_and_leaving_the_group(self):
+        channel = await self.join(self.first)
+        other = await self.join(self.second)
+        await self.second.send(channel, {'type': 'direct'})
+        self.assertEqual((await asyncio.wait_for(self.first.receive(channel), 1))['type'], 'direct')
+
+        await self.second.group_discard('document_1', other)
+        await self.first.group_send('document_1', {'type': 'edit'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.second.receive(other), 0.05)
+
+    async def test_process_without_members_publishes(self):
+        channel = await self.join(self.first)
+        await self.second.group_send('document_1', {'type': 'edit'})
+        self.assertEqual((await asyncio.wait_for(self.first.receive(channel), 1))['type'], 'edit')
+
+
+class AccessCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create(username='owner')
+        self.guest = User.objects.create(username='guest')
+        self.document = Document.objects.create(title='Plans', owner=self.owner)
+
+    def test_decisions_are_cached(self):
+        self.assertTrue(can_access_document(self.owner, self.document.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(can_access_document(self.owner, self.document.id))
+            self.assertTrue(can_access_document(self.owner, self.document.id))
+
+    def test_collaborator_changes_invalidate(self):
+        self.assertFalse(can_access_document(self.guest, self.document.id))
+        self.document.collaborators.add(self.guest)
+        self.assertTrue(can_access_document(self.guest, self.document.id))
+        self.guest.collaborated_documents.clear()
+        self.assertFalse(can_access_document(self.guest, self.document.id))
+
+    def test_visibility_change_invalidates(self):
+        self.assertFalse(can_access_document(self.guest, self.document.id))
+        self.document.is_public = True
+        self.document.save()
+        self.assertTrue(can_access_document(self.guest, self.document.id))
+
+    def test_missing_document_and_anonymous_user(self):
+        self.assertFalse(can_access_document(self.owner, self.document.id + 1))
+        self.assertFalse(can_access_document(AnonymousUser(), self.document.id))
+
+    @override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'worker'},
+            'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+        },
+        ACCESS_CACHE_ALIAS='shared',
+    )
+    def test_decisions_live_in_the_configured_cache(self):
+        self.document.collaborators.add(self.guest)
+        self.assertTrue(can_access_document(self.guest, self.document.id))
+        self.assertIsNone(caches['default'].get(f'doc_access_gen:{self.document.id}'))
+        # What a revocation in another worker leaves in the shared cache
+        caches['shared'].incr(f'doc_access_gen:{self.document.id}')
+        Document.collaborators.through.objects.filter(user=self.guest).delete()
+        self.assertFalse(can_access_document(self.guest, self.document.id))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """The few Redis commands the presence registry uses, with key expiry"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+
+    def _get(self, key):
+        if key in self.expires and self.expires[key] <= self.clock():
+            self.delete(key)
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+        self.expire(key, ex)
+
+    def expire(self, key, seconds):
+        if self._get(key) is not None and seconds is not None:
+            self.expires[key] = self.clock() + seconds
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def sadd(self, key, member):
+        members = self._get(key)
+        if members is None:
+            members = self.data[key] = set()
+        members.add(member.encode())
+
+    def srem(self, key, member):
+        members = self._get(key)
+        if members is not None:
+            members.discard(member.encode())
+
+    def smembers(self, key):
+        return set(self._get(key) or ())
+
+    def mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    def registries(self):
+        self.clock = FakeClock()
+        yield InMemoryPresenceRegistry(ttl=60, clock=self.clock)
+        self.clock = FakeClock()
+        yield RedisPresenceRegistry(ttl=60, client=FakeRedis(self.clock))
+
+    def test_users_are_listed_once_per_document(self):
+        for registry in self.registries():
+            with self.subTest(registry=type(registry).__name__):
+                registry.join(1, 'conn-a', 7, 'ann')
+                registry.join(1, 'conn-b', 7, 'ann')
+                registry.join(1, 'conn-c', 8, 'bob')
+                registry.join(2, 'conn-d', 8, 'bob')
+                registry.leave(1, 'conn-c')
+                self.assertEqual(registry.users_by_document([1, 2, 3]), {
+                    1: [{'id': 7, 'username': 'ann'}],
+                    2: [{'id': 8, 'username': 'bob'}],
+                    3: [],
+                })
+
+    def test_entries_expire_without_heartbeat(self):
+        for registry in self.registries():
+            with self.subTest(registry=type(registry).__name__):
+                registry.join(1, 'conn-a', 7, 'ann')
+                registry.join(1, 'conn-b', 8, 'bob')
+                self.clock.now += 40
+                registry.heartbeat(1, 'conn-a')
+                self.clock.now += 40
+                self.assertEqual(registry.users(1), [{'id': 7, 'username': 'ann'}])
+                self.clock.now += 60
+                self.assertEqual(registry.users(1), [])
+
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='ann')
+        other = User.objects.create(username='bob')
+        self.owned = Document.objects.create(title='Owned', owner=self.user)
+        shared = Document.objects.create(title='Shared', owner=other)
+        shared.collaborators.add(self.user)
+        Document.objects.create(title='Public', owner=other, is_public=True)
+        Document.objects.create(title='Hidden', owner=other)
+        self.client.force_login(self.user)
+
+    def test_lists_come_from_one_query_and_are_cached(self):
+        # Session and user lookups plus one query for every document list
+        with self.assertNumQueries(3):
+            response = self.client.get('/')
+        self.assertContains(response, 'Owned')
+        self.assertContains(response, 'Shared')
+        self.assertContains(response, 'Public')
+        self.assertNotContains(response, 'Hidden')
+        with self.assertNumQueries(2):
+            self.client.get('/')
+
+    def test_document_changes_invalidate_cached_lists(self):
+        self.client.get('/')
+        Document.objects.create(title='Fresh', owner=self.user)
+        self.assertContains(self.client.get('/'), 'Fresh')
+
+    def test_active_users_are_current(self):
+        self.client.get('/')
+        registry = get_presence_registry()
+        registry.join(self.owned.id, 'conn-dashboard', self.user.id, 'ann')
+        try:
+            self.assertContains(self.client.get('/'), 'Active users')
+        finally:
+            registry.leave(self.owned.id, 'conn-dashboard')
+        self.assertNotContains(self.client.get('/'), 'Active users')
+
+
+class DocumentApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        other = User.objects.create(username='bob')
+        for i in range(5):
+            document = Document.objects.create(title=f'Doc {i}', content='x' * 1000, owner=self.user)
+            document.collaborators.add(other)
+        Document.objects.create(title='Public', owner=other, is_public=True)
+        Document.objects.create(title='Hidden', owner=other)
+        self.client.force_login(self.user)
+
+    def test_list_is_paginated_without_content(self):
+        # Session, user, one page of documents and their collaborators
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/documents/', {'page_size': 4})
+        page = response.json()
+        self.assertEqual(len(page['results']), 4)
+        self.assertNotIn('content', page['results'][0])
+        shared = next(item for item in page['results'] if item['title'].startswith('Doc'))
+        self.assertEqual(shared['collaborators'][0]['username'], 'bob')
+
+        titles = [item['title'] for item in page['results']]
+        while page['next']:
+            page = self.client.get(page['next']).json()
+            titles += [item['title'] for item in page['results']]
+        self.assertEqual(sorted(titles), ['Doc 0', 'Doc 1', 'Doc 2', 'Doc 3', 'Doc 4', 'Public'])
+
+    def test_update_keeps_concurrently_allocated_version_numbers(self):
+        document = Document.objects.filter(owner=self.user).first()
+        create_version(document.id, 'first', self.user.id)
+
+        def concurrent_save(sender, instance, **kwargs):
+            # Another writer stores a version after the view loaded the document
+            if instance.pk == document.pk:
+                pre_save.disconnect(concurrent_save, sender=Document)
+                create_version(document.id, 'second', self.user.id)
+
+        pre_save.connect(concurrent_save, sender=Document)
+        self.addCleanup(pre_save.disconnect, concurrent_save, sender=Document)
+        response = self.client.patch(f'/api/documents/{document.id}/', {'is_public': True},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(create_version(document.id, 'third', self.user.id).version_number, 3)
+        document.refresh_from_db()
+        self.assertEqual((document.version_count, document.is_public), (3, True))
+
+    def test_sparse_fieldsets(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/documents/', {'fields': 'id,title'})
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'title'})
+
+        document = Document.objects.filter(owner=self.user).first()
+        response = self.client.get(f'/api/documents/{document.id}/', {'fields': 'title,content'})
+        self.assertEqual(response.json(), {'title': document.title, 'content': document.content})
+
+
+@override_settings(DOCUMENT_VERSION_KEYFRAME_INTERVAL=4)
+class HotPathQueryTests(TestCase):
+    """Query counts of the busiest views; a change here is likely a regression"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', content='hello', owner=self.user)
+        parent = None
+        for number in range(1, 11):
+            parent = create_version(self.document.id, f'hello {number}', self.user.id, parent=parent)
+        self.client.force_login(self.user)
+
+    def test_editor_view(self):
+        # Session, user, document and the access check, which is then cached
+        with self.assertNumQueries(4):
+            self.client.get(f'/document/{self.document.id}/')
+        with self.assertNumQueries(3):
+            self.client.get(f'/document/{self.document.id}/')
+
+    def test_document_versions_view(self):
+        # Session, user, document, access check, version count and one page of versions
+        with self.assertNumQueries(6):
+            response = self.client.get(f'/document/{self.document.id}/versions/')
+        self.assertContains(response, 'Version 10')
+        self.assertNotContains(response, 'hello 10')
+
+    def test_document_versions_api(self):
+        # Session, user, access check and one page of versions without content
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/documents/{self.document.id}/versions/')
+        results = response.json()['results']
+        self.assertEqual([item['version_number'] for item in results], list(range(10, 0, -1)))
+        self.assertNotIn('content', results[0])
+
+    def test_single_version_content(self):
+        version = DocumentVersion.objects.get(document=self.document, version_number=7)
+        response = self.client.get(f'/api/documents/{self.document.id}/versions/{version.id}/')
+        self.assertEqual(response.json()['content'], 'hello 7')
+
+    def test_versions_export_streams_every_version(self):
+        response = self.client.get(f'/api/documents/{self.document.id}/versions/export/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([codec.loads(line)['content'] for line in lines],
+                         [f'hello {number}' for number in range(1, 11)])
+
+    def test_versions_of_inaccessible_document(self):
+        other = User.objects.create(username='bob')
+        hidden = Document.objects.create(title='Hidden', owner=other)
+        create_version(hidden.id, 'secret', other.id)
+        self.assertEqual(self.client.get(f'/api/documents/{hidden.id}/versions/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/documents/{hidden.id}/versions/export/').status_code, 404)
+
+    def test_version_diff(self):
+        url = f'/api/documents/{self.document.id}/versions/diff/'
+        response = self.client.get(url, {'from': 3, 'to': 7, 'by': 'word'})
+        self.assertEqual(response.json()['changes'], [['=', 'hello '], ['-', '3'], ['+', '7']])
+        self.assertEqual(self.client.get(url, {'from': 3, 'to': 70}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'from': 'x', 'to': 7}).status_code, 400)
+
+
+class DiffTests(SimpleTestCase):
+    def test_opcodes_are_a_shortest_edit_script(self):
+        def lcs_length(a, b):
+            row = [0] * (len(b) + 1)
+            for x in a:
+                previous, row = row, [0]
+                for j, y in enumerate(b):
+                    row.append(previous[j] + 1 if x == y else max(previous[j + 1], row[j]))
+            return row[-1]
+
+        rng = random.Random(5)
+        for _ in range(500):
+            a = [rng.choice('abc') for _ in range(rng.randint(0, 12))]
+            b = [rng.choice('abc') for _ in range(rng.randint(0, 12))]
+            rebuilt, edits = [], 0
+            for tag, i1, i2, j1, j2 in diff_opcodes(a, b):
+                if tag == 'equal':
+                    rebuilt += a[i1:i2]
+                elif tag == 'insert':
+                    rebuilt += b[j1:j2]
+                    edits += j2 - j1
+                else:
+                    edits += i2 - i1
+            self.assertEqual(rebuilt, b)
+            self.assertEqual(edits, len(a) + len(b) - 2 * lcs_length(a, b))
+
+    def test_unchanged_lines_are_skipped(self):
+        old = ''.join(f'line {i}\n' for i in range(100))
+        new = old.replace('line 50\n', 'line fifty\n')
+        diff = diff_texts(old, new, context=2)
+        self.assertEqual(diff['changes'], [
+            ['skip', 48], ['=', 'line 48\nline 49\n'], ['-', 'line 50\n'], ['+', 'line fifty\n'],
+            ['=', 'line 51\nline 52\n'], ['skip', 47],
+        ])
+
+
+class ClusterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', owner=self.user, content='hello')
+        self.doc_id = str(self.document.id)
+        self.layer = InMemoryChannelLayer()
+        self.registry = InMemoryWorkerRegistry()
+
+    def test_ring_moves_a_share_of_documents_to_a_new_worker(self):
+        before = HashRing(['worker-a', 'worker-b', 'worker-c'])
+        after = HashRing(['worker-a', 'worker-b', 'worker-c', 'worker-d'])
+        moved = [key for key in range(3000) if before.owner(key) != after.owner(key)]
+        self.assertTrue(all(after.owner(key) == 'worker-d' for key in moved))
+        self.assertLess(abs(len(moved) - 750), 250)
+
+    def worker(self, name):
+        return Cluster(self.registry, self.layer, DocumentStateManager(flush_interval=60), worker=name)
+
+    def edit(self, state, position, text, sender):
+        return {'base_revision': state.engine.revision, 'ops': [insert(position, text)], 'cursor_position': 0,
+                'user_id': self.user.id, 'username': 'ann', 'epoch': state.epoch, 'sender_channel_name': sender}
+
+    async def eventually(self, predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('condition not reached')
+
+    async def test_edits_are_forwarded_to_the_owner_and_handed_over(self):
+        # Names for which the document moves from a to c when c joins
+        a = HashRing(['worker-a', 'worker-b']).owner(self.doc_id)
+        b = 'worker-b' if a == 'worker-a' else 'worker-a'
+        c = next(name for name in (f'worker-c{index}' for index in range(100))
+                 if HashRing([a, b, name]).owner(self.doc_id) == name)
+        first, second = self.worker(a), self.worker(b)
+        await first.start()
+        await second.start()
+        await first.refresh()
+        editor = await self.layer.new_channel()
+        await self.layer.group_add(f'document_{self.doc_id}', editor)
+
+        replica = await second.acquire(self.doc_id)
+        self.assertEqual(replica.owner, a)
+        await second.submit_edit(replica, self.edit(replica, 5, ' there', editor))
+        event = await asyncio.wait_for(self.layer.receive(editor), 1)
+        self.assertEqual(event['revision'], 1)
+        self.assertEqual(first.manager.get(self.doc_id).engine.content, 'hello there')
+        await self.eventually(lambda: replica.engine.content == 'hello there')
+
+        third = self.worker(c)
+        await third.start()
+        await first.refresh()
+        await self.eventually(lambda: third.manager.get(self.doc_id) is not None)
+        await self.eventually(lambda: replica.owner == c)
+        self.assertIsNone(first.manager.get(self.doc_id))
+        self.assertEqual(await database_sync_to_async(lambda: Document.objects.get(id=self.doc_id).content)(),
+                         'hello there')
+
+        owned = third.manager.get(self.doc_id)
+        self.assertEqual((owned.engine.revision, owned.epoch), (1, replica.epoch))
+        await second.submit_edit(replica, self.edit(replica, 11, ' world', editor))
+        event = await asyncio.wait_for(self.layer.receive(editor), 1)
+        self.assertEqual(event['revision'], 2)
+        await self.eventually(lambda: replica.engine.content == 'hello there world')
+
+        # The owner writes the document back once the last replica is gone
+        await second.release(self.doc_id)
+        await self.eventually(lambda: third.manager.get(self.doc_id) is None)
+        self.assertEqual(await database_sync_to_async(lambda: Document.objects.get(id=self.doc_id).content)(),
+                         'hello there world')
+
+
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', owner=self.user, content='hello')
+        self.doc_id = str(self.document.id)
+
+    async def edit(self, manager, state, text):
+        revision, ops = state.engine.apply(state.engine.revision, [insert(state.engine.length, text)])
+        manager.mark_dirty(state, self.user.id, ops)
+
+    async def stored_content(self):
+        return await database_sync_to_async(lambda: Document.objects.get(id=self.doc_id).content)()
+
+    async def test_flushed_after_interval(self):
+        manager = DocumentStateManager(flush_interval=0.05, flush_ops=1000)
+        state = await manager.acquire(self.doc_id)
+        await self.edit(manager, state, ' there')
+        self.assertEqual(await self.stored_content(), 'hello')
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.stored_content(), 'hello there')
+        self.assertFalse(state.dirty)
+        await manager.release(self.doc_id)
+
+    async def test_flushed_after_enough_edits(self):
+        manager = DocumentStateManager(flush_interval=60, flush_ops=3)
+        state = await manager.acquire(self.doc_id)
+        for text in ' a', ' b':
+            await self.edit(manager, state, text)
+        await asyncio.sleep(0.05)
+        self.assertEqual(await self.stored_content(), 'hello')
+        await self.edit(manager, state, ' c')
+        await asyncio.gather(*manager._pending_flushes)
+        self.assertEqual(await self.stored_content(), 'hello a b c')
+        await manager.release(self.doc_id)
+
+    async def test_flushed_when_last_connection_closes(self):
+        manager = DocumentStateManager(flush_interval=60, flush_ops=1000)
+        state = await manager.acquire(self.doc_id)
+        await manager.acquire(self.doc_id)
+        await self.edit(manager, state, ' there')
+        await manager.release(self.doc_id)
+        self.assertEqual(await self.stored_content(), 'hello')
+        await manager.release(self.doc_id)
+        self.assertEqual(await self.stored_content(), 'hello there')
+        self.assertIsNone(manager.get(self.doc_id))
+
+    def test_flushed_at_shutdown(self):
+        manager = DocumentStateManager(flush_interval=60, flush_ops=1000)
+
+        async def edit():
+            state = await manager.acquire(self.doc_id)
+            await self.edit(manager, state, ' there')
+            # A replica's content is not ours to write back
+            replica = await manager.acquire('0')
+            replica.owner = 'collab.elsewhere'
+            await self.edit(manager, replica, 'lost')
+
+        async_to_sync(edit)()
+        # What get_cluster() registers with atexit
+        Cluster(InMemoryWorkerRegistry(), InMemoryChannelLayer(), manager, worker='worker-a').stop()
+        self.assertEqual(Document.objects.get(id=self.doc_id).content, 'hello there')
+        self.assertTrue(manager.get('0').dirty)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LiveWriteTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', owner=self.user, content='hello')
+        self.client.force_login(self.user)
+
+    async def test_rest_writes_reach_open_sessions(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             f'/ws/document/{self.document.id}/?protocol=delta')
+        communicator.scope['user'] = self.user
+        self.assertTrue((await communicator.connect())[0])
+
+        response = await sync_to_async(self.client.post)(
+            f'/api/document/{self.document.id}/save-version/', codec.dumps({'content': 'hello world'}),
+            content_type='application/json')
+        self.assertEqual(response.json()['version_number'], 1)
+        response = await sync_to_async(self.client.patch)(
+            f'/api/documents/{self.document.id}/', {'content': 'hello brave world'}, content_type='application/json')
+        self.assertEqual(response.json()['content'], 'hello brave world')
+
+        deltas = []
+        while len(deltas) < 2:
+            message = await communicator.receive_json_from(timeout=2)
+            deltas += [m for m in message.get('messages', [message]) if m['type'] == 'edit_delta']
+        self.assertEqual([delta['ops'] for delta in deltas], [[insert(5, ' world')], [insert(6, 'brave ')]])
+        state = get_cluster().manager.get(str(self.document.id))
+        self.assertEqual(state.engine.content, 'hello brave world')
+        self.assertFalse(state.dirty)
+
+        # The session's final flush keeps what was written
+        await communicator.disconnect()
+        document = await database_sync_to_async(Document.objects.get)(id=self.document.id)
+        self.assertEqual(document.content, 'hello brave world')
+
+
+class VersionNumberTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', owner=self.user)
+
+    # SQLite's in-memory test database fails concurrent writers instead of making them wait
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_saves_get_distinct_numbers(self):
+        def save(i):
+            try:
+                return create_version(self.document.id, f'content {i}', self.user.id).version_number
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            numbers = list(pool.map(save, range(64)))
+
+        self.assertEqual(sorted(numbers), list(range(1, 65)))
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.version_count, 64)
+
+    def test_missing_document(self):
+        with self.assertRaises(Document.DoesNotExist):
+            allocate_version_number(self.document.id + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LoadTestTests(TransactionTestCase):
+    databases = {'default', LOADTEST_DATABASE}
+
+    def test_small_run_reports_every_broadcast(self):
+        report = LoadTest(documents=2, editors=3, rate=20, duration=0.3, document_size=200).execute()
+        self.assertGreater(report['edits_sent'], 0)
+        self.assertEqual(report['edits_acked'], report['edits_sent'])
+        self.assertEqual(report['edit_to_broadcast_ms']['count'], report['broadcasts_expected'])
+        self.assertEqual(report['errors'], 0)
+        self.assertIsNotNone(report['db_queries']['per_edit'])
+        # The run had a database of its own
+        self.assertEqual(report['environment']['database'], 'sqlite')
+        self.assertFalse(User.objects.filter(username__startswith='loadtest-').exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DeltaEditTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username='ann'), User.objects.create(username='bob')]
+        self.document = Document.objects.create(title='Notes', owner=self.users[0], content='hello')
+        self.document.collaborators.add(self.users[1])
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             f'/ws/document/{self.document.id}/?protocol=delta')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, message_type):
+        # Messages after the one looked for may come in the same batch
+        received = communicator.__dict__.setdefault('received', deque())
+        while True:
+            while received:
+                message = received.popleft()
+                if message['type'] == message_type:
+                    return message
+            message = await communicator.receive_json_from(timeout=2)
+            received.extend(message['messages'] if message['type'] == 'batch' else [message])
+
+    async def test_stale_edits_are_transformed_and_broadcast(self):
+        ann, bob = await self.connect(self.users[0]), await self.connect(self.users[1])
+        for communicator in (ann, bob):
+            self.assertEqual((await self.receive(communicator, 'sync'))['revision'], 0)
+
+        await ann.send_json_to({'type': 'edit_delta', 'base_revision': 0, 'ops': [insert(5, ' world')]})
+        self.assertEqual((await self.receive(ann, 'edit_ack'))['revision'], 1)
+        delta = await self.receive(bob, 'edit_delta')
+        self.assertEqual((delta['revision'], delta['ops'], delta['user_id']), (1, [insert(5, ' world')], self.users[0].id))
+
+        # Typed before bob saw revision 1; ann's insert at the same position came first
+        await bob.send_json_to({'type': 'edit_delta', 'base_revision': 0, 'ops': [insert(5, '!')],
+                                'cursor_position': 6})
+        self.assertEqual((await self.receive(bob, 'edit_ack'))['revision'], 2)
+        delta = await self.receive(ann, 'edit_delta')
+        self.assertEqual((delta['revision'], delta['ops'], delta['cursor_position']), (2, [insert(11, '!')], 6))
+        self.assertEqual(get_cluster().manager.get(str(self.document.id)).engine.content, 'hello world!')
+        await ann.disconnect()
+        await bob.disconnect()
+
+    async def test_malformed_ops_are_rejected(self):
+        ann = await self.connect(self.users[0])
+        await self.receive(ann, 'sync')
+        for message in ({'type': 'edit_delta', 'base_revision': 0, 'ops': [{'op': 'insert', 'pos': -1, 'text': 'x'}]},
+                        {'type': 'edit_delta', 'base_revision': '0', 'ops': []},
+                        {'type': 'edit_delta', 'base_revision': 0, 'ops': [delete(3, 10)]}):
+            await ann.send_json_to(message)
+        for _ in range(2):
+            self.assertTrue((await self.receive(ann, 'error'))['error'].startswith('Invalid edit_delta'))
+        # Ops that do not fit the document are answered with a fresh sync
+        self.assertEqual((await self.receive(ann, 'sync'))['content'], 'hello')
+        await ann.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ResumeTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann')
+        self.document = Document.objects.create(title='Notes', owner=self.user, content='hello')
+
+    async def connect(self, query='protocol=delta'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             f'/ws/document/{self.document.id}/?{query}')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, message_type):
+        while True:
+            message = await communicator.receive_json_from(timeout=2)
+            messages = message['messages'] if message['type'] == 'batch' else [message]
+            for message in messages:
+                if message['type'] == message_type:
+                    return message
+
+    async def test_reconnect_receives_only_missed_ops(self):
+        editor = await self.connect()
+        reader = await self.connect()
+        sync = await self.receive(reader, 'sync')
+        await reader.disconnect()
+
+        for text in (' there', ' world'):
+            await editor.send_json_to({'type': 'edit_delta', 'base_revision': sync['revision'],
+                                       'ops': [insert(5, text)]})
+            await self.receive(editor, 'edit_ack')
+
+        reader = await self.connect(f'protocol=delta&epoch={sync["epoch"]}&revision={sync["revision"]}')
+        resume = await self.receive(reader, 'resume')
+        self.assertEqual(resume['revision'], sync['revision'] + 2)
+        self.assertEqual(apply_ops(sync['content'], resume['ops']), 'hello there world')
+        await reader.disconnect()
+
+        reader = await self.connect(f'protocol=delta&epoch=unknown&revision={sync["revision"]}')
+        self.assertEqual((await self.receive(reader, 'sync'))['content'], 'hello there world')
+        await reader.disconnect()
+        await editor.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BinarySubprotocolTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username='ann'), User.objects.create(username='bob')]
+        self.document = Document.objects.create(title='Notes', owner=self.users[0], content='hello')
+        self.document.collaborators.add(self.users[1])
+
+    async def connect(self, user, subprotocols):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/document/{self.document.id}/',
+                                             subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def receive(self, communicator, code):
+        # Messages after the one looked for may come in the same batch
+        received = communicator.__dict__.setdefault('received', deque())
+        while True:
+            while received:
+                message = received.popleft()
+                if message[0] == code:
+                    return message
+            array = codec.loads((await communicator.receive_from(timeout=2))[1:])
+            received.extend(array[1:] if array[0] == compact.BATCH else [array])
+
+    async def test_binary_and_json_clients_edit_together(self):
+        binary, subprotocol = await self.connect(self.users[1], ['collab.compact'])
+        self.assertEqual(subprotocol, 'collab.compact')
+        self.assertEqual((await self.receive(binary, 1))[1:3], [0, 'hello'])
+        text, subprotocol = await self.connect(self.users[0], None)
+        self.assertIsNone(subprotocol)
+
+        await text.send_json_to({'type': 'edit', 'content': 'hello world'})
+        # Each user is named once, before the first message about them
+        self.assertEqual(await self.receive(binary, 11), [11, self.users[1].id, 'bob'])
+        self.assertEqual(await self.receive(binary, 11), [11, self.users[0].id, 'ann'])
+        self.assertEqual(await self.receive(binary, 6), [6, self.users[0].id])
+        self.assertEqual(await self.receive(binary, 3), [3, 1, [[5, ' world']], 0, self.users[0].id])
+
+        await binary.send_to(bytes_data=b'\x00' + codec.dumps([3, 1, [[0, 5]], 0]).encode())
+        self.assertEqual(await self.receive(binary, 2), [2, 2])
+        message = await text.receive_json_from(timeout=2)
+        while message.get('type') != 'edit' or message['revision'] != 2:
+            message = await text.receive_json_from(timeout=2)
+        self.assertEqual(message['content'], ' world')
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_resync_reaches_binary_clients(self):
+        binary, _ = await self.connect(self.users[1], ['collab.compact'])
+        self.assertEqual((await self.receive(binary, 1))[1:3], [0, 'hello'])
+        await get_channel_layer().group_send(document_group(self.document.id), {'type': 'document_resync'})
+        self.assertEqual((await self.receive(binary, 1))[1:3], [0, 'hello'])
+        await binary.disconnect()
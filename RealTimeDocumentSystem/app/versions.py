@@ -0,0 +1,178 @@
+"""
+Compact storage for document versions.
+
+Every KEYFRAME_INTERVAL-th version of a document stores its full content
+(a keyframe). The versions in between store only a JSON list of ops that
+turn their parent's content into theirs, and ``depth`` counts how many
+deltas separate a version from its keyframe.
+"""
+import json
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import F
+
+from .collab.ops import apply_ops, diff_ops
+from .models import Document, DocumentVersion
+
+DEFAULT_KEYFRAME_INTERVAL = 20
+
+
+def get_keyframe_interval():
+    return max(1, getattr(settings, 'DOCUMENT_VERSION_KEYFRAME_INTERVAL', DEFAULT_KEYFRAME_INTERVAL))
+
+
+def compute_delta(old, new):
+    """Return ops turning old into new, diffing line by line first"""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+
+    ops = []
+    pos = 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_chunk = ''.join(old_lines[i1:i2])
+        if tag == 'equal':
+            pos += len(old_chunk)
+            continue
+        # Trim the common prefix/suffix of the changed lines as well
+        new_chunk = ''.join(new_lines[j1:j2])
+        for op in diff_ops(old_chunk, new_chunk):
+            ops.append(dict(op, pos=op['pos'] + pos))
+        pos += len(new_chunk)
+    return ops
+
+
+def encode_delta(ops):
+    return json.dumps(ops, separators=(',', ':'), ensure_ascii=False)
+
+
+class VersionContentCache:
+    """
+    Rebuilds version content from keyframes and deltas.
+
+    Contents are memoized, so resolving many versions of one document walks
+    each delta chain once. Missing ancestors are fetched a chain at a time.
+    """
+
+    def __init__(self):
+        self.contents = {}
+        self.versions = {}
+
+    def add(self, versions):
+        for version in versions:
+            self.versions[version.pk] = version
+        return self
+
+    def get(self, version):
+        chain = []
+        node = version
+        while node.pk not in self.contents:
+            if node.is_keyframe:
+                self.contents[node.pk] = node.content
+                break
+            chain.append(node)
+            node = self._get_parent(node)
+
+        content = self.contents[node.pk]
+        for node in reversed(chain):
+            content = apply_ops(content, json.loads(node.delta))
+            self.contents[node.pk] = content
+        return content
+
+    def resolve(self, versions):
+        """Set ``full_content`` on each version and return them"""
+        versions = list(versions)
+        self.add(versions)
+        for version in versions:
+            version.full_content = self.get(version)
+        return versions
+
+    def _get_parent(self, version):
+        parent = self.versions.get(version.parent_id)
+        if parent is None:
+            # Load the rest of this chain in one query
+            self.add(DocumentVersion.objects.filter(
+                document_id=version.document_id,
+                version_number__gte=version.version_number - version.depth,
+                version_number__lt=version.version_number,
+            ))
+            parent = self.versions.get(version.parent_id)
+            if parent is None:
+                parent = DocumentVersion.objects.get(pk=version.parent_id)
+                self.versions[parent.pk] = parent
+        return parent
+
+
+def iter_version_contents(versions, keep=None):
+    """
+    Yield (version, content) for versions in ascending order.
+
+    Only the contents of the last ``keep`` versions are held on to, enough
+    to apply each delta to its parent, so memory does not grow with the
+    number of versions.
+    """
+    keep = keep or get_keyframe_interval()
+    recent = OrderedDict()
+    for version in versions:
+        if version.is_keyframe:
+            content = version.content
+        elif version.parent_id in recent:
+            content = apply_ops(recent[version.parent_id], json.loads(version.delta))
+        else:
+            content = VersionContentCache().get(version)
+        recent[version.pk] = content
+        if len(recent) > keep:
+            recent.popitem(last=False)
+        yield version, content
+
+
+def allocate_version_number(document_id):
+    """
+    Reserve the next version number of a document. Call it inside a
+    transaction: the row stays locked by the increment until the transaction
+    ends, so concurrent callers get consecutive numbers.
+    """
+    updated = Document.objects.filter(id=document_id).update(version_count=F('version_count') + 1)
+    if not updated:
+        raise Document.DoesNotExist(f"Document {document_id} does not exist")
+    return Document.objects.filter(id=document_id).values_list('version_count', flat=True).get()
+
+
+def build_version(document_id, content, created_by_id, version_number, parent=None, parent_content=None):
+    """Return an unsaved version, stored as a delta against parent when possible"""
+    version = DocumentVersion(
+        document_id=document_id,
+        created_by_id=created_by_id,
+        version_number=version_number,
+    )
+    if parent is None or parent.depth + 1 >= get_keyframe_interval():
+        version.content = content
+        return version
+
+    if parent_content is None:
+        parent_content = VersionContentCache().get(parent)
+    delta = encode_delta(compute_delta(parent_content, content))
+    if len(delta) >= len(content):
+        # Rewritten wholesale, a keyframe is smaller
+        version.content = content
+        return version
+
+    version.parent = parent
+    version.depth = parent.depth + 1
+    version.delta = delta
+    version.content = ''
+    return version
+
+
+def create_version(document_id, content, created_by_id, parent=None, parent_content=None):
+    """Store a new version of a document; parent is its latest version, if any"""
+    # Diff before taking the lock so the transaction stays short
+    version = build_version(document_id, content, created_by_id, None, parent, parent_content)
+    with transaction.atomic(using=router.db_for_write(DocumentVersion)):
+        version.version_number = allocate_version_number(document_id)
+        version.save()
+    version.full_content = content
+    return version
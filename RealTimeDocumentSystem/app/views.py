@@ -2,17 +2,31 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout, authenticate
 from django.contrib import messages
-from django.http import JsonResponse
+from django.core.paginator import Paginator
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.models import User
+from asgiref.sync import async_to_sync
+from . import codec
+from .collab.cluster import get_cluster
+from .access import accessible_filter, can_access_document
 from .models import Document, DocumentVersion
-from .serializers import DocumentSerializer, DocumentVersionSerializer
+from .dashboard import document_lists_html
+from .diff import DEFAULT_CONTEXT, diff_versions
+from .pagination import DocumentCursorPagination, VersionCursorPagination
+from .serializers import (DocumentListSerializer, DocumentSerializer, DocumentVersionListSerializer,
+                          DocumentVersionSerializer, requested_fields)
+from .versions import iter_version_contents
 import json
-from django.db import models
+
+VERSIONS_PER_PAGE = 50
+VERSION_EXPORT_CHUNK_SIZE = 200
+MAX_DIFF_CONTEXT = 50
 
 # Authentication Views
 def login_view(request):
@@ -51,37 +65,8 @@ def logout_view(request):
 # Document Management Views
 @login_required
 def dashboard(request):
-    owned_docs = Document.objects.filter(owner=request.user)
-    collaborated_docs = Document.objects.filter(collaborators=request.user)
-    public_docs = Document.objects.filter(is_public=True).exclude(owner=request.user)
-    
-    # Get active users for all documents
-    from .models import DocumentSession
-    from django.utils import timezone
-    from datetime import timedelta
-    
-    # Consider users active if they joined in the last 5 minutes
-    active_threshold = timezone.now() - timedelta(minutes=5)
-    
-    # Get all active sessions
-    active_sessions = DocumentSession.objects.filter(
-        joined_at__gte=active_threshold
-    ).select_related('user', 'document')
-    
-    # Group active users by document
-    active_users_by_doc = {}
-    for session in active_sessions:
-        doc_id = session.document.id
-        if doc_id not in active_users_by_doc:
-            active_users_by_doc[doc_id] = []
-        if session.user not in active_users_by_doc[doc_id]:
-            active_users_by_doc[doc_id].append(session.user)
-    
     context = {
-        'owned_docs': owned_docs,
-        'collaborated_docs': collaborated_docs,
-        'public_docs': public_docs,
-        'active_users_by_doc': active_users_by_doc
+        'documents_html': document_lists_html(request.user)
     }
     return render(request, 'dashboard.html', context)
 
@@ -98,12 +83,10 @@ def create_document(request):
 
 @login_required
 def editor_view(request, doc_id):
-    document = get_object_or_404(Document, id=doc_id)
+    document = get_object_or_404(Document.objects.select_related('owner'), id=doc_id)
     
     # Check if user has access
-    if not (request.user == document.owner or 
-            request.user in document.collaborators.all() or 
-            document.is_public):
+    if not can_access_document(request.user, document.id):
         messages.error(request, 'You do not have permission to access this document.')
         return redirect('dashboard')
     
@@ -115,12 +98,20 @@ def editor_view(request, doc_id):
 
 @login_required
 def document_versions(request, doc_id):
-    document = get_object_or_404(Document, id=doc_id)
-    versions = document.versions.all()
+    document = get_object_or_404(Document.objects.select_related('owner'), id=doc_id)
+    
+    # Check if user has access
+    if not can_access_document(request.user, document.id):
+        messages.error(request, 'You do not have permission to access this document.')
+        return redirect('dashboard')
+    
+    # Content is fetched from the API when a version is opened
+    versions = document.versions.select_related('created_by').defer('content', 'delta')
+    page = Paginator(versions, VERSIONS_PER_PAGE).get_page(request.GET.get('page'))
     
     context = {
         'document': document,
-        'versions': versions
+        'versions': page
     }
     return render(request, 'document_versions.html', context)
 
@@ -180,29 +171,17 @@ def save_version(request, doc_id):
         document = get_object_or_404(Document, id=doc_id)
         
         # Check if user has access
-        if not (request.user == document.owner or 
-                request.user in document.collaborators.all() or 
-                document.is_public):
+        if not can_access_document(request.user, document.id):
             return JsonResponse({'success': False, 'error': 'Permission denied'})
         
         try:
             data = json.loads(request.body)
             content = data.get('content', '')
             
-            # Update document content
-            document.content = content
-            document.save()
-            
-            # Create version
-            latest_version = document.versions.first()
-            version_number = (latest_version.version_number + 1) if latest_version else 1
-            
-            DocumentVersion.objects.create(
-                document=document,
-                content=content,
-                created_by=request.user,
-                version_number=version_number
-            )
+            # Applied to the live document like an edit, so open sessions see it
+            # and their next flush does not put the old content back
+            version_number = async_to_sync(get_cluster().write_content)(
+                str(document.id), content, request.user.id, request.user.username, version=True)
             
             return JsonResponse({
                 'success': True,
@@ -221,18 +200,40 @@ def save_version(request, doc_id):
 class DocumentViewSet(viewsets.ModelViewSet):
     serializer_class = DocumentSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = DocumentCursorPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return DocumentListSerializer
+        return DocumentSerializer
 
     def get_queryset(self):
         user = self.request.user
-        return Document.objects.filter(
-            models.Q(owner=user) |
-            models.Q(collaborators=user) |
-            models.Q(is_public=True)
-        ).distinct()
+        # EXISTS on the collaborator table needs no join, so no distinct() either
+        queryset = Document.objects.filter(accessible_filter(user.id)).select_related('owner')
+        
+        if self.action == 'add_collaborator':
+            return queryset
+        
+        fields = requested_fields(self.request)
+        if fields is None or 'collaborators' in fields:
+            queryset = queryset.prefetch_related('collaborators')
+        if self.action == 'list' or (fields is not None and 'content' not in fields):
+            queryset = queryset.defer('content')
+        return queryset
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    def perform_update(self, serializer):
+        # Content changes go through the live document, as in save_version
+        content = serializer.validated_data.pop('content', None)
+        document = serializer.save()
+        if content is not None:
+            async_to_sync(get_cluster().write_content)(
+                str(document.id), content, self.request.user.id, self.request.user.username)
+            document.refresh_from_db(fields=['content', 'updated_at'])
+
     @action(detail=True, methods=['post'])
     def add_collaborator(self, request, pk=None):
         document = self.get_object()
@@ -247,18 +248,66 @@ class DocumentViewSet(viewsets.ModelViewSet):
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
-    @action(detail=True, methods=['get'])
-    def versions(self, request, pk=None):
-        document = self.get_object()
-        versions = document.versions.all()
-        serializer = DocumentVersionSerializer(versions, many=True)
-        return Response(serializer.data)
-
 
 class DocumentVersionViewSet(viewsets.ReadOnlyModelViewSet):
-    serializer_class = DocumentVersionSerializer
+    """
+    Version history of a document. The list is paginated metadata only;
+    content comes one version at a time, or for all of them from the
+    streamed export.
+    """
     permission_classes = [IsAuthenticated]
+    pagination_class = VersionCursorPagination
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return DocumentVersionSerializer
+        return DocumentVersionListSerializer
 
     def get_queryset(self):
         document_id = self.kwargs.get('document_pk')
-        return DocumentVersion.objects.filter(document_id=document_id)
+        if not can_access_document(self.request.user, document_id):
+            raise NotFound()
+        versions = DocumentVersion.objects.filter(document_id=document_id).select_related('created_by')
+        if self.action == 'list':
+            versions = versions.defer('content', 'delta')
+        return versions
+
+    @action(detail=False, methods=['get'])
+    def diff(self, request, document_pk=None):
+        """Changes between versions ?from=a&to=b, by=line (default) or by=word"""
+        # Checks access before anything is served from the diff cache
+        self.get_queryset()
+        try:
+            from_number = int(request.query_params['from'])
+            to_number = int(request.query_params['to'])
+            context = int(request.query_params.get('context', DEFAULT_CONTEXT))
+        except (KeyError, ValueError):
+            raise ValidationError({'error': "'from' and 'to' must be version numbers"})
+        by = request.query_params.get('by', 'line')
+        if by not in ('line', 'word'):
+            raise ValidationError({'error': "'by' must be 'line' or 'word'"})
+        
+        try:
+            result = diff_versions(document_pk, from_number, to_number, by, max(0, min(context, MAX_DIFF_CONTEXT)))
+        except DocumentVersion.DoesNotExist:
+            raise NotFound()
+        return Response(result)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, document_pk=None):
+        """Every version with its content as newline-delimited JSON, oldest first"""
+        versions = self.get_queryset().order_by('version_number').iterator(chunk_size=VERSION_EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(export_versions(versions), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="document-{document_pk}-versions.ndjson"'
+        return response
+
+
+def export_versions(versions):
+    for version, content in iter_version_contents(versions):
+        yield codec.dumps({
+            'id': version.id,
+            'version_number': version.version_number,
+            'created_by': version.created_by.username,
+            'created_at': version.created_at.isoformat(),
+            'content': content
+        }) + '\n'